@@ -0,0 +1,282 @@
+"""Calibrate the data loading settings of a training run: short training passes of the training data loader and
+model are timed for every candidate value of num_workers, prefetch_factor, prefetch_batches, pin_memory (on a GPU),
+num_threads (on a CPU) and optionally batch_size, one setting after the other. The best settings are written to an
+options file read back with --options_file, and the run is reported as input-bound or compute-bound by comparing
+its throughput with the one of training steps repeated on a batch already loaded.
+    python autotune.py --dataroot data/ --dataset_name birds --model attngan --autotune_out saved/birds_loader.json
+    python train.py --options_file saved/birds_loader.json ...
+"""
+import os
+import copy
+import time
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import BatchSampler
+from base import BaseOptions, HAS_PREFETCH_FACTOR, worker_kwargs
+from data_loader import COCOShardDataLoader
+from data_loader.data_loaders import text_image_collate_fn, text_image_worker_init_fn
+from data_loader.prefetcher import DataPrefetcher
+from data_loader.samplers import EpochBatchSampler, ImageGroupedBatchSampler
+from model import create_model
+from options import AutotuneOptions
+from train import training_fields, create_data_loader, set_damsm_caches
+
+# the settings searched, in the order of the search
+SEARCHED_OPTIONS = ('num_workers', 'prefetch_factor', 'prefetch_batches', 'pin_memory', 'num_threads', 'batch_size')
+# throughput ratio to the training steps alone under which the run is input-bound
+INPUT_BOUND_RATIO = 0.9
+
+
+def powers_of_two(limit, start=1):
+    """[start, 2 * start, 4 * start, ...] up to <limit>, with <limit> itself."""
+    values = []
+    value = start
+    while value < limit:
+        values.append(value)
+        value *= 2
+    return values + [limit]
+
+
+def batch_samples(batch):
+    """Number of samples of a batch, the size of its first tensor."""
+    for value in batch.values():
+        if torch.is_tensor(value):
+            return value.size(0)
+    return 0
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class Calibration(object):
+    """Timed training passes of <model> on the training data loader, with some of its options replaced.
+    The dataset of the loader is shared by all the passes, which only rebuild the DataLoader around it: the
+    dataset is loaded once and its shared image cache (--shm_cache_mb) stays warm from one pass to the next.
+    """
+    def __init__(self, opt, model, data_loader):
+        """
+            @:param opt (Namespace): training options
+            @:param model (BaseTrainer): model trained by the passes
+            @:param data_loader (DataLoader): training data loader, see train.create_data_loader
+        """
+        self.opt = opt
+        self.model = model
+        self.data_loader = data_loader
+        self.default_threads = torch.get_num_threads()
+        # results of the settings already timed
+        self.results = {}
+        model.set_image_flip(data_loader.dataset.flip)
+        set_damsm_caches(opt, data_loader, model)
+        self.warm_shared_cache()
+
+    def warm_shared_cache(self):
+        """Fill the shared image cache of the dataset, as the first epoch of the training does, so that every
+        pass reads the images the way the following epochs do."""
+        cache = getattr(self.data_loader.dataset, 'shared_cache', None)
+        if cache is None:
+            return
+        n_images = min(cache.n_slots, len(self.data_loader.dataset))
+        print('filling the shared image cache with {} images'.format(n_images))
+        warm_loader = DataLoader(self.data_loader.dataset, batch_size=self.opt.batch_size,
+                                 sampler=list(range(n_images)), collate_fn=text_image_collate_fn,
+                                 worker_init_fn=text_image_worker_init_fn, num_workers=os.cpu_count() or 1)
+        for _ in warm_loader:
+            pass
+
+    def options(self, settings):
+        """Copy of the options with the values of <settings>."""
+        opt = copy.copy(self.opt)
+        for key, value in settings.items():
+            setattr(opt, key, value)
+        return opt
+
+    def loader(self, opt):
+        """DataLoader of the dataset of the training data loader, with the batch size and the loading settings
+        of the options <opt>."""
+        data_loader = self.data_loader
+        kwargs = dict(collate_fn=data_loader.collate_fn, worker_init_fn=data_loader.worker_init_fn,
+                      **worker_kwargs(opt.num_workers, opt.pin_memory, opt.prefetch_factor))
+        if isinstance(data_loader, COCOShardDataLoader):
+            # the samples are streamed by the dataset, the DataLoader cuts them into batches
+            return DataLoader(data_loader.dataset, batch_size=opt.batch_size, **kwargs)
+        batch_sampler = data_loader.batch_sampler
+        if isinstance(batch_sampler, BatchSampler):
+            batch_sampler = BatchSampler(batch_sampler.sampler, opt.batch_size, batch_sampler.drop_last)
+        else:
+            batch_sampler = copy.copy(batch_sampler)
+            batch_sampler.batch_size = opt.batch_size
+            if isinstance(batch_sampler, ImageGroupedBatchSampler):
+                batch_sampler.num_streams = max(opt.num_workers, 1)
+            if isinstance(batch_sampler, EpochBatchSampler):
+                # the batches made in advance by __len__ have the batch size of the training loader
+                batch_sampler._batches = None
+                batch_sampler._fresh = False
+        return DataLoader(data_loader.dataset, batch_sampler=batch_sampler, **kwargs)
+
+    def batches(self, opt):
+        """Data loader of the options <opt>, wrapped in a DataPrefetcher as in train.py."""
+        torch.set_num_threads(opt.num_threads if opt.num_threads > 0 else self.default_threads)
+        data_loader = self.loader(opt)
+        if opt.prefetch_batches > 0:
+            return DataPrefetcher(data_loader, self.model.device, opt.prefetch_batches)
+        return data_loader
+
+    def step(self, data):
+        self.model.set_input(data)
+        self.model.optimize_parameters()
+
+    def train(self, settings):
+        """Time <opt.autotune_batches> training steps with <settings>, after <opt.autotune_warmup> steps.
+            @:return the samples per second, and the fraction of the time spent waiting for the batches
+        """
+        key = tuple(sorted(settings.items()))
+        if key in self.results:
+            return self.results[key]
+        opt = self.options(settings)
+        batches = self.batches(opt)
+        iterator = iter(batches)
+        n_samples, waited, start = 0, 0.0, time.time()
+        try:
+            for step in range(opt.autotune_warmup + opt.autotune_batches):
+                if step == opt.autotune_warmup:
+                    synchronize(self.model.device)
+                    n_samples, waited, start = 0, 0.0, time.time()
+                wait_start = time.time()
+                try:
+                    data = next(iterator)
+                except StopIteration:
+                    # the epoch is shorter than the pass
+                    iterator = iter(batches)
+                    data = next(iterator)
+                waited += time.time() - wait_start
+                n_samples += batch_samples(data)
+                self.step(data)
+            synchronize(self.model.device)
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            del iterator
+        elapsed = max(time.time() - start, 1e-12)
+        self.results[key] = (n_samples / elapsed, waited / elapsed)
+        return self.results[key]
+
+    def train_compute(self, settings):
+        """Time the training steps alone with <settings>, repeated on one batch already on the device.
+            @:return the samples per second
+        """
+        opt = self.options(settings)
+        batches = self.batches(opt)
+        iterator = iter(batches)
+        try:
+            data = next(iterator)
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            del iterator
+        data = {key: value.to(self.model.device) if torch.is_tensor(value) else value for key, value in data.items()}
+        n_samples, start = 0, None
+        for step in range(opt.autotune_warmup + opt.autotune_batches):
+            if step == opt.autotune_warmup:
+                synchronize(self.model.device)
+                n_samples, start = 0, time.time()
+            n_samples += batch_samples(data)
+            # set_input may replace the entries of the batch, e.g. the uint8 images
+            self.step(dict(data))
+        synchronize(self.model.device)
+        return n_samples / max(time.time() - start, 1e-12)
+
+
+def candidate_values(opt, settings, use_cuda):
+    """Values tried for each searched option, from the cheapest to the most expensive one."""
+    n_cpus = os.cpu_count() or 1
+    candidates = {
+        'num_workers': opt.autotune_workers or [0] + powers_of_two(n_cpus),
+        'prefetch_factor': opt.autotune_prefetch_factors,
+        'prefetch_batches': opt.autotune_prefetch_batches,
+        'pin_memory': [False, True] if use_cuda else [],
+        # the threads of the training steps share the cpus with the loading workers
+        'num_threads': [] if use_cuda else opt.autotune_threads or powers_of_two(n_cpus),
+        'batch_size': opt.autotune_batch_sizes,
+    }
+    if settings['num_workers'] == 0 or not HAS_PREFETCH_FACTOR:
+        # prefetch_factor is the number of batches loaded in advance by every worker, torch >= 1.7
+        candidates['prefetch_factor'] = []
+    return candidates
+
+
+def is_out_of_memory(error):
+    return isinstance(error, RuntimeError) and 'out of memory' in str(error)
+
+
+def search(calibration, opt, use_cuda):
+    """Search the options one after the other, each one set to its cheapest value within <opt.autotune_tolerance>
+    of the best throughput, the others keeping their current values.
+        @:return the best settings, the options searched, and the samples per second and waiting fraction of the
+        best settings
+    """
+    settings = {key: getattr(opt, key) for key in SEARCHED_OPTIONS}
+    searched = []
+    for key in SEARCHED_OPTIONS:
+        values = candidate_values(opt, settings, use_cuda)[key]
+        if not values:
+            continue
+        searched.append(key)
+        results = []
+        for value in values:
+            trial = dict(settings)
+            trial[key] = value
+            try:
+                samples_per_second, wait_fraction = calibration.train(trial)
+            except RuntimeError as error:
+                if not is_out_of_memory(error):
+                    raise
+                print('    {:>16} = {:<6} out of memory'.format(key, str(value)))
+                if use_cuda:
+                    torch.cuda.empty_cache()
+                continue
+            print('    {:>16} = {:<6} {:8.1f} samples/s, {:4.1f}% of the time waiting for data'.format(
+                key, str(value), samples_per_second, 100 * wait_fraction))
+            results.append((value, samples_per_second))
+        if not results:
+            raise RuntimeError("no value of {} could be trained on".format(key))
+        best = max(samples_per_second for _, samples_per_second in results)
+        settings[key] = next(value for value, samples_per_second in results
+                             if samples_per_second >= (1 - opt.autotune_tolerance) * best)
+        print('{} = {}'.format(key, settings[key]))
+    samples_per_second, wait_fraction = calibration.train(settings)
+    return settings, searched, samples_per_second, wait_fraction
+
+
+def main(opt):
+    data_loader = create_data_loader(opt, training_fields(opt))
+    opt.vocab_size = len(data_loader.dataset.vocab)
+
+    model = create_model(opt)
+    model.setup(opt)
+    use_cuda = model.device.type == 'cuda'
+    calibration = Calibration(opt, model, data_loader)
+
+    print('searching {} with {} timed steps per pass'.format(', '.join(SEARCHED_OPTIONS), opt.autotune_batches))
+    settings, searched, samples_per_second, wait_fraction = search(calibration, opt, use_cuda)
+    compute_samples_per_second = calibration.train_compute(settings)
+
+    ratio = samples_per_second / max(compute_samples_per_second, 1e-12)
+    print('best settings: {}'.format(', '.join('{}={}'.format(key, settings[key]) for key in SEARCHED_OPTIONS)))
+    print('training: {:.1f} samples/s, {:.1f}% of the time waiting for data; training steps alone: {:.1f} samples/s'
+          .format(samples_per_second, 100 * wait_fraction, compute_samples_per_second))
+    if ratio < INPUT_BOUND_RATIO:
+        print('input-bound: the data loading limits the training to {:.0f}% of the speed of its steps, see '
+              '--shm_cache_mb, --uint8_images, --batch_pyramid and --use_image_pyramid'.format(100 * ratio))
+    else:
+        print('compute-bound: the training runs at {:.0f}% of the speed of its steps'.format(100 * min(ratio, 1.0)))
+
+    options_file = opt.autotune_out or opt.options_file or os.path.join(opt.save_dir, 'loader_options.json')
+    BaseOptions.save_options_file(options_file, {key: settings[key] for key in searched})
+    print('settings written to {}, train with --options_file {}'.format(options_file, options_file))
+
+
+if __name__ == '__main__':
+    opt = AutotuneOptions().parse()
+    main(opt)
@@ -1,14 +1,134 @@
+import inspect
+import warnings
 import numpy as np
+import torch
 from torch.utils.data import DataLoader
 from torch.utils.data.dataloader import default_collate
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import Sampler, SubsetRandomSampler
 
 
-class BaseDataLoader(DataLoader):
+# whether the DataLoader takes the number of batches loaded in advance by every worker (torch >= 1.7)
+HAS_PREFETCH_FACTOR = 'prefetch_factor' in inspect.signature(DataLoader.__init__).parameters
+
+
+def worker_kwargs(num_workers, pin_memory=False, prefetch_factor=2):
+    """DataLoader arguments of the loading processes. <prefetch_factor>, the number of batches loaded in advance
+    by every worker, is only passed when it is not the default one, as it needs workers, and ignored with a
+    warning when the DataLoader does not take it."""
+    kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    if num_workers > 0 and prefetch_factor != 2:
+        if HAS_PREFETCH_FACTOR:
+            kwargs['prefetch_factor'] = prefetch_factor
+        else:
+            warnings.warn("prefetch_factor={} is ignored, the DataLoader of torch {} does not take it (torch >= 1.7)"
+                          .format(prefetch_factor, torch.__version__))
+    return kwargs
+
+
+def load_sampler_state(sampler, state, kind='sampler'):
+    """Restore a state saved by <sampler>.state_dict. A state saved by another kind of sampler, e.g. with
+    --bucket_by_length and resumed without it, raises a ValueError.
+        @:param sampler (Sampler): sampler with the keys of its states in <state_keys>
+        @:param state (dict): state to restore
+        @:param kind (string): name of the sampler in the error message
+    """
+    state_keys = getattr(sampler, 'state_keys', None)
+    if state_keys is None or set(state) != set(state_keys):
+        raise ValueError("the {} {} cannot resume from a state with the keys {}, was the checkpoint saved with other "
+                         "data loading options?".format(kind, type(sampler).__name__, sorted(state)))
+    sampler.load_state_dict(state)
+
+
+def epoch_state(stream, batch_size):
+    """Translate the state of a stream of epochs, see data_loader.samplers.StreamingBatchSampler, into the state
+    of its epoch sampler, so that a checkpoint saved with --streaming resumes without it.
+        @:param stream (dict): the 'stream' entry of the state of the stream
+        @:param batch_size (int): batch size of the stream, when its epoch sampler is a sampler of examples
+    """
+    state = dict(stream['sampler'])
+    if 'batches' in state:
+        # batch sampler, see data_loader.samplers.EpochBatchSampler
+        state['batches'] = state['batches'][stream['skip']:]
+        return {'batch_sampler': state}
+    state['position'] += stream['skip'] * stream.get('batch_size', batch_size)
+    return {'sampler': state}
+
+
+class ResumableRandomSampler(Sampler):
+    """Sampler of a subset of indices, shuffled every epoch with its own random stream.
+    Its state (order of the current epoch, position and random state) can be saved with <state_dict>
+    and restored with <load_state_dict>, the next iteration then resumes the epoch at that position.
+    """
+    state_keys = ('order', 'position', 'rng')
+
+    def __init__(self, indices, shuffle=True, seed=None):
+        """
+            @:param indices (array like): indices to sample from
+            @:param shuffle (bool): shuffle the indices every epoch, keep their order otherwise
+            @:param seed (int): seed of the random stream
+        """
+        self.indices = np.asarray(indices)
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        # order of the current epoch and number of its samples skipped when resuming
+        self.order = None
+        self.start = 0
+        self._resume = False
+
+    def __iter__(self):
+        if not self._resume:
+            self.order = self.rng.permutation(self.indices) if self.shuffle else self.indices
+            self.start = 0
+        self._resume = False
+        return iter(self.order[self.start:].tolist())
+
+    def __len__(self):
+        return len(self.indices) - self.start
+
+    def state_dict(self, position):
+        """State of the current epoch, <position> samples of which have been consumed."""
+        return {'order': self.order, 'position': self.start + position, 'rng': self.rng.get_state()}
+
+    def load_state_dict(self, state):
+        self.order = state['order']
+        self.start = state['position']
+        self.rng.set_state(state['rng'])
+        self._resume = True
+
+
+class ResumableLoaderMixin(object):
+    """Checkpointing of the sampling state of a DataLoader, see ResumableRandomSampler."""
+    def state_dict(self, batches_done):
+        """Sampling state of the current epoch, <batches_done> batches of which have been consumed;
+        None if the sampler cannot be resumed."""
+        if hasattr(self.batch_sampler, 'state_dict'):
+            return {'batch_sampler': self.batch_sampler.state_dict(batches_done)}
+        if hasattr(self.sampler, 'state_dict'):
+            return {'sampler': self.sampler.state_dict(batches_done * self.batch_size)}
+        return None
+
+    def load_state_dict(self, state):
+        """Restore a state of <state_dict>, the next iteration resumes at the next unseen batch.
+        The state of a stream of epochs (--streaming) is translated into the state of its epoch."""
+        if 'stream' in state.get('batch_sampler', {}) and 'stream' not in getattr(self.batch_sampler, 'state_keys', ()):
+            state = epoch_state(state['batch_sampler']['stream'], self.batch_size)
+        if 'batch_sampler' in state:
+            load_sampler_state(self.batch_sampler, state['batch_sampler'], 'batch sampler')
+        else:
+            load_sampler_state(self.sampler, state['sampler'])
+
+
+class BaseDataLoader(ResumableLoaderMixin, DataLoader):
     """
     Base class for all data loaders
     """
-    def __init__(self, dataset, batch_size, shuffle, validation_split, num_workers, collate_fn=default_collate):
+    def __init__(self, dataset, batch_size, shuffle, validation_split, num_workers, collate_fn=default_collate,
+                 worker_init_fn=None, batch_sampler_fn=None, pin_memory=False, prefetch_factor=2):
+        """
+        batch_sampler_fn, if given, is called with the indices of the training samples and
+        returns the batch sampler to use instead of sampling fixed size batches.
+        pin_memory and prefetch_factor are passed to the DataLoader, see <worker_kwargs>.
+        """
         self.validation_split = validation_split
         self.shuffle = shuffle
         
@@ -22,13 +142,23 @@ class BaseDataLoader(DataLoader):
             'batch_size': batch_size,
             'shuffle': self.shuffle,
             'collate_fn': collate_fn,
-            'num_workers': num_workers
+            'worker_init_fn': worker_init_fn
             }
-        super(BaseDataLoader, self).__init__(sampler=self.sampler, **self.init_kwargs)
+        self.init_kwargs.update(worker_kwargs(num_workers, pin_memory, prefetch_factor))
+        if batch_sampler_fn is None:
+            super(BaseDataLoader, self).__init__(sampler=self.sampler, **self.init_kwargs)
+        else:
+            train_idx = self.sampler.indices if self.sampler is not None else np.arange(self.n_samples)
+            batch_kwargs = {k: v for k, v in self.init_kwargs.items() if k not in ('batch_size', 'shuffle')}
+            super(BaseDataLoader, self).__init__(batch_sampler=batch_sampler_fn(train_idx), **batch_kwargs)
 
     def _split_sampler(self, split):
         if split == 0.0:
-            return None, None
+            if not self.shuffle:
+                return None, None
+            # turn off shuffle option which is mutually exclusive with sampler
+            self.shuffle = False
+            return ResumableRandomSampler(np.arange(self.n_samples)), None
 
         idx_full = np.arange(self.n_samples)
 
@@ -40,7 +170,7 @@ class BaseDataLoader(DataLoader):
         valid_idx = idx_full[0:len_valid]
         train_idx = np.delete(idx_full, np.arange(0, len_valid))
         
-        train_sampler = SubsetRandomSampler(train_idx)
+        train_sampler = ResumableRandomSampler(train_idx)
         valid_sampler = SubsetRandomSampler(valid_idx)
         
         # turn off shuffle option which is mutually exclusive with sampler
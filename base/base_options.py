@@ -1,4 +1,5 @@
 import argparse
+import json
 import os
 from utils import util
 import torch
@@ -19,6 +20,7 @@ class BaseOptions():
     def initialize(self, parser):
         """Define the common options that are used in both training and test."""
         # basic parameters
+        parser.add_argument('--options_file', type=str, default='', help='json file of option values used as defaults, the command line overrides them, see autotune.py')
         parser.add_argument('--dataroot', default='data/', help='path to images')
         parser.add_argument('--exp_name', type=str, default='CycleGAN', help='name of the experiment. It decides where to store samples and models')
         parser.add_argument('--checkpoints_dir', type=str, default='./saved', help='models are saved here')
@@ -54,6 +56,25 @@ class BaseOptions():
         parser.add_argument('--num_workers', default=0, type=int, help='# threads for loading data')
         parser.add_argument('--batch_size', type=int, default=8, help='input batch size')
         parser.add_argument('--validation_split', type=float, default=0.02, help='validation split of COCO')
+        parser.add_argument('--bucket_by_length', action='store_true', help='batch captions of similar lengths together to reduce padding')
+        parser.add_argument('--max_tokens', type=int, default=0, help='with --bucket_by_length, size batches by this padded token budget instead of batch_size (0 to disable)')
+        parser.add_argument('--prefetch_batches', type=int, default=2, help='# batches loaded and copied to the device ahead of the training step, 0 to disable')
+        parser.add_argument('--prefetch_factor', type=int, default=2, help='# batches loaded in advance by every data loading worker (torch >= 1.7)')
+        parser.add_argument('--pin_memory', action='store_true', help='copy the batches to page-locked memory in the data loader')
+        parser.add_argument('--num_threads', type=int, default=0, help='# torch threads of the training process, 0 for the torch default')
+        parser.add_argument('--h5_cache_mb', type=int, default=32, help='hdf5 chunk cache size (MB) of every data loading process')
+        parser.add_argument('--shm_cache_mb', type=int, default=0, help='birds / flowers: shared memory (MB) of the decoded images kept for all the data loading processes, 0 to decode them every time')
+        parser.add_argument('--use_image_pyramid', action='store_true', help='load birds / flowers images from the pyramid built by data_loader/image_pyramid.py')
+        parser.add_argument('--columnar_h5', action='store_true', help='read birds / flowers from the columnar file built by python -m data_loader.columnar_h5')
+        parser.add_argument('--batch_pyramid', action='store_true', help='load only the largest image size as uint8, the smaller sizes, flips and normalization are computed per batch by the trainer')
+        parser.add_argument('--uint8_images', action='store_true', help='load every image size as uint8, the flips and normalization are computed per batch by the trainer')
+        parser.add_argument('--no_flip', action='store_true', help='do not flip the images')
+        parser.add_argument('--full_decode', action='store_true', help='decode the JPEG images at full resolution instead of close to the largest image size')
+        parser.add_argument('--coco_shards', action='store_true', help='stream COCO from the tar shards built by python -m data_loader.coco_shards')
+        parser.add_argument('--shuffle_buffer', type=int, default=2000, help='with --coco_shards, # captions shuffled together')
+        parser.add_argument('--group_by_image', action='store_true', help='load all the captions of a COCO image from one decode of the image, spread over consecutive batches')
+        parser.add_argument('--damsm_text_cache', action='store_true', help='encode the captions once with the frozen DAMSM text encoder and load the embeddings with the batches')
+        parser.add_argument('--damsm_image_cache', action='store_true', help='encode the real images once with the frozen DAMSM image encoder and load the features with the batches, implies --no_flip')
 
         # additional parameters
         parser.add_argument('--epoch', type=str, default='latest', help='which epoch to load? set to latest to use latest cached model')
@@ -82,6 +103,10 @@ class BaseOptions():
         parser = model_option_setter(parser, self.isTrain)
         opt, _ = parser.parse_known_args()  # parse again with new defaults
 
+        # option values of the options file replace the defaults
+        if opt.options_file:
+            parser.set_defaults(**self.load_options_file(parser, opt.options_file))
+
         # # modify dataset-related parser options
         # dataset_name = opt.dataset_name
         # dataset_option_setter = data_loader.get_option_setter(dataset_name)
@@ -91,6 +116,33 @@ class BaseOptions():
         self.parser = parser
         return parser.parse_args()
 
+    @staticmethod
+    def load_options_file(parser, options_file):
+        """Return the option values of a json options file, checking that they are options of <parser>."""
+        with open(options_file, 'r') as f:
+            values = json.load(f)
+        known = set(action.dest for action in parser._actions)
+        unknown = sorted(set(values) - known)
+        if unknown:
+            raise ValueError("unknown options in {}: {}".format(options_file, ', '.join(unknown)))
+        return values
+
+    @staticmethod
+    def save_options_file(options_file, values):
+        """Write option values into a json options file, keeping its other values."""
+        options = {}
+        if os.path.exists(options_file):
+            with open(options_file, 'r') as f:
+                options = json.load(f)
+        options.update(values)
+        directory = os.path.dirname(os.path.abspath(options_file))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_file = options_file + '.tmp.{}'.format(os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(options, f, indent=4, sort_keys=True)
+        os.replace(tmp_file, options_file)
+
     def print_options(self, opt):
         """Print and save options
         It will print both current options and default values(if different).
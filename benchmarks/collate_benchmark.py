@@ -0,0 +1,100 @@
+"""Time text_image_collate_fn against the previous list based collate, in process and through DataLoader workers.
+    python -m benchmarks.collate_benchmark --batch_size 16 --num_workers 4
+"""
+import time
+import argparse
+import torch
+import numpy as np
+from torch.utils.data import Dataset, DataLoader
+from data_loader.data_loaders import text_image_collate_fn
+from data_loader.image_pyramid import PYRAMID_SIZES
+
+
+class SyntheticTextImageDataset(Dataset):
+    """Samples shaped like the ones of TextImageDataset, generated once and served from memory."""
+    def __init__(self, n_samples=256, embed_dim=1024, seed=0):
+        rng = np.random.RandomState(seed)
+        self.samples = []
+        for index in range(n_samples):
+            sample = {'right_img_id': str(index), 'right_class_id': index % 200}
+            for side in ('right', 'wrong'):
+                for size in PYRAMID_SIZES:
+                    sample['{}_image_{}'.format(side, size)] = torch.rand(3, size, size) * 2 - 1
+                sample[side + '_embed'] = torch.rand(embed_dim)
+                sample[side + '_caption'] = torch.from_numpy(rng.randint(4, 5000, rng.randint(8, 30)).astype(np.int64))
+                sample[side + '_txt'] = 'a bird with a short beak'
+            self.samples.append(sample)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        return self.samples[index]
+
+
+def reference_collate_fn(data):
+    """The list based collate replaced by the preallocated one, kept for comparison."""
+    collate_data = {}
+    data.sort(key=lambda x: x['right_caption'].size(0), reverse=True)
+    collate_data['class_id'] = np.stack([sample['right_img_id'] for sample in data])
+    for side in ('right', 'wrong'):
+        collate_data[side + '_txt'] = [sample[side + '_txt'] for sample in data]
+        captions = [sample[side + '_caption'] for sample in data]
+        if side == 'wrong':
+            captions.sort(key=lambda x: len(x), reverse=True)
+        caption_lengths = [len(cap) for cap in captions]
+        collate_data[side + '_caption_lengths'] = torch.LongTensor(caption_lengths)
+        collate_data[side + '_captions'] = torch.zeros(len(caption_lengths), max(caption_lengths)).long()
+        for i, cap in enumerate(captions):
+            collate_data[side + '_captions'][i, :caption_lengths[i]] = cap[:caption_lengths[i]]
+        collate_data[side + '_embeds'] = torch.stack([sample[side + '_embed'] for sample in data], 0)
+        for size in PYRAMID_SIZES:
+            images = [sample['{}_image_{}'.format(side, size)] for sample in data]
+            collate_data['{}_images_{}'.format(side, size)] = torch.stack(images, 0)
+    return collate_data
+
+
+def time_in_process(dataset, collate_fn, batch_size, n_batches):
+    start = time.time()
+    for i in range(n_batches):
+        indices = np.random.randint(0, len(dataset), batch_size)
+        collate_fn([dataset[index] for index in indices])
+    return (time.time() - start) / n_batches
+
+
+def time_through_workers(dataset, collate_fn, batch_size, num_workers, n_batches):
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                             collate_fn=collate_fn, drop_last=True)
+    n, start = 0, None
+    while n < n_batches:
+        for batch in data_loader:
+            # the first batch includes the start of the workers
+            if start is None:
+                start = time.time()
+                continue
+            n += 1
+            if n == n_batches:
+                break
+    return (time.time() - start) / n_batches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the collate function of the text image data loaders')
+    parser.add_argument('--batch_size', type=int, default=16, help='input batch size')
+    parser.add_argument('--num_workers', type=int, default=2, help='# DataLoader workers')
+    parser.add_argument('--n_batches', type=int, default=50, help='# timed batches')
+    args = parser.parse_args()
+
+    dataset = SyntheticTextImageDataset(n_samples=4 * args.batch_size)
+    # both collates must produce the same batch
+    batch = [dataset[index] for index in range(args.batch_size)]
+    expected, result = reference_collate_fn(list(batch)), text_image_collate_fn(list(batch))
+    for key, value in expected.items():
+        if torch.is_tensor(value):
+            assert torch.equal(value, result[key]), key
+
+    for name, collate_fn in (('reference', reference_collate_fn), ('preallocated', text_image_collate_fn)):
+        t_collate = time_in_process(dataset, collate_fn, args.batch_size, args.n_batches)
+        t_loader = time_through_workers(dataset, collate_fn, args.batch_size, args.num_workers, args.n_batches)
+        print('{:>12} collate: {:.2f} ms/batch, {} workers: {:.2f} ms/batch'.format(
+            name, 1000 * t_collate, args.num_workers, 1000 * t_loader))
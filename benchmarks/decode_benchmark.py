@@ -0,0 +1,83 @@
+"""Time the scaled JPEG decode of data_loader.image_decode against the full resolution decode, and measure
+how far the resized images of both paths are from each other and from an antialiased resize of the full image.
+    python -m benchmarks.decode_benchmark --data_dir data/ --datasets birds coco --sizes 64 128 256
+"""
+import os
+import time
+import argparse
+import h5py
+import numpy as np
+from PIL import Image
+from data_loader.crop_boxes import crop_boxes_file
+from data_loader.image_decode import decode_image, DRAFT_MIN_RATIO
+
+
+def load_sources(data_dir, dataset_name, which_set, max_images):
+    """Encoded images of a split with their crop boxes (None when the images are not cropped)."""
+    if dataset_name == 'coco':
+        image_dir = os.path.join(data_dir, 'coco/images', which_set)
+        sources = []
+        for file_name in sorted(os.listdir(image_dir))[:max_images]:
+            with open(os.path.join(image_dir, file_name), 'rb') as f:
+                sources.append(f.read())
+        return sources, [None] * len(sources)
+
+    with h5py.File(os.path.join(data_dir, '{}/{}.hdf5'.format(dataset_name, dataset_name)), mode='r') as h5_file:
+        data = h5_file[which_set]
+        sources = [bytes(np.array(data[key]['img'])) for key in list(data.keys())[:max_images]]
+    crop_boxes = [None] * len(sources)
+    path = crop_boxes_file(data_dir, dataset_name, which_set)
+    if dataset_name == 'birds' and os.path.exists(path):
+        crop_boxes = [box.tolist() for box in np.load(path)[:len(sources)]]
+    elif dataset_name == 'birds':
+        print("    {} not found, the birds images are not cropped".format(path))
+    return sources, crop_boxes
+
+
+def decode_and_resize(sources, crop_boxes, size, scaled, min_ratio, resample=None):
+    images = []
+    for source, crop_box in zip(sources, crop_boxes):
+        image = decode_image(source, size if scaled else None, crop_box, min_ratio=min_ratio)
+        image = image.resize((size, size)) if resample is None else image.resize((size, size), resample)
+        images.append(np.asarray(image, dtype=np.float64))
+    return images
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+
+def mean_abs_error(images, reference):
+    return float(np.mean([np.abs(image - ref).mean() for image, ref in zip(images, reference)]))
+
+
+def psnr(images, reference):
+    mse = np.mean([((image - ref) ** 2).mean() for image, ref in zip(images, reference)])
+    return 10 * np.log10(255.0 ** 2 / max(mse, 1e-12))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the scaled JPEG decode with the full resolution decode')
+    parser.add_argument('--data_dir', type=str, default='data/', help='main directory of datasets')
+    parser.add_argument('--datasets', type=str, nargs='+', default=['birds', 'coco'], help='birds, flowers or coco')
+    parser.add_argument('--which_set', type=str, default='train', help='split of the images')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256], help='largest image sizes to load')
+    parser.add_argument('--max_images', type=int, default=500, help='# images decoded per dataset')
+    parser.add_argument('--min_ratio', type=float, default=DRAFT_MIN_RATIO,
+                        help='smallest ratio between a decoded side and the image size')
+    args = parser.parse_args()
+
+    for dataset_name in args.datasets:
+        sources, crop_boxes = load_sources(args.data_dir, dataset_name, args.which_set, args.max_images)
+        print("{}: {} images".format(dataset_name, len(sources)))
+        for size in args.sizes:
+            full, full_time = timed(decode_and_resize, sources, crop_boxes, size, False, args.min_ratio)
+            scaled, scaled_time = timed(decode_and_resize, sources, crop_boxes, size, True, args.min_ratio)
+            # antialiased resize of the full resolution image, the best either path can do
+            best = decode_and_resize(sources, crop_boxes, size, False, args.min_ratio, resample=Image.LANCZOS)
+            print("    {:>3}px: full {:.0f} images/s, scaled {:.0f} images/s ({:.1f}x) | scaled vs full: "
+                  "mean abs error {:.2f}, PSNR {:.1f} dB | vs antialiased: full {:.1f} dB, scaled {:.1f} dB".format(
+                      size, len(sources) / full_time, len(sources) / scaled_time, full_time / max(scaled_time, 1e-12),
+                      mean_abs_error(scaled, full), psnr(scaled, full), psnr(full, best), psnr(scaled, best)))
@@ -0,0 +1,73 @@
+"""Time the data loaders with the images shipped from the workers as normalized float32 tensors, as uint8 tensors
+of every size (--uint8_images) and as uint8 tensors of the largest size (--batch_pyramid), the uint8 batches being
+normalized by the consumer.
+    python -m benchmarks.loader_benchmark --data_dir data/ --dataset_name birds --batch_size 64 --num_workers 8
+"""
+import time
+import argparse
+import torch
+from data_loader.data_loaders import TextImageDataLoader, COCOTextImageDataLoader
+from data_loader.batch_transforms import expand_image_pyramid
+from data_loader.image_pyramid import PYRAMID_SIZES
+
+MODES = ('float32', 'uint8_images', 'batch_pyramid')
+
+
+def make_loader(args, mode):
+    fields = ['right_captions', 'right_caption_lengths'] + \
+             ['{}_images_{}'.format(side, size) for side in ('right', 'wrong') for size in PYRAMID_SIZES]
+    kwargs = dict(fields=fields, uint8_images=mode == 'uint8_images', batch_pyramid=mode == 'batch_pyramid')
+    if args.dataset_name == 'coco':
+        return COCOTextImageDataLoader(args.data_dir + '/coco/', 'train', args.image_size, args.batch_size, 0.0,
+                                       args.num_workers, **kwargs)
+    return TextImageDataLoader(args.data_dir, args.dataset_name, 'train', args.image_size, args.batch_size,
+                               args.num_workers, **kwargs)
+
+
+def image_bytes(batch):
+    return sum(value.numel() * value.element_size() for key, value in batch.items()
+               if '_images_' in key and torch.is_tensor(value))
+
+
+def time_loader(data_loader, n_batches, device):
+    """Return the batches per second and the image bytes per batch sent by the workers, after a warm up batch."""
+    n_loaded = 0
+    transported = 0
+    start = None
+    for batch in data_loader:
+        transported = image_bytes(batch)
+        for key, value in batch.items():
+            if '_images_' in key and value.dtype == torch.float32:
+                batch[key] = value.to(device)
+        expand_image_pyramid(batch, device=device)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if start is None:
+            start = time.time()
+            continue
+        n_loaded += 1
+        if n_loaded == n_batches:
+            break
+    return n_loaded / max(time.time() - start, 1e-12), transported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the float32 and uint8 image transports of the data loaders')
+    parser.add_argument('--data_dir', type=str, default='data/', help='main directory of datasets')
+    parser.add_argument('--dataset_name', type=str, default='birds', help='birds, flowers or coco')
+    parser.add_argument('--image_size', type=int, default=256, help='largest image size')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--n_batches', type=int, default=50, help='# batches timed per mode')
+    parser.add_argument('--modes', type=str, nargs='+', default=list(MODES), choices=MODES)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='where the uint8 batches are normalized')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    reference = None
+    for mode in args.modes:
+        batches_per_second, transported = time_loader(make_loader(args, mode), args.n_batches, device)
+        reference = reference or batches_per_second
+        print("{:>13}: {:.2f} batches/s ({:.2f}x), {:.1f} MB of images per batch from the workers".format(
+            mode, batches_per_second, batches_per_second / reference, transported / 1024 ** 2))
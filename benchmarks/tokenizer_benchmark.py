@@ -0,0 +1,73 @@
+"""Check that utils.tokenizer gives the tokens of the NLTK path on the caption sets, and time both.
+    python -m benchmarks.tokenizer_benchmark --data_dir data/ --datasets birds flowers coco
+"""
+import os
+import json
+import time
+import string
+import argparse
+import h5py
+import nltk
+import numpy as np
+from utils.tokenizer import tokenize, CaptionTokenizer
+
+
+def nltk_tokenize(caption):
+    """The previous path: text_clean building its translation table on every call, then word_tokenize."""
+    translator = str.maketrans('', '', string.punctuation)
+    return nltk.tokenize.word_tokenize(str(caption).translate(translator).lower())
+
+
+def load_captions(data_dir, dataset_name, which_set):
+    if dataset_name == 'coco':
+        with open(os.path.join(data_dir, 'coco/annotations/captions_{}2017.json'.format(which_set)), 'r') as f:
+            return [annotation['caption'] for annotation in json.load(f)['annotations']]
+    with h5py.File(os.path.join(data_dir, '{}/{}.hdf5'.format(dataset_name, dataset_name)), mode='r') as h5_file:
+        data = h5_file[which_set]
+        return [str(np.array(data[key]['txt'])) for key in data.keys()]
+
+
+def check_and_time(captions, max_mismatches=10):
+    start = time.time()
+    reference = [nltk_tokenize(caption) for caption in captions]
+    nltk_time = time.time() - start
+
+    start = time.time()
+    tokens = [tokenize(caption) for caption in captions]
+    fast_time = time.time() - start
+
+    mismatches = [i for i in range(len(captions)) if tokens[i] != reference[i]]
+    for i in mismatches[:max_mismatches]:
+        print("    mismatch {!r}: {} != {}".format(captions[i], tokens[i], reference[i]))
+
+    # encode_batch against encoding the reference tokens one caption at a time
+    word2idx = {}
+    for caption_tokens in reference:
+        for token in caption_tokens:
+            word2idx.setdefault(token, len(word2idx) + 1)
+    start = time.time()
+    flat_ids, offsets = CaptionTokenizer(word2idx, 0).encode_batch(captions)
+    encode_time = time.time() - start
+    expected = [word2idx[token] for caption_tokens in reference for token in caption_tokens]
+    assert np.array_equal(flat_ids, expected)
+    assert np.array_equal(np.diff(offsets), [len(caption_tokens) for caption_tokens in reference])
+    return len(mismatches), nltk_time, fast_time, encode_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare utils.tokenizer with the NLTK tokenization of the captions')
+    parser.add_argument('--data_dir', type=str, default='data/', help='main directory of datasets')
+    parser.add_argument('--datasets', type=str, nargs='+', default=['birds', 'flowers', 'coco'], help='caption sets')
+    parser.add_argument('--which_set', type=str, default='train', help='split of the captions')
+    parser.add_argument('--max_captions', type=int, default=None, help='only use the first captions of every set')
+    args = parser.parse_args()
+
+    total_mismatches = 0
+    for dataset_name in args.datasets:
+        captions = load_captions(args.data_dir, dataset_name, args.which_set)[:args.max_captions]
+        n_mismatches, nltk_time, fast_time, encode_time = check_and_time(captions)
+        total_mismatches += n_mismatches
+        print("{}: {} captions, {} mismatches, nltk {:.2f} s, tokenizer {:.2f} s ({:.1f}x), encode_batch {:.2f} s".format(
+            dataset_name, len(captions), n_mismatches, nltk_time, fast_time, nltk_time / max(fast_time, 1e-12), encode_time))
+    if total_mismatches:
+        raise SystemExit("{} captions are tokenized differently".format(total_mismatches))
@@ -0,0 +1,37 @@
+import torch
+import torch.nn.functional as F
+from data_loader.image_pyramid import PYRAMID_SIZES
+
+
+def expand_image_pyramid(data, fields=None, flip=True, device=None):
+    """Build the image pyramid of a batch whose images were shipped as uint8, see the <batch_pyramid> and
+    <uint8_images> arguments of the datasets: the largest size, or every size, of the right and wrong images
+    is loaded as (batch, 3, size, size) uint8 tensors.
+    On <device>, the images of the whole batch are randomly flipped, scaled to [-1.0, 1.0] like
+    transforms.ToTensor followed by transforms.Normalize with mean and std 0.5, and the smaller sizes that
+    were not loaded are downsampled from the largest one. The same flip is used for every size of an image.
+        @:param data (dict): batch of text_image_collate_fn, updated in place
+        @:param fields (list): batch fields to build, all the smaller sizes if None
+        @:param flip (bool): randomly flip the images horizontally
+        @:param device (torch.device): where to build the pyramid, where the images already are if None
+    """
+    for side in ('right', 'wrong'):
+        keys = ['{}_images_{}'.format(side, size) for size in PYRAMID_SIZES]
+        keys = [key for key in keys if key in data and data[key].dtype == torch.uint8]
+        if not keys:
+            continue
+        flipped = None
+        for key in reversed(keys):
+            images = data[key].to(device if device is not None else data[key].device, non_blocking=True).float()
+            if flip:
+                if flipped is None:
+                    flipped = torch.rand(images.size(0), device=images.device) < 0.5
+                images[flipped] = images[flipped].flip(3)
+            data[key] = images.div_(127.5).sub_(1.0)
+
+        largest_size = int(keys[-1].rsplit('_', 1)[1])
+        for smaller_size in PYRAMID_SIZES:
+            smaller_key = '{}_images_{}'.format(side, smaller_size)
+            if smaller_size < largest_size and smaller_key not in data and (fields is None or smaller_key in fields):
+                data[smaller_key] = F.interpolate(data[keys[-1]], size=(smaller_size, smaller_size), mode='area')
+    return data
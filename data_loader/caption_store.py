@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+import numpy as np
+from multiprocessing import Pool
+from utils.tokenizer import CaptionTokenizer
+
+
+def vocab_fingerprint(vocab):
+    """Return a short hash identifying the word -> id mapping of a vocabulary."""
+    items = sorted(vocab.word2idx.items(), key=lambda item: item[1])
+    return hashlib.sha1(json.dumps(items).encode('utf-8')).hexdigest()[:16]
+
+
+# tokenizer of the vocabulary, set once per pool worker by <_init_encoder>
+_tokenizer = None
+
+
+def _init_encoder(word2idx, unk_idx):
+    global _tokenizer
+    _tokenizer = CaptionTokenizer(word2idx, unk_idx)
+
+
+def _encode_chunk(captions):
+    return _tokenizer.encode_batch(captions)
+
+
+class CaptionStore(object):
+    """Build-once, memory-mapped store of tokenized captions.
+    All the token ids of a split are kept in one flat int32 array, caption i being
+    ids[offsets[i]:offsets[i + 1]] (without the start and end words).
+    The files are keyed by split and vocabulary, so a new vocabulary never reads stale ids.
+    """
+    def __init__(self, store_dir, which_set, vocab):
+        """
+            @:param store_dir (string): directory holding the store files of a dataset
+            @:param which_set (string): split name, part of the store key
+            @:param vocab (Vocabulary): vocabulary used to encode the captions
+        """
+        self.store_dir = store_dir
+        self.which_set = which_set
+        self.start_idx = vocab(vocab.start_word)
+        self.end_idx = vocab(vocab.end_word)
+        self.unk_idx = vocab(vocab.unk_word)
+        self.word2idx = vocab.word2idx
+
+        # split and vocabulary, also the key of the stores derived from the captions
+        self.key = '{}_{}'.format(which_set, vocab_fingerprint(vocab))
+        prefix = os.path.join(store_dir, self.key)
+        self.ids_file = prefix + '.ids.npy'
+        self.offsets_file = prefix + '.offsets.npy'
+        self.ids = None
+        self.offsets = None
+
+    def exists(self):
+        return os.path.exists(self.ids_file) and os.path.exists(self.offsets_file)
+
+    def build(self, captions, num_workers=None, chunksize=512):
+        """Tokenize and encode all the captions with a pool of processes and write the store files."""
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+        print("Building caption store for {} captions...".format(len(captions)))
+        chunks = [captions[start:start + chunksize] for start in range(0, len(captions), chunksize)]
+        pool = Pool(num_workers, initializer=_init_encoder, initargs=(self.word2idx, self.unk_idx))
+        try:
+            encoded = pool.map(_encode_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+        offsets = np.zeros(len(captions) + 1, dtype=np.int64)
+        ids = np.zeros(0, dtype=np.int32)
+        if encoded:
+            ids = np.concatenate([chunk_ids for chunk_ids, _ in encoded])
+            offsets[1:] = np.cumsum(np.concatenate([np.diff(chunk_offsets) for _, chunk_offsets in encoded]))
+
+        # write to temporary files first so that concurrent readers never see a partial store
+        for path, array in ((self.ids_file, ids), (self.offsets_file, offsets)):
+            tmp_path = path + '.tmp.{}.npy'.format(os.getpid())
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+
+    def load(self):
+        self.ids = np.load(self.ids_file, mmap_mode='r')
+        self.offsets = np.load(self.offsets_file)
+        return self
+
+    def build_or_load(self, get_captions, num_workers=None):
+        """Load the store, building it first with the captions returned by <get_captions> if needed."""
+        if not self.exists():
+            self.build(get_captions(), num_workers=num_workers)
+        return self.load()
+
+    @property
+    def lengths(self):
+        """Number of tokens of every caption, without the start and end words."""
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def get_caption(self, index):
+        """Return caption <index> as a LongTensor-ready int64 array wrapped with the start and end words."""
+        ids = self[index]
+        caption = np.empty(len(ids) + 2, dtype=np.int64)
+        caption[0] = self.start_idx
+        caption[1:-1] = ids
+        caption[-1] = self.end_idx
+        return caption
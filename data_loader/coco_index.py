@@ -0,0 +1,101 @@
+import os
+import json
+import numpy as np
+
+
+def coco_index_file(annotations_file):
+    return os.path.splitext(annotations_file)[0] + '.index.npz'
+
+
+class COCOIndex(object):
+    """Compact numpy tables of a COCO captions annotation file, replacing the pycocotools COCO object.
+    Annotations keep the order of the json file (the order of COCO.anns); images are numbered by order
+    of first appearance among the annotations, so that the class of annotation i is image_rows[i] + 1.
+        ann_ids (int64):         id of every annotation
+        image_rows (int32):      row of the image of every annotation in the image tables
+        image_ids (int64):       id of every image
+        file_names (str):        file name of every image
+        caption_bytes (uint8):   utf-8 encoded captions, caption i is caption_bytes[caption_offsets[i]:caption_offsets[i + 1]]
+        caption_offsets (int64): start of every caption in caption_bytes, plus the total length
+    The tables are compiled once and saved next to the json file, see <coco_index_file>.
+    """
+    tables = ('ann_ids', 'image_rows', 'image_ids', 'file_names', 'caption_bytes', 'caption_offsets')
+
+    def __init__(self, annotations_file):
+        """
+            @:param annotations_file (string): path of the captions_*.json annotation file
+        """
+        self.annotations_file = annotations_file
+        self.index_file = coco_index_file(annotations_file)
+        for name in self.tables:
+            setattr(self, name, None)
+
+    def exists(self):
+        # compiled tables older than the json file are out of date
+        return os.path.exists(self.index_file) and \
+            os.path.getmtime(self.index_file) >= os.path.getmtime(self.annotations_file)
+
+    def build(self):
+        print("Compiling the annotation tables of {}...".format(self.annotations_file))
+        with open(self.annotations_file, 'r') as f:
+            dataset = json.load(f)
+
+        image_rows = {}
+        for ann in dataset['annotations']:
+            if ann['image_id'] not in image_rows:
+                image_rows[ann['image_id']] = len(image_rows)
+        # images without any caption come last
+        for img in dataset['images']:
+            if img['id'] not in image_rows:
+                image_rows[img['id']] = len(image_rows)
+
+        file_names = [None] * len(image_rows)
+        for img in dataset['images']:
+            file_names[image_rows[img['id']]] = img['file_name']
+        image_ids = [None] * len(image_rows)
+        for img_id, row in image_rows.items():
+            image_ids[row] = img_id
+
+        captions = [str(ann['caption']).encode('utf-8') for ann in dataset['annotations']]
+        caption_offsets = np.zeros(len(captions) + 1, dtype=np.int64)
+        np.cumsum([len(caption) for caption in captions], out=caption_offsets[1:])
+
+        self.ann_ids = np.array([ann['id'] for ann in dataset['annotations']], dtype=np.int64)
+        self.image_rows = np.array([image_rows[ann['image_id']] for ann in dataset['annotations']], dtype=np.int32)
+        self.image_ids = np.array(image_ids, dtype=np.int64)
+        self.file_names = np.array(file_names, dtype=np.str_)
+        self.caption_bytes = np.frombuffer(b''.join(captions), dtype=np.uint8)
+        self.caption_offsets = caption_offsets
+
+        # written to a temporary file first so that concurrent readers never see a partial index
+        tmp_file = self.index_file[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_file, **{name: getattr(self, name) for name in self.tables})
+        os.replace(tmp_file, self.index_file)
+        return self
+
+    def load(self):
+        with np.load(self.index_file) as tables:
+            for name in self.tables:
+                setattr(self, name, tables[name])
+        return self
+
+    def build_or_load(self):
+        if self.exists():
+            return self.load()
+        return self.build()
+
+    def __len__(self):
+        return len(self.ann_ids)
+
+    def caption(self, index):
+        """Caption text of annotation <index>."""
+        start, end = self.caption_offsets[index], self.caption_offsets[index + 1]
+        return self.caption_bytes[start:end].tobytes().decode('utf-8')
+
+    def image_id(self, index):
+        """Image id of annotation <index>."""
+        return self.image_ids[self.image_rows[index]]
+
+    def file_name(self, index):
+        """Image file name of annotation <index>."""
+        return str(self.file_names[self.image_rows[index]])
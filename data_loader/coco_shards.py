@@ -0,0 +1,291 @@
+import os
+import io
+import json
+import tarfile
+import argparse
+import torch
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+from utils.data_processing import COCOVocabulary, text_clean
+from data_loader.caption_store import CaptionStore, vocab_fingerprint
+from data_loader.coco_index import COCOIndex
+from data_loader.image_decode import decode_image
+from data_loader.datasets_custom import FieldSelectionMixin, dirname, uint8_tensor
+
+try:
+    from torch.utils.data import IterableDataset
+except ImportError:
+    # torch < 1.2
+    IterableDataset = object
+
+
+def shard_dir(data_dir, which_set):
+    return os.path.join(data_dir, 'shards', which_set)
+
+
+def shard_rank():
+    """Rank and world size of the current process when training with torch.distributed."""
+    if hasattr(torch.distributed, 'is_initialized') and torch.distributed.is_available() \
+            and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+# per worker state of the shard writer, set by <_init_writer>
+_writer = {}
+
+
+def _init_writer(data_dir, which_set, out_dir, image_size):
+    _writer['image_dir'] = os.path.join(data_dir, 'images', which_set)
+    _writer['out_dir'] = out_dir
+    _writer['image_size'] = image_size
+
+
+def _write_shard(shard):
+    """Write the records of one shard, one record per image holding all of its captions."""
+    shard_id, records = shard
+    file_name = 'shard-{:05d}.tar'.format(shard_id)
+    tmp_path = os.path.join(_writer['out_dir'], file_name + '.tmp')
+    with tarfile.open(tmp_path, 'w') as tar:
+        for key, image_file, meta in records:
+            if _writer['image_size'] is None:
+                with open(os.path.join(_writer['image_dir'], image_file), 'rb') as f:
+                    image_bytes = f.read()
+            else:
+                image = Image.open(os.path.join(_writer['image_dir'], image_file)).convert("RGB")
+                image = image.resize((_writer['image_size'], _writer['image_size']))
+                buffer = io.BytesIO()
+                image.save(buffer, format='JPEG', quality=95)
+                image_bytes = buffer.getvalue()
+            for name, payload in ((key + '.jpg', image_bytes), (key + '.json', json.dumps(meta).encode('utf-8'))):
+                info = tarfile.TarInfo(name)
+                info.size = len(payload)
+                tar.addfile(info, io.BytesIO(payload))
+    os.replace(tmp_path, os.path.join(_writer['out_dir'], file_name))
+    return {'file': file_name, 'n_images': len(records), 'n_samples': sum(len(meta['captions']) for _, _, meta in records)}
+
+
+def write_coco_shards(data_dir, which_set, vocab, images_per_shard=1000, image_size=None, num_workers=None):
+    """Pack the images of a COCO split with their captions into sequential tar shards.
+    Every image is stored once as <key>.jpg, optionally resized to <image_size>, next to <key>.json holding
+    its image id, class id, caption texts and caption token ids (without the start and end words).
+    Images are written in random order so that consecutive records are unrelated.
+    """
+    index = COCOIndex(os.path.join(data_dir, 'annotations/captions_{}2017.json'.format(which_set))).build_or_load()
+    captions = CaptionStore(os.path.join(data_dir, 'caption_store'), which_set, vocab)
+    captions.build_or_load(lambda: [index.caption(i) for i in range(len(index))])
+
+    # annotations grouped by image row, in order of appearance
+    order = np.argsort(index.image_rows, kind='mergesort')
+    rows, starts = np.unique(index.image_rows[order], return_index=True)
+    groups = np.split(order, starts[1:])
+
+    records = []
+    for row, group in zip(rows, groups):
+        image_id = int(index.image_ids[row])
+        meta = {
+            'image_id': image_id,
+            'class_id': int(row) + 1,
+            'txt': [index.caption(i) for i in group],
+            'captions': [captions[i].tolist() for i in group],
+        }
+        records.append(('{:012d}'.format(image_id), str(index.file_names[row]), meta))
+    records = [records[i] for i in np.random.permutation(len(records))]
+    shards = [(shard_id, records[start:start + images_per_shard])
+              for shard_id, start in enumerate(range(0, len(records), images_per_shard))]
+
+    out_dir = shard_dir(data_dir, which_set)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    pool = Pool(num_workers, initializer=_init_writer, initargs=(data_dir, which_set, out_dir, image_size))
+    try:
+        shard_infos = []
+        for shard_info in pool.imap(_write_shard, shards):
+            shard_infos.append(shard_info)
+            print("[{}/{}] {} shards written".format(len(shard_infos), len(shards), which_set))
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump({'vocab': vocab_fingerprint(vocab), 'image_size': image_size, 'shards': shard_infos}, f)
+
+
+class COCOShardDataset(FieldSelectionMixin, IterableDataset):
+    """Streaming COCO dataset reading the tar shards of <write_coco_shards> sequentially.
+    The shards are split across the ranks and the DataLoader workers, and every worker shuffles its
+    shards and then its samples within a buffer of <shuffle_buffer> captions. Wrong images and captions
+    are drawn from the buffer among the samples of other images. Samples are the ones of COCOTextImageDataset.
+    """
+    def __init__(self,
+                 data_dir,
+                 which_set,
+                 transform,
+                 vocab_threshold=4,
+                 vocab_file=os.path.join(dirname, "data/coco/vocab.pkl"),
+                 start_word="<start>",
+                 end_word="<end>",
+                 unk_word="<unk>",
+                 annotations_file=os.path.join(dirname, "data/coco/annotations/captions_train2017.json"),
+                 shuffle_buffer=2000,
+                 fields=None,
+                 batch_pyramid=False,
+                 scaled_decode=True,
+                 uint8_images=False,
+                 num_workers=0
+                 ):
+        """
+            @:param data_dir (string): COCO directory, the shards being in <data_dir>/shards/<which_set>
+            @:param which_set (string): "train", "val"
+            @:param shuffle_buffer (int): number of captions shuffled together
+            @:param fields (list): batch fields to compute, see TEXT_IMAGE_FIELDS; None for all of them
+            @:param batch_pyramid (bool): only load the largest image size as uint8, the batch is transformed
+                                          by data_loader.batch_transforms.expand_image_pyramid
+            @:param scaled_decode (bool): decode the JPEG images close to the largest size they are resized to,
+                                          see data_loader.image_decode.decode_image
+            @:param uint8_images (bool): load every image size as uint8, the batch is normalized by
+                                         data_loader.batch_transforms.expand_image_pyramid
+            @:param num_workers (int): number of DataLoader workers the shards are split across, see <worker_lengths>
+        """
+        if IterableDataset is object:
+            raise ImportError("COCOShardDataset requires torch >= 1.2")
+        self.which_set = which_set
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.set_fields(fields)
+        self.batch_pyramid = batch_pyramid
+        self.scaled_decode = scaled_decode
+        self.uint8_images = uint8_images
+        self.num_workers = num_workers
+        # the images are not flipped, neither by the transform nor by expand_image_pyramid
+        self.flip = False
+        self.vocab = COCOVocabulary(vocab_threshold, vocab_file, start_word,
+                                    end_word, unk_word, annotations_file, True)
+        self.start_idx = self.vocab(self.vocab.start_word)
+        self.end_idx = self.vocab(self.vocab.end_word)
+
+        self.shard_dir = shard_dir(data_dir, which_set)
+        index_file = os.path.join(self.shard_dir, 'index.json')
+        if not os.path.exists(index_file):
+            raise ValueError("COCO shards not found, build them with python -m data_loader.coco_shards")
+        with open(index_file, 'r') as f:
+            shard_index = json.load(f)
+        assert shard_index['vocab'] == vocab_fingerprint(self.vocab), "COCO shards were built with another vocabulary"
+        self.shards = shard_index['shards']
+        self.n_samples = sum(shard['n_samples'] for shard in self.shards)
+
+    def __len__(self):
+        """Number of samples of the current rank."""
+        return sum(self.worker_lengths())
+
+    def reader_shards(self, worker_id, num_workers):
+        """Shards read by worker <worker_id> of <num_workers> of the current rank."""
+        rank, world_size = shard_rank()
+        reader = rank * num_workers + worker_id
+        return self.shards[reader::world_size * num_workers]
+
+    def worker_lengths(self):
+        """Number of samples yielded by every DataLoader worker of the current rank, one worker without workers."""
+        num_workers = max(self.num_workers, 1)
+        return [sum(shard['n_samples'] for shard in self.reader_shards(worker_id, num_workers))
+                for worker_id in range(num_workers)]
+
+    def worker_shards(self):
+        """Shards read by the current rank and worker."""
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        return self.reader_shards(worker_id, num_workers)
+
+    def read_records(self, shards):
+        """Yield the (image bytes, meta) records of <shards>, sequentially."""
+        for shard in shards:
+            with tarfile.open(os.path.join(self.shard_dir, shard['file']), 'r|') as tar:
+                image_bytes = None
+                for member in tar:
+                    payload = tar.extractfile(member).read()
+                    if member.name.endswith('.jpg'):
+                        image_bytes = payload
+                    else:
+                        yield image_bytes, json.loads(payload.decode('utf-8'))
+
+    def read_captions(self, shards):
+        """Yield one (image bytes, meta, caption number) item per caption of <shards>."""
+        for image_bytes, meta in self.read_records(shards):
+            for caption_index in range(len(meta['captions'])):
+                yield image_bytes, meta, caption_index
+
+    def __iter__(self):
+        shards = self.worker_shards()
+        shards = [shards[i] for i in np.random.permutation(len(shards))]
+
+        buffer = []
+        for item in self.read_captions(shards):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            position = np.random.randint(len(buffer))
+            right, buffer[position] = buffer[position], item
+            yield self.make_sample(right, buffer)
+        for position in np.random.permutation(len(buffer)):
+            yield self.make_sample(buffer[position], buffer)
+
+    def draw_wrong(self, right, buffer):
+        """Draw an item of <buffer> of another image than <right>."""
+        for _ in range(100):
+            wrong = buffer[np.random.randint(len(buffer))]
+            if wrong[1]['image_id'] != right[1]['image_id']:
+                return wrong
+        raise ValueError("the shuffle buffer holds a single image, increase shuffle_buffer")
+
+    def make_sample(self, right, buffer):
+        wrong_img, wrong_txt = self.draw_wrong(right, buffer), self.draw_wrong(right, buffer)
+
+        sample = {
+                'right_img_id': right[1]['image_id'],
+                'right_class_id': right[1]['class_id'],
+                 }
+
+        # Processing images
+        for side, (image_bytes, meta, caption_index) in (('right', right), ('wrong', wrong_img)):
+            sizes = self.wanted_sizes(side)
+            if not sizes:
+                continue
+            image = decode_image(image_bytes, sizes[-1] if self.scaled_decode else None)
+            if self.batch_pyramid:
+                sample['{}_image_{}'.format(side, sizes[-1])] = uint8_tensor(image.resize((sizes[-1], sizes[-1])))
+            elif self.uint8_images:
+                for size in sizes:
+                    sample['{}_image_{}'.format(side, size)] = uint8_tensor(image.resize((size, size)))
+            else:
+                for size in sizes:
+                    sample['{}_image_{}'.format(side, size)] = self.transform(image.resize((size, size)))
+
+        # Processing txt
+        for side, (image_bytes, meta, caption_index) in (('right', right), ('wrong', wrong_txt)):
+            if self.wants(side + '_txt'):
+                sample[side + '_txt'] = text_clean(meta['txt'][caption_index])
+            if self.wants(side + '_captions', side + '_caption_lengths'):
+                caption = [self.start_idx] + meta['captions'][caption_index] + [self.end_idx]
+                sample[side + '_caption'] = torch.LongTensor(caption)
+            if self.wants(side + '_embeds'):
+                # TODO use DAMSM model to get embedding
+                sample[side + '_embed'] = torch.FloatTensor([0])
+
+        return sample
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack COCO images and captions into sequential tar shards')
+    parser.add_argument('--data_dir', type=str, default='data/coco/', help='COCO directory')
+    parser.add_argument('--which_set', type=str, nargs='+', default=['train'], help='splits to process')
+    parser.add_argument('--images_per_shard', type=int, default=1000, help='# images per shard')
+    parser.add_argument('--image_size', type=int, default=None, help='resize the images to this size, keep the original files if not set')
+    parser.add_argument('--vocab_file', type=str, default=os.path.join(dirname, "data/coco/vocab.pkl"), help='COCO vocabulary')
+    parser.add_argument('--num_workers', type=int, default=None, help='# processes, default to the number of cpus')
+    args = parser.parse_args()
+
+    vocab = COCOVocabulary(4, args.vocab_file, vocab_from_file=True)
+    for which_set in args.which_set:
+        write_coco_shards(args.data_dir, which_set, vocab, images_per_shard=args.images_per_shard,
+                          image_size=args.image_size, num_workers=args.num_workers)
@@ -0,0 +1,156 @@
+import os
+import argparse
+import h5py
+import numpy as np
+from tqdm import tqdm
+from data_loader.h5_handle import LazyH5File, H5_CACHE_BYTES, H5_CACHE_SLOTS
+
+# largest gap (bytes) between the images or captions of a batch read together in one slice read
+MAX_READ_GAP = 1024 ** 2
+
+
+def columnar_file(data_dir, dataset_name):
+    return os.path.join(data_dir, dataset_name, '{}_columnar.hdf5'.format(dataset_name))
+
+
+def _pack_bytes(chunks):
+    """Concatenate byte strings into one uint8 array, with the (N + 1) offsets of the chunks."""
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    np.cumsum([len(chunk) for chunk in chunks], out=offsets[1:])
+    return np.frombuffer(b''.join(chunks), dtype=np.uint8), offsets
+
+
+def convert_to_columnar(data_dir, dataset_name, which_sets=('train', 'valid', 'test')):
+    """Convert the one group per example {dataset}.hdf5 into a columnar file, one group per split with
+        img_ids, names, classes (S):     example key, image name and raw class name of every example
+        class_ids (int32):               class id of every example, see TextImageDataset.load_classes
+        embeddings (float32):            (N, ...) text embeddings
+        img_bytes (uint8), img_offsets:  encoded images, image i is img_bytes[img_offsets[i]:img_offsets[i + 1]]
+        txt_bytes (uint8), txt_offsets:  utf-8 encoded captions, indexed the same way
+    Examples keep the order of the keys of the original groups, so indices are unchanged.
+    """
+    from data_loader.datasets_custom import TextImageDataset
+    classes = TextImageDataset.load_classes(data_dir, dataset_name)
+
+    h5_file = os.path.join(data_dir, '{}/{}.hdf5'.format(dataset_name, dataset_name))
+    out_file = columnar_file(data_dir, dataset_name)
+    tmp_file = out_file[:-len('.hdf5')] + '.tmp.hdf5'
+    with h5py.File(h5_file, mode='r') as source, h5py.File(tmp_file, mode='w') as target:
+        for which_set in which_sets:
+            data = source[which_set]
+            img_ids = [str(k) for k in data.keys()]
+            names, class_names, embeddings, images, captions = [], [], [], [], []
+            for img_id in tqdm(img_ids):
+                example = data[img_id]
+                names.append(str(np.array(example['name'])))
+                class_names.append(str(np.array(example['class'])))
+                embeddings.append(np.array(example['embeddings'], dtype=np.float32))
+                images.append(bytes(np.array(example['img'])))
+                captions.append(str(np.array(example['txt'])).encode('utf-8'))
+
+            group = target.create_group(which_set)
+            group.create_dataset('img_ids', data=np.array([k.encode('utf-8') for k in img_ids]))
+            group.create_dataset('names', data=np.array([name.encode('utf-8') for name in names]))
+            group.create_dataset('classes', data=np.array([name.encode('utf-8') for name in class_names]))
+            group.create_dataset('class_ids', data=np.array([classes[name] for name in class_names], dtype=np.int32))
+            group.create_dataset('embeddings', data=np.stack(embeddings))
+            for column, chunks in (('img', images), ('txt', captions)):
+                values, offsets = _pack_bytes(chunks)
+                group.create_dataset(column + '_bytes', data=values, chunks=True)
+                group.create_dataset(column + '_offsets', data=offsets)
+    os.replace(tmp_file, out_file)
+
+
+def _read_chunks(values, offsets, indices, max_gap):
+    """Read the chunks <indices> of a packed bytes column, see <_pack_bytes>, with one slice read per run of
+    chunks less than <max_gap> bytes apart, e.g. one read for a run of consecutive indices.
+        @:param values (h5py.Dataset): uint8 column
+        @:param offsets (array): (N + 1) offsets of the chunks
+        @:param indices (list): chunks to read, in any order and with repetitions
+        @:return the byte strings of the chunks, in the order of <indices>
+    """
+    unique_indices, inverse = np.unique(np.asarray(indices, dtype=np.int64), return_inverse=True)
+    if len(unique_indices) == 0:
+        return []
+    starts, ends = offsets[unique_indices], offsets[unique_indices + 1]
+    # sorted indices have increasing offsets, a new read starts after every gap larger than max_gap
+    breaks = np.flatnonzero(starts[1:] - ends[:-1] > max_gap) + 1
+    chunks = []
+    for run in np.split(np.arange(len(unique_indices)), breaks):
+        first = starts[run[0]]
+        buffer = values[first:ends[run[-1]]].tobytes()
+        chunks.extend(buffer[start - first:end - first] for start, end in zip(starts[run], ends[run]))
+    return [chunks[i] for i in inverse.ravel()]
+
+
+class ColumnarH5Reader(object):
+    """Reader of one split of a columnar file, see <convert_to_columnar>.
+    Offsets, ids, names and class ids are read once; a sample is then a few slice reads, and a batch of
+    indices a few slice reads per column, see <get_batch>.
+    """
+    def __init__(self, path, which_set, rdcc_nbytes=H5_CACHE_BYTES, rdcc_nslots=H5_CACHE_SLOTS):
+        self.which_set = which_set
+        self.file = LazyH5File(path, rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots)
+        group = self.group
+        self.img_ids = [k.decode('utf-8') for k in group['img_ids'][()]]
+        self.names = [name.decode('utf-8') for name in group['names'][()]]
+        self.class_ids = group['class_ids'][()]
+        self.img_offsets = group['img_offsets'][()]
+        self.txt_offsets = group['txt_offsets'][()]
+        # do not leave a handle open across the fork of the DataLoader workers
+        self.file.close()
+
+    @property
+    def group(self):
+        return self.file[self.which_set]
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def image_bytes(self, index):
+        return self.group['img_bytes'][self.img_offsets[index]:self.img_offsets[index + 1]].tobytes()
+
+    def txt(self, index):
+        return self.group['txt_bytes'][self.txt_offsets[index]:self.txt_offsets[index + 1]].tobytes().decode('utf-8')
+
+    def embeddings(self, indices):
+        """Embeddings of one index, or of an array of indices in a single read."""
+        indices = np.asarray(indices)
+        if indices.ndim == 0:
+            return self.group['embeddings'][int(indices)]
+        # h5py reads strictly increasing indices only
+        unique_indices, inverse = np.unique(indices, return_inverse=True)
+        return self.group['embeddings'][unique_indices.tolist()][inverse]
+
+    def get_batch(self, indices, columns=('img_id', 'name', 'class_id', 'img', 'txt', 'embeddings'),
+                  max_gap=MAX_READ_GAP):
+        """Return the <columns> of the examples <indices>, as lists and arrays in the order of <indices>.
+        The images and the captions are read with one slice read per run of examples less than <max_gap>
+        bytes apart, the embeddings with a single read.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        batch = {}
+        if 'img_id' in columns:
+            batch['img_id'] = [self.img_ids[index] for index in indices]
+        if 'name' in columns:
+            batch['name'] = [self.names[index] for index in indices]
+        if 'class_id' in columns:
+            batch['class_id'] = self.class_ids[indices]
+        if 'img' in columns:
+            batch['img'] = _read_chunks(self.group['img_bytes'], self.img_offsets, indices, max_gap)
+        if 'txt' in columns:
+            batch['txt'] = [txt.decode('utf-8') for txt in
+                            _read_chunks(self.group['txt_bytes'], self.txt_offsets, indices, max_gap)]
+        if 'embeddings' in columns:
+            batch['embeddings'] = self.embeddings(indices)
+        return batch
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert birds / flowers to the columnar hdf5 layout')
+    parser.add_argument('--data_dir', type=str, default='data/', help='main directory of datasets')
+    parser.add_argument('--dataset_name', type=str, default='birds', help='[birds | flowers]')
+    parser.add_argument('--which_set', type=str, nargs='+', default=['train', 'valid', 'test'], help='splits to convert')
+    args = parser.parse_args()
+
+    convert_to_columnar(args.data_dir, args.dataset_name, args.which_set)
@@ -0,0 +1,56 @@
+import os
+import io
+import numpy as np
+from PIL import Image
+
+
+def crop_boxes_file(data_dir, dataset_name, which_set):
+    return os.path.join(data_dir, dataset_name, 'crop_boxes', '{}.npy'.format(which_set))
+
+
+def compute_crop_boxes(bboxes, image_sizes):
+    """Square crops of 1.5 times the largest side of the bounding boxes, clipped to the images,
+    the vectorized equivalent of TextImageDataset.crop_image.
+        @:param bboxes (array like): (N, 4) bounding boxes [x-left, y-top, width, height]
+        @:param image_sizes (array like): (N, 2) image [width, height]
+        @:return (N, 4) int32 crop rectangles [x1, y1, x2, y2]
+    """
+    bboxes = np.asarray(bboxes, dtype=np.int64)
+    image_sizes = np.asarray(image_sizes, dtype=np.int64)
+    r = np.floor(np.maximum(bboxes[:, 2], bboxes[:, 3]) * 0.75).astype(np.int64)
+    center_x = (2 * bboxes[:, 0] + bboxes[:, 2]) // 2
+    center_y = (2 * bboxes[:, 1] + bboxes[:, 3]) // 2
+    x1 = np.maximum(0, center_x - r)
+    y1 = np.maximum(0, center_y - r)
+    x2 = np.minimum(image_sizes[:, 0], center_x + r)
+    y2 = np.minimum(image_sizes[:, 1], center_y + r)
+    return np.stack([x1, y1, x2, y2], axis=1).astype(np.int32)
+
+
+def build_crop_boxes(n_examples, get_name, get_images_bytes, bbox, out_file, chunk_size=256):
+    """Compute the crop rectangle of every example of a split, row i for example i.
+    Only the image headers are decoded, to get the image sizes.
+        @:param n_examples (int): number of examples of the split
+        @:param get_name (function): image name of an example index
+        @:param get_images_bytes (function): encoded images of a list of example indices
+        @:param bbox (dict): bounding box of every image name, see TextImageDataset.load_bounding_box
+        @:param out_file (string): where to save the (N, 4) int32 array
+        @:param chunk_size (int): number of images read together
+    """
+    bboxes = np.zeros((n_examples, 4), dtype=np.int64)
+    image_sizes = np.zeros((n_examples, 2), dtype=np.int64)
+    for start in range(0, n_examples, chunk_size):
+        indices = list(range(start, min(start + chunk_size, n_examples)))
+        for i, image_bytes in zip(indices, get_images_bytes(indices)):
+            bboxes[i] = bbox[get_name(i)]
+            image_sizes[i] = Image.open(io.BytesIO(image_bytes)).size
+    crop_boxes = compute_crop_boxes(bboxes, image_sizes)
+
+    out_dir = os.path.dirname(out_file)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    # written to a temporary file first so that concurrent readers never see a partial array
+    tmp_file = out_file[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_file, crop_boxes)
+    os.replace(tmp_file, out_file)
+    return crop_boxes
@@ -0,0 +1,271 @@
+import os
+import json
+import hashlib
+import torch
+import numpy as np
+from torch.utils.data import Dataset, DataLoader
+from utils.data_processing import file_fingerprint
+
+# batch fields served from the DAMSM text embedding cache
+DAMSM_TEXT_FIELDS = ('right_words_embs', 'right_sent_emb')
+# batch fields served from the DAMSM image feature cache
+DAMSM_IMAGE_FIELDS = ('right_region_features', 'right_cnn_codes')
+
+
+def damsm_cache_dir(caption_store):
+    """Directory of the DAMSM caches of a dataset, next to its caption store."""
+    return os.path.join(os.path.dirname(caption_store.store_dir), 'damsm_cache')
+
+
+class DAMSMTextCache(object):
+    """Build-once, memory-mapped store of the outputs of the frozen DAMSM text encoder on the captions of a split.
+    The word embeddings of all the captions are kept in one flat (words, nef) float16 array, caption i being
+    words[offsets[i]:offsets[i + 1]] (with its start and end words); sentence embeddings are a (captions, nef) array.
+    Caption ids are the ones of the caption store, and the files are keyed by the caption store and the DAMSM
+    checkpoint, so a new vocabulary or a retrained DAMSM never reads stale embeddings.
+    """
+    def __init__(self, cache_dir, caption_store, checkpoint_file):
+        """
+            @:param cache_dir (string): directory holding the cache files of a dataset
+            @:param caption_store (CaptionStore): loaded captions of the split
+            @:param checkpoint_file (string): DAMSM checkpoint the text encoder was loaded from
+        """
+        self.cache_dir = cache_dir
+        self.captions = caption_store
+        prefix = os.path.join(cache_dir, '{}_{}_text'.format(caption_store.key, file_fingerprint(checkpoint_file)[:16]))
+        self.words_file = prefix + '.words.npy'
+        self.offsets_file = prefix + '.offsets.npy'
+        self.sent_file = prefix + '.sent.npy'
+        self.words = None
+        self.offsets = None
+        self.sent = None
+
+    def exists(self):
+        return all(os.path.exists(path) for path in (self.words_file, self.offsets_file, self.sent_file))
+
+    def build(self, rnn_encoder, device, batch_size=256):
+        """Run the text encoder once in eval mode over every caption of the split and write the cache files.
+            @:param rnn_encoder (DAMSM_RNN_Encoder or DataParallel): the frozen text encoder
+            @:param device (torch.device): device of the text encoder
+            @:param batch_size (int): # captions encoded together
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        encoder = getattr(rnn_encoder, 'module', rnn_encoder)
+        nef = encoder.lstm_hidden_size * encoder.num_directions
+
+        lengths = self.captions.lengths + 2
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # batches of captions sorted by decreasing length, as pack_padded_sequence expects
+        order = np.argsort(-lengths, kind='mergesort')
+
+        print("Encoding {} captions with the DAMSM text encoder...".format(len(lengths)))
+        # written to temporary files first so that concurrent readers never see a partial cache
+        tmp_words_file = self.words_file + '.tmp.{}.npy'.format(os.getpid())
+        words = np.lib.format.open_memmap(tmp_words_file, mode='w+', dtype=np.float16, shape=(int(offsets[-1]), nef))
+        sent = np.zeros((len(lengths), nef), dtype=np.float32)
+        training = rnn_encoder.training
+        rnn_encoder.eval()
+        try:
+            with torch.no_grad():
+                for start in range(0, len(order), batch_size):
+                    batch = order[start:start + batch_size]
+                    captions = np.zeros((len(batch), lengths[batch[0]]), dtype=np.int64)
+                    for row, index in enumerate(batch):
+                        captions[row, :lengths[index]] = self.captions.get_caption(index)
+                    words_embs, sent_emb = rnn_encoder(torch.from_numpy(captions).to(device),
+                                                       torch.from_numpy(lengths[batch]).to(device))
+                    words_embs = words_embs.transpose(1, 2).cpu().numpy()
+                    for row, index in enumerate(batch):
+                        words[offsets[index]:offsets[index + 1]] = words_embs[row, :lengths[index]]
+                    sent[batch] = sent_emb.cpu().numpy()
+        finally:
+            rnn_encoder.train(training)
+        words.flush()
+        del words
+
+        os.replace(tmp_words_file, self.words_file)
+        for path, array in ((self.offsets_file, offsets), (self.sent_file, sent)):
+            tmp_path = path + '.tmp.{}.npy'.format(os.getpid())
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+
+    def load(self):
+        self.words = np.load(self.words_file, mmap_mode='r')
+        self.offsets = np.load(self.offsets_file)
+        self.sent = np.load(self.sent_file, mmap_mode='r')
+        assert len(self.offsets) == len(self.captions) + 1, "DAMSM text cache is out of date, please rebuild it"
+        return self
+
+    def build_or_load(self, rnn_encoder, device):
+        """Load the cache, building it first with <rnn_encoder> if needed."""
+        if not self.exists():
+            self.build(rnn_encoder, device)
+        return self.load()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """Return the (caption length, nef) float16 word embeddings and the (nef,) sentence embedding of a caption."""
+        return self.words[self.offsets[index]:self.offsets[index + 1]], self.sent[index]
+
+
+class _UnflippedImages(Dataset):
+    """Largest unflipped image of every real image of a dataset, as (3, size, size) uint8 tensors."""
+    def __init__(self, dataset, sample_indices, size):
+        self.dataset = dataset
+        self.sample_indices = sample_indices
+        self.size = size
+
+    def __len__(self):
+        return len(self.sample_indices)
+
+    def __getitem__(self, i):
+        return self.dataset.get_uint8_image(int(self.sample_indices[i]), self.size)
+
+
+class DAMSMImageCache(object):
+    """Build-once, memory-mapped store of the outputs of the frozen DAMSM image encoder on the real images of a split:
+    the (images, nef, 17, 17) float16 region features and the (images, nef) float32 global codes.
+    Row i holds the image of image key i of the dataset, see <DAMSMCacheMixin.image_keys>. The images are encoded
+    unflipped, as the trainers get them with --no_flip. The files are keyed by the split, the image source file,
+    the DAMSM checkpoint, the image size and the settings of the dataset changing the images, see
+    <DAMSMCacheMixin.image_settings>.
+    """
+    def __init__(self, cache_dir, which_set, source_file, checkpoint_file, size=256, image_settings=None):
+        """
+            @:param cache_dir (string): directory holding the cache files of a dataset
+            @:param which_set (string): split name, part of the cache key
+            @:param source_file (string): file the images of the split are listed in (hdf5 file, COCO annotations)
+            @:param checkpoint_file (string): DAMSM checkpoint the image encoder was loaded from
+            @:param size (int): size of the real images given to the encoder by the trainers
+            @:param image_settings (dict): settings of the dataset the images are decoded with, part of the cache key
+        """
+        self.cache_dir = cache_dir
+        self.size = size
+        settings = json.dumps([size, sorted((image_settings or {}).items())])
+        prefix = os.path.join(cache_dir, '{}_{}_{}_{}_image'.format(
+            which_set, file_fingerprint(source_file)[:16], file_fingerprint(checkpoint_file)[:16],
+            hashlib.sha1(settings.encode('utf-8')).hexdigest()[:8]))
+        self.features_file = prefix + '.features.npy'
+        self.codes_file = prefix + '.codes.npy'
+        self.features = None
+        self.codes = None
+
+    def exists(self):
+        return os.path.exists(self.features_file) and os.path.exists(self.codes_file)
+
+    def build(self, dataset, cnn_encoder, device, batch_size=32, num_workers=0):
+        """Run the image encoder once in eval mode over every real image of <dataset> and write the cache files.
+            @:param dataset (Dataset): dataset with the DAMSMCacheMixin and a <get_uint8_image> method
+            @:param cnn_encoder (DAMSM_CNN_Encoder or DataParallel): the frozen image encoder
+            @:param device (torch.device): device of the image encoder
+            @:param num_workers (int): # processes decoding the images
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # one sample of every image, in image key order
+        keys, sample_indices = np.unique(dataset.image_keys(), return_index=True)
+        assert np.array_equal(keys, np.arange(len(keys))), "image keys must number the images from 0"
+        images = DataLoader(_UnflippedImages(dataset, sample_indices, self.size), batch_size=batch_size,
+                            num_workers=num_workers)
+
+        print("Encoding {} images with the DAMSM image encoder...".format(len(keys)))
+        # written to temporary files first so that concurrent readers never see a partial cache
+        tmp_features_file = self.features_file + '.tmp.{}.npy'.format(os.getpid())
+        features = None
+        codes = None
+        training = cnn_encoder.training
+        cnn_encoder.eval()
+        try:
+            with torch.no_grad():
+                start = 0
+                for batch in images:
+                    # scaled to [-1.0, 1.0] like transforms.ToTensor followed by transforms.Normalize with mean and std 0.5
+                    batch = batch.to(device).float().div_(127.5).sub_(1.0)
+                    batch_features, batch_codes = cnn_encoder(batch)
+                    if features is None:
+                        features = np.lib.format.open_memmap(tmp_features_file, mode='w+', dtype=np.float16,
+                                                             shape=(len(keys),) + tuple(batch_features.size()[1:]))
+                        codes = np.zeros((len(keys), batch_codes.size(1)), dtype=np.float32)
+                    features[start:start + len(batch)] = batch_features.cpu().numpy()
+                    codes[start:start + len(batch)] = batch_codes.cpu().numpy()
+                    start += len(batch)
+        finally:
+            cnn_encoder.train(training)
+        features.flush()
+        del features
+
+        os.replace(tmp_features_file, self.features_file)
+        tmp_codes_file = self.codes_file + '.tmp.{}.npy'.format(os.getpid())
+        np.save(tmp_codes_file, codes)
+        os.replace(tmp_codes_file, self.codes_file)
+
+    def load(self):
+        self.features = np.load(self.features_file, mmap_mode='r')
+        self.codes = np.load(self.codes_file, mmap_mode='r')
+        return self
+
+    def build_or_load(self, dataset, cnn_encoder, device, num_workers=0):
+        """Load the cache, building it first with <cnn_encoder> if needed."""
+        if not self.exists():
+            self.build(dataset, cnn_encoder, device, num_workers=num_workers)
+        return self.load()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        """Return the (nef, 17, 17) float16 region features and the (nef,) global code of an image."""
+        return self.features[key], self.codes[key]
+
+
+class DAMSMCacheMixin(object):
+    """Lets a dataset serve the DAMSM embeddings of its right captions from a <DAMSMTextCache>, as the
+    'right_words_emb' and 'right_sent_emb' sample fields, and the DAMSM features of its right images from a
+    <DAMSMImageCache>, as the 'right_region_feature' and 'right_cnn_code' sample fields."""
+    text_embeddings = None
+    image_features = None
+    # <image_keys> of the samples, computed once by <set_image_features>
+    image_feature_keys = None
+
+    def image_keys(self):
+        """Row of the image of every sample in the image feature cache; samples of the same image share it."""
+        return np.arange(len(self))
+
+    def image_source_file(self):
+        """File listing the images of the split, part of the key of the image feature cache."""
+        raise NotImplementedError
+
+    def image_settings(self):
+        """Settings of the dataset changing the images given to the image encoder, part of the key of the image
+        feature cache."""
+        return {'scaled_decode': self.scaled_decode, 'uint8_images': self.uint8_images}
+
+    def set_text_embeddings(self, text_cache):
+        """Serve the embeddings of <text_cache>, a loaded DAMSMTextCache of the caption store of the dataset."""
+        assert len(text_cache) == len(self.captions), "DAMSM text cache and captions do not match"
+        self.text_embeddings = text_cache
+
+    def add_text_embeddings(self, sample, caption_index):
+        if self.text_embeddings is not None and self.wants(*DAMSM_TEXT_FIELDS):
+            words_emb, sent_emb = self.text_embeddings[caption_index]
+            # copied out of the memory map
+            sample['right_words_emb'] = torch.from_numpy(np.array(words_emb))
+            sample['right_sent_emb'] = torch.from_numpy(np.array(sent_emb))
+
+    def set_image_features(self, image_cache):
+        """Serve the features of <image_cache>, a loaded DAMSMImageCache of the images of the dataset."""
+        image_keys = np.asarray(self.image_keys())
+        assert len(image_cache) == int(np.max(image_keys)) + 1, "DAMSM image cache and images do not match"
+        self.image_feature_keys = image_keys
+        self.image_features = image_cache
+
+    def add_image_features(self, sample, index):
+        if self.image_features is not None and self.wants(*DAMSM_IMAGE_FIELDS):
+            region_features, cnn_code = self.image_features[self.image_feature_keys[index]]
+            # copied out of the memory map
+            sample['right_region_feature'] = torch.from_numpy(np.array(region_features))
+            sample['right_cnn_code'] = torch.from_numpy(np.array(cnn_code))
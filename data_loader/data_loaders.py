@@ -1,90 +1,116 @@
 import torch
 import numpy as np
 from torch.utils.data import DataLoader
+from torch.utils.data.sampler import BatchSampler
 from torchvision import transforms
 from data_loader.datasets_custom import TextImageDataset, COCOTextImageDataset
-from base import BaseDataLoader
+from data_loader.coco_shards import COCOShardDataset
+from data_loader.h5_handle import H5_CACHE_BYTES, H5_CACHE_SLOTS
+from data_loader.image_pyramid import PYRAMID_SIZES
+from data_loader.samplers import BucketBatchSampler, ImageGroupedBatchSampler, StreamingBatchSampler
+from base import BaseDataLoader, ResumableLoaderMixin, ResumableRandomSampler, load_sampler_state, worker_kwargs
+
+
+def text_image_worker_init_fn(worker_id):
+    """Give every worker its own numpy random stream, forked workers otherwise draw the same
+    wrong images, captions and flips. The hdf5 file is opened lazily by the dataset itself."""
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+def in_worker_process():
+    """Whether the caller runs in a DataLoader worker process."""
+    get_worker_info = getattr(torch.utils.data, 'get_worker_info', None)
+    if get_worker_info is not None:
+        return get_worker_info() is not None
+    # torch < 1.2
+    return getattr(torch.utils.data.dataloader, '_use_shared_memory', False)
+
+
+def new_batch_tensor(shape, dtype):
+    """Allocate the buffer of a batch field. In a worker it is allocated in shared memory, so that the batch
+    is sent to the main process as a handle; any other tensor is first copied to shared memory when pickled."""
+    tensor = torch.empty(shape, dtype=dtype)
+    if in_worker_process():
+        tensor.share_memory_()
+    return tensor
+
+
+def collate_tensors(tensors):
+    """Stack same shaped tensors into a new batch buffer."""
+    out = new_batch_tensor((len(tensors),) + tuple(tensors[0].size()), tensors[0].dtype)
+    return torch.stack(tensors, 0, out=out)
+
+
+def collate_captions(captions):
+    """Pad a list of LongTensor captions into a (batch, longest caption) LongTensor, also returning the lengths.
+    The captions are written with one masked scatter of their concatenation, row by row."""
+    caption_lengths = torch.LongTensor([len(cap) for cap in captions])
+    padded_captions = new_batch_tensor((len(captions), int(caption_lengths.max())), torch.long).zero_()
+    mask = torch.arange(padded_captions.size(1)).unsqueeze(0) < caption_lengths.unsqueeze(1)
+    padded_captions.masked_scatter_(mask, torch.cat(captions).long())
+    return padded_captions, caption_lengths
+
+
+def collate_word_embeddings(words_embs):
+    """Pad a list of (caption length, nef) word embeddings into a (batch, longest caption, nef) tensor,
+    the zero padding matching the padded positions of the DAMSM text encoder outputs."""
+    max_length = max(words_emb.size(0) for words_emb in words_embs)
+    padded = new_batch_tensor((len(words_embs), max_length, words_embs[0].size(1)), words_embs[0].dtype).zero_()
+    for i, words_emb in enumerate(words_embs):
+        padded[i, :words_emb.size(0)].copy_(words_emb)
+    return padded
 
 
 def text_image_collate_fn(data):
+    """Collate the samples of the text image datasets; only the fields present in the samples are
+    collated, see the <fields> argument of the datasets. Tensors are written into freshly allocated
+    batch buffers, in shared memory when collated in a worker, see <new_batch_tensor>."""
     collate_data = {}
     # Sort a data list by right caption length (descending order).
-    data.sort(key=lambda x: x['right_caption'].size(0), reverse=True)
+    if 'right_caption' in data[0]:
+        data.sort(key=lambda x: x['right_caption'].size(0), reverse=True)
 
     collate_data['right_img_id'] = []
-    collate_data['class_id'] = []
-    collate_data['right_txt'] = []
-    class_ids = []
-    right_captions = []
-    right_embeds = []
-    right_images_32 = []
-    right_images_64 = []
-    right_images_128 = []
-    right_images_256 = []
-
     collate_data['wrong_img_id'] = []
-    collate_data['wrong_txt'] = []
-    wrong_captions = []
-    wrong_embeds = []
-    wrong_images_32 = []
-    wrong_images_64 = []
-    wrong_images_128 = []
-    wrong_images_256 = []
-
-    for i in range(len(data)):
-        class_ids.append(data[i]['right_img_id'])
-        collate_data['class_id'].append(data[i]['right_class_id'])
-        collate_data['right_txt'].append(data[i]['right_txt'])
-        right_captions.append(data[i]['right_caption'])
-        right_embeds.append(data[i]['right_embed'])
-        right_images_32.append(data[i]['right_image_32'])
-        right_images_64.append(data[i]['right_image_64'])
-        right_images_128.append(data[i]['right_image_128'])
-        right_images_256.append(data[i]['right_image_256'])
-
-        collate_data['wrong_txt'].append(data[i]['wrong_txt'])
-        wrong_captions.append(data[i]['wrong_caption'])
-        wrong_embeds.append(data[i]['wrong_embed'])
-        wrong_images_32.append(data[i]['wrong_image_32'])
-        wrong_images_64.append(data[i]['wrong_image_64'])
-        wrong_images_128.append(data[i]['wrong_image_128'])
-        wrong_images_256.append(data[i]['wrong_image_256'])
-
-    # sort and get captions, lengths, images, embeds, etc.
-    right_caption_lengths = [len(cap) for cap in right_captions]
-    collate_data['right_caption_lengths'] = torch.LongTensor(right_caption_lengths)
-    collate_data['right_captions'] = torch.zeros(len(right_caption_lengths), max(right_caption_lengths)).long()
-    for i, cap in enumerate(right_captions):
-        end = right_caption_lengths[i]
-        collate_data['right_captions'][i, :end] = cap[:end]
-
-    # sort and get captions, lengths, images, embeds, etc.
-    wrong_captions.sort(key=lambda x: len(x), reverse=True)
-    wrong_caption_lengths = [len(cap) for cap in wrong_captions]
-    collate_data['wrong_caption_lengths'] = torch.LongTensor(wrong_caption_lengths)
-    collate_data['wrong_captions'] = torch.zeros(len(wrong_caption_lengths), max(wrong_caption_lengths)).long()
-    for i, cap in enumerate(wrong_captions):
-        end = wrong_caption_lengths[i]
-        collate_data['wrong_captions'][i, :end] = cap[:end]
-
-    collate_data['class_id'] = np.stack(class_ids)
-    collate_data['right_embeds'] = torch.stack(right_embeds, 0)
-    collate_data['right_images_32'] = torch.stack(right_images_32, 0)
-    collate_data['right_images_64'] = torch.stack(right_images_64, 0)
-    collate_data['right_images_128'] = torch.stack(right_images_128, 0)
-    collate_data['right_images_256'] = torch.stack(right_images_256, 0)
-
-    collate_data['wrong_embeds'] = torch.stack(wrong_embeds, 0)
-    collate_data['wrong_images_32'] = torch.stack(wrong_images_32, 0)
-    collate_data['wrong_images_64'] = torch.stack(wrong_images_64, 0)
-    collate_data['wrong_images_128'] = torch.stack(wrong_images_128, 0)
-    collate_data['wrong_images_256'] = torch.stack(wrong_images_256, 0)
+    collate_data['class_id'] = np.stack([sample['right_img_id'] for sample in data])
+
+    for side in ('right', 'wrong'):
+        if side + '_txt' in data[0]:
+            collate_data[side + '_txt'] = [sample[side + '_txt'] for sample in data]
+
+        # sort and get captions, lengths, images, embeds, etc.
+        if side + '_caption' in data[0]:
+            captions = [sample[side + '_caption'] for sample in data]
+            if side == 'wrong':
+                captions.sort(key=lambda x: len(x), reverse=True)
+            collate_data[side + '_captions'], collate_data[side + '_caption_lengths'] = collate_captions(captions)
+
+        if side + '_embed' in data[0]:
+            collate_data[side + '_embeds'] = collate_tensors([sample[side + '_embed'] for sample in data])
+
+        # DAMSM embeddings of the right captions, in the order of the right captions
+        if side + '_words_emb' in data[0]:
+            collate_data[side + '_words_embs'] = collate_word_embeddings([sample[side + '_words_emb'] for sample in data])
+            collate_data[side + '_sent_emb'] = collate_tensors([sample[side + '_sent_emb'] for sample in data])
+
+        # DAMSM features of the right images
+        if side + '_cnn_code' in data[0]:
+            collate_data[side + '_region_features'] = collate_tensors([sample[side + '_region_feature'] for sample in data])
+            collate_data[side + '_cnn_codes'] = collate_tensors([sample[side + '_cnn_code'] for sample in data])
+
+        for size in PYRAMID_SIZES:
+            key = '{}_image_{}'.format(side, size)
+            if key in data[0]:
+                collate_data['{}_images_{}'.format(side, size)] = collate_tensors([sample[key] for sample in data])
 
     return collate_data
 
 
-class TextImageDataLoader(DataLoader):
-    def __init__(self, data_dir, dataset_name, which_set, image_size, batch_size, num_workers):
+class TextImageDataLoader(ResumableLoaderMixin, DataLoader):
+    def __init__(self, data_dir, dataset_name, which_set, image_size, batch_size, num_workers, use_image_pyramid=False,
+                 h5_cache_bytes=H5_CACHE_BYTES, h5_cache_slots=H5_CACHE_SLOTS, bucket_by_length=False, max_tokens=None,
+                 fields=None, batch_pyramid=False, columnar=False, flip=True, scaled_decode=True,
+                 shared_cache_bytes=0, uint8_images=False, pin_memory=False, prefetch_factor=2):
         self.data_dir = data_dir
         self.which_set = which_set
         self.dataset_name = dataset_name
@@ -95,22 +121,37 @@ class TextImageDataLoader(DataLoader):
         self.num_workers = num_workers
 
         # transforms.ToTensor convert PIL images in range [0, 255] to a torch in range [-1.0, 1.0]
-        self.transform = transforms.Compose([
-            transforms.RandomHorizontalFlip(),
+        self.transform = transforms.Compose(([transforms.RandomHorizontalFlip()] if flip else []) + [
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
         ])
 
-        self.dataset = TextImageDataset(self.data_dir, self.dataset_name, self.which_set, self.transform, vocab_from_file=False)
+        self.dataset = TextImageDataset(self.data_dir, self.dataset_name, self.which_set, self.transform,
+                                        vocab_from_file=False, use_image_pyramid=use_image_pyramid,
+                                        h5_cache_bytes=h5_cache_bytes, h5_cache_slots=h5_cache_slots,
+                                        fields=fields, batch_pyramid=batch_pyramid, columnar=columnar, flip=flip,
+                                        scaled_decode=scaled_decode, shared_cache_bytes=shared_cache_bytes,
+                                        shared_cache_size=image_size, uint8_images=uint8_images)
         self.n_samples = len(self.dataset)
 
-        if self.which_set == 'train' or self.which_set == 'valid':
+        if bucket_by_length and (self.which_set == 'train' or self.which_set == 'valid'):
+            # batches of captions with similar lengths, optionally sized by a padded token budget
+            super(TextImageDataLoader, self).__init__(
+                dataset=self.dataset,
+                batch_sampler=BucketBatchSampler(self.dataset.caption_lengths, self.batch_size, max_tokens=max_tokens),
+                collate_fn=text_image_collate_fn,
+                worker_init_fn=text_image_worker_init_fn,
+                **worker_kwargs(self.num_workers, pin_memory, prefetch_factor)
+            )
+        elif self.which_set == 'train' or self.which_set == 'valid':
+            # shuffled by a sampler whose state is checkpointed with the training state
             super(TextImageDataLoader, self).__init__(
                 dataset=self.dataset,
                 batch_size=self.batch_size,
-                shuffle=True,
-                num_workers=self.num_workers,
-                collate_fn=text_image_collate_fn
+                sampler=ResumableRandomSampler(np.arange(self.n_samples)),
+                collate_fn=text_image_collate_fn,
+                worker_init_fn=text_image_worker_init_fn,
+                **worker_kwargs(self.num_workers, pin_memory, prefetch_factor)
             )
         else:
             super(TextImageDataLoader, self).__init__(
@@ -125,7 +166,9 @@ class COCOTextImageDataLoader(BaseDataLoader):
     """
     COCO Image Caption Model Data Loader
     """
-    def __init__(self, data_dir, which_set, image_size, batch_size, validation_split, num_workers):
+    def __init__(self, data_dir, which_set, image_size, batch_size, validation_split, num_workers,
+                 bucket_by_length=False, max_tokens=None, fields=None, batch_pyramid=False, flip=True,
+                 group_by_image=False, scaled_decode=True, uint8_images=False, pin_memory=False, prefetch_factor=2):
 
         self.data_dir = data_dir
         self.which_set = which_set
@@ -140,7 +183,9 @@ class COCOTextImageDataLoader(BaseDataLoader):
         mean = torch.tensor([0.5, 0.5, 0.5], dtype=torch.float32)
         std = torch.tensor([0.5, 0.5, 0.5], dtype=torch.float32)
 
-        if which_set == 'val' or which_set == 'test':
+        # only the images of the validation and test sets are flipped
+        image_flip = (which_set == 'val' or which_set == 'test') and flip
+        if image_flip:
             self.transform = transforms.Compose([
                 transforms.RandomHorizontalFlip(),
                 transforms.ToTensor(),
@@ -153,9 +198,25 @@ class COCOTextImageDataLoader(BaseDataLoader):
                 transforms.Normalize(mean=mean, std=std)
             ])
 
-        self.dataset = COCOTextImageDataset(self.data_dir, self.which_set, self.transform, vocab_from_file=True)
+        # every worker keeps the images of its current batches, twice the images of the batches of the sampler
+        image_cache_size = 2 * self.batch_size if group_by_image else 0
+        self.dataset = COCOTextImageDataset(self.data_dir, self.which_set, self.transform, vocab_from_file=True,
+                                            fields=fields, batch_pyramid=batch_pyramid,
+                                            image_cache_size=image_cache_size, scaled_decode=scaled_decode,
+                                            uint8_images=uint8_images, flip=image_flip)
         # self.n_samples = len(self.dataset)
 
+        batch_sampler_fn = None
+        assert not (bucket_by_length and group_by_image), "bucket_by_length and group_by_image are exclusive"
+        if group_by_image:
+            # the captions of an image are loaded together, decoding the image once per epoch
+            batch_sampler_fn = lambda indices: ImageGroupedBatchSampler(
+                self.dataset.index.image_rows, self.batch_size, num_workers=self.num_workers, indices=indices)
+        elif bucket_by_length:
+            # batches of captions with similar lengths, optionally sized by a padded token budget
+            batch_sampler_fn = lambda indices: BucketBatchSampler(
+                self.dataset.caption_lengths, self.batch_size, max_tokens=max_tokens, indices=indices)
+
         if self.which_set == 'train':
             super(COCOTextImageDataLoader, self).__init__(
                 dataset=self.dataset,
@@ -163,7 +224,11 @@ class COCOTextImageDataLoader(BaseDataLoader):
                 shuffle=True,
                 validation_split=validation_split,
                 num_workers=self.num_workers,
-                collate_fn=text_image_collate_fn
+                collate_fn=text_image_collate_fn,
+                worker_init_fn=text_image_worker_init_fn,
+                batch_sampler_fn=batch_sampler_fn,
+                pin_memory=pin_memory,
+                prefetch_factor=prefetch_factor
             )
         else:
             super(COCOTextImageDataLoader, self).__init__(
@@ -172,7 +237,90 @@ class COCOTextImageDataLoader(BaseDataLoader):
                 shuffle=False,
                 validation_split=0,
                 num_workers=self.num_workers,
-                collate_fn=text_image_collate_fn)
+                collate_fn=text_image_collate_fn,
+                worker_init_fn=text_image_worker_init_fn,
+                pin_memory=pin_memory,
+                prefetch_factor=prefetch_factor)
+
+
+class COCOShardDataLoader(ResumableLoaderMixin, DataLoader):
+    """
+    COCO data loader streaming the tar shards of data_loader/coco_shards.py, a drop-in
+    alternative to COCOTextImageDataLoader for file systems with a high per-file latency
+    """
+    def __init__(self, data_dir, which_set, image_size, batch_size, num_workers, shuffle_buffer=2000,
+                 fields=None, batch_pyramid=False, scaled_decode=True, uint8_images=False, pin_memory=False,
+                 prefetch_factor=2):
+
+        self.data_dir = data_dir
+        self.which_set = which_set
+        assert self.which_set in {'train', 'val'}
+
+        self.image_size = (image_size, image_size)
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+        # transforms.ToTensor convert PIL images in range [0, 255] to a torch in range [-1.0, 1.0]
+        mean = torch.tensor([0.5, 0.5, 0.5], dtype=torch.float32)
+        std = torch.tensor([0.5, 0.5, 0.5], dtype=torch.float32)
+        self.transform = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize(mean=mean, std=std)
+        ])
+
+        self.dataset = COCOShardDataset(self.data_dir, self.which_set, self.transform, shuffle_buffer=shuffle_buffer,
+                                        fields=fields, batch_pyramid=batch_pyramid, scaled_decode=scaled_decode,
+                                        uint8_images=uint8_images, num_workers=num_workers)
+
+        # the samples are shuffled by the dataset, within its shuffle buffer
+        super(COCOShardDataLoader, self).__init__(
+            dataset=self.dataset,
+            batch_size=self.batch_size,
+            collate_fn=text_image_collate_fn,
+            worker_init_fn=text_image_worker_init_fn,
+            **worker_kwargs(self.num_workers, pin_memory, prefetch_factor)
+        )
+
+    def __len__(self):
+        """Number of batches of an epoch: every worker batches its own samples, ending with an incomplete batch."""
+        return sum((n_samples + self.batch_size - 1) // self.batch_size for n_samples in self.dataset.worker_lengths())
+
+
+class StreamingDataLoader(ResumableLoaderMixin, DataLoader):
+    """DataLoader iterating once over all the training epochs of <data_loader>, see
+    data_loader.samplers.StreamingBatchSampler: its workers, with their hdf5 handles and image caches, live for the
+    whole training, and the first batches of an epoch are loaded while the last ones of the previous epoch are
+    trained on. The incomplete last batch of an epoch is dropped by the sampler instead of being loaded.
+    """
+    def __init__(self, data_loader, n_epochs=None, drop_last=True):
+        """
+            @:param data_loader (DataLoader): loader of one epoch, with a sampler or a batch sampler
+            @:param n_epochs (int): number of epochs of the stream, None for an endless stream
+            @:param drop_last (bool): drop the incomplete last batch of the epochs of fixed size batches
+        """
+        self.data_loader = data_loader
+        if isinstance(data_loader.batch_sampler, BatchSampler):
+            batch_sampler = StreamingBatchSampler(data_loader.sampler, data_loader.batch_size, drop_last, n_epochs)
+        else:
+            batch_sampler = StreamingBatchSampler(data_loader.batch_sampler, n_epochs=n_epochs)
+        super(StreamingDataLoader, self).__init__(
+            dataset=data_loader.dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=data_loader.collate_fn,
+            worker_init_fn=data_loader.worker_init_fn,
+            **worker_kwargs(data_loader.num_workers, data_loader.pin_memory, getattr(data_loader, 'prefetch_factor', 2))
+        )
+
+    def position(self, n):
+        """Epoch (counted from the start of the stream) of the n-th batch and its position in the epoch."""
+        return self.batch_sampler.position(n)
+
+    def load_state_dict(self, state):
+        """Restore a state of <state_dict>, or the state of an epoch of <data_loader> saved without streaming."""
+        if 'stream' in state.get('batch_sampler', {}):
+            load_sampler_state(self.batch_sampler, state['batch_sampler'], 'batch sampler')
+        else:
+            self.data_loader.load_state_dict(state)
 
 
 if __name__ == '__main__':
@@ -1,24 +1,65 @@
-import h5py
 import json
 import os
-import io
 import torch
-import sys
-import nltk
 import numpy as np
 import pandas as pd
 dirname = os.path.dirname(__file__)
 dirname = os.path.dirname(dirname)
-sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data/coco/cocoapi/PythonAPI'))
-from pycocotools.coco import COCO
 from tqdm import tqdm
 from torch.utils.data import Dataset
 from utils.data_processing import Vocabulary, COCOVocabulary, text_clean
+from data_loader.caption_store import CaptionStore
+from data_loader.coco_index import COCOIndex
+from data_loader.crop_boxes import crop_boxes_file, build_crop_boxes
+from data_loader.damsm_cache import DAMSMCacheMixin
+from data_loader.columnar_h5 import ColumnarH5Reader, columnar_file
+from data_loader.image_pyramid import ImagePyramid, PYRAMID_SIZES
+from data_loader.image_cache import LRUCache
+from data_loader.image_decode import decode_image
+from data_loader.shm_image_cache import SharedImageCache
+from data_loader.h5_handle import LazyH5File, H5_CACHE_BYTES, H5_CACHE_SLOTS
+from data_loader.negative_sampler import NegativeSampler
 from PIL import Image
 from collections import OrderedDict
 
+# every field a batch of text_image_collate_fn can hold, trainers request a subset of them
+TEXT_IMAGE_FIELDS = (
+    'class_id',
+    'right_txt', 'right_captions', 'right_caption_lengths', 'right_embeds', 'right_words_embs', 'right_sent_emb',
+    'right_images_32', 'right_images_64', 'right_images_128', 'right_images_256', 'right_region_features', 'right_cnn_codes',
+    'wrong_txt', 'wrong_captions', 'wrong_caption_lengths', 'wrong_embeds',
+    'wrong_images_32', 'wrong_images_64', 'wrong_images_128', 'wrong_images_256',
+)
 
-class COCOTextImageDataset(Dataset):
+
+def uint8_tensor(image):
+    """Convert a (size, size, 3) PIL image or uint8 array to a (3, size, size) uint8 tensor."""
+    image = np.asarray(image, dtype=np.uint8)
+    return torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))
+
+
+class FieldSelectionMixin(object):
+    """Lets a dataset compute only the batch fields that are consumed, see <TEXT_IMAGE_FIELDS>."""
+    fields = None
+
+    def set_fields(self, fields):
+        """Restrict the samples to <fields> (an iterable of batch field names), None for all of them."""
+        if fields is not None:
+            unknown = set(fields) - set(TEXT_IMAGE_FIELDS)
+            assert not unknown, "unknown sample fields: {}".format(sorted(unknown))
+            fields = frozenset(fields)
+        self.fields = fields
+
+    def wants(self, *fields):
+        """Whether any of <fields> is requested."""
+        return self.fields is None or any(field in self.fields for field in fields)
+
+    def wanted_sizes(self, side):
+        """Image sizes requested for the 'right' or 'wrong' image."""
+        return [size for size in PYRAMID_SIZES if self.wants('{}_images_{}'.format(side, size))]
+
+
+class COCOTextImageDataset(FieldSelectionMixin, DAMSMCacheMixin, Dataset):
     def __init__(self,
                  data_dir,
                  which_set,
@@ -29,11 +70,28 @@ class COCOTextImageDataset(Dataset):
                  end_word="<end>",
                  unk_word="<unk>",
                  annotations_file=os.path.join(dirname, "data/coco/annotations/captions_train2017.json"),
-                 vocab_from_file=True
+                 vocab_from_file=True,
+                 fields=None,
+                 batch_pyramid=False,
+                 image_cache_size=0,
+                 scaled_decode=True,
+                 uint8_images=False,
+                 flip=False
                  ):
         """
             @:param datasetFile (string): path for dataset file
             @:param which_set (string): "train:, "valid", "test"
+            @:param fields (list): batch fields to compute, see TEXT_IMAGE_FIELDS; None for all of them
+            @:param batch_pyramid (bool): only load the largest image size as uint8, the batch is transformed
+                                          by data_loader.batch_transforms.expand_image_pyramid
+            @:param image_cache_size (int): number of resized images kept by every process, to serve the
+                                            other captions of an image, see data_loader.samplers.ImageGroupedBatchSampler
+            @:param scaled_decode (bool): decode the JPEG images close to the largest size they are resized to,
+                                          see data_loader.image_decode.decode_image
+            @:param uint8_images (bool): load every image size as uint8, the batch is normalized by
+                                         data_loader.batch_transforms.expand_image_pyramid
+            @:param flip (bool): whether <transform> randomly flips the images, the uint8 images are then flipped
+                                 by data_loader.batch_transforms.expand_image_pyramid
         """
 
         if data_dir[-1] != '/':
@@ -44,24 +102,30 @@ class COCOTextImageDataset(Dataset):
         self.vocab = COCOVocabulary(vocab_threshold, vocab_file, start_word,
                                     end_word, unk_word, annotations_file, vocab_from_file)
         self.transform = transform
+        self.set_fields(fields)
+        self.batch_pyramid = batch_pyramid
+        # resized images of the image rows last loaded, filled separately by every worker
+        self.image_cache = LRUCache(image_cache_size) if image_cache_size > 0 else None
+        self.scaled_decode = scaled_decode
+        self.uint8_images = uint8_images
+        self.flip = flip
 
         if self.which_set == 'train' or self.which_set == 'val':
-            self.coco = COCO(os.path.join(data_dir, 'annotations/captions_{}2017.json'.format(which_set)))
-            self.ann_ids = list(self.coco.anns.keys())
-
-            self.classes = OrderedDict()
-            class_cnt = 0
-            for ann_id in self.ann_ids:
-                img_id = self.coco.anns[ann_id]["image_id"]
-                if img_id not in self.classes.keys():
-                    class_cnt += 1
-                    self.classes[img_id] = class_cnt
-
-            print("Obtaining caption lengths...")
-            all_tokens = [nltk.tokenize.word_tokenize(
-                text_clean(str(self.coco.anns[self.ann_ids[index]]["caption"])).lower())
-                for index in tqdm(np.arange(len(self.ann_ids)))]
-            self.caption_lengths = [len(token) for token in all_tokens]
+            # numpy tables compiled once from the annotation file, instead of a pycocotools COCO object per worker
+            self.index = COCOIndex(os.path.join(data_dir, 'annotations/captions_{}2017.json'.format(which_set)))
+            self.index.build_or_load()
+            self.ann_ids = self.index.ann_ids
+            # images are numbered by order of first appearance, starting at 1
+            self.class_ids = self.index.image_rows + 1
+
+            # wrong images and captions are drawn among the annotations of the other images
+            self.negatives = NegativeSampler(self.index.image_rows)
+
+            # captions are tokenized once and then served from the memory-mapped store
+            self.captions = CaptionStore(os.path.join(data_dir, 'caption_store'), which_set, self.vocab)
+            self.captions.build_or_load(
+                lambda: [self.index.caption(i) for i in range(len(self.index))])
+            self.caption_lengths = self.captions.lengths
         else:
             test_info = json.loads(open(os.path.join(data_dir, 'annotations/image_info_test2017')).read())
             self.paths = [item["file_name"] for item in test_info["images"]]
@@ -70,108 +134,92 @@ class COCOTextImageDataset(Dataset):
         return len(self.ann_ids)
 
     def __getitem__(self, index):
-        right_ann_id = self.ann_ids[index]
-
-        right_txt = self.coco.anns[right_ann_id]["caption"]
-        right_txt = str(np.array(right_txt))
-        right_img_id = self.coco.anns[right_ann_id]["image_id"]
-        right_image_path = self.coco.loadImgs(right_img_id)[0]["file_name"]
-        class_id = self.classes[right_img_id]
-        # TODO use DAMSM model to get embedding
-        right_embed = [0]
-
-        wrong_img_id = self.find_wrong_img_id(right_img_id)
-        wrong_txt = str(np.array(self.find_wrond_txt(right_img_id)))
-        wrong_image_path = self.coco.loadImgs(wrong_img_id)[0]["file_name"]
-        # TODO use DAMSM model to get embedding
-        wrong_embed = [0]
-
-        # Processing images
-        right_image = Image.open(os.path.join(self.data_dir + 'images/{}/'.format(self.which_set), right_image_path))
-        right_image = right_image.convert("RGB")
-        wrong_image = Image.open(os.path.join(self.data_dir + 'images/{}/'.format(self.which_set), wrong_image_path))
-        wrong_image = wrong_image.convert("RGB")
-
-        right_image_32 = right_image.resize((32, 32))
-        wrong_image_32 = wrong_image.resize((32, 32))
-        right_image_64 = right_image.resize((64, 64))
-        wrong_image_64 = wrong_image.resize((64, 64))
-        right_image_128 = right_image.resize((128, 128))
-        wrong_image_128 = wrong_image.resize((128, 128))
-        right_image_256 = right_image.resize((256, 256))
-        wrong_image_256 = wrong_image.resize((256, 256))
-
-        right_image_32 = self.transform(right_image_32)
-        wrong_image_32 = self.transform(wrong_image_32)
-        right_image_64 = self.transform(right_image_64)
-        wrong_image_64 = self.transform(wrong_image_64)
-        right_image_128 = self.transform(right_image_128)
-        wrong_image_128 = self.transform(wrong_image_128)
-        right_image_256 = self.transform(right_image_256)
-        wrong_image_256 = self.transform(wrong_image_256)
-
-        # Processing txt
-        # Convert caption to tensor of word ids.
-        right_txt = text_clean(right_txt)
-        right_tokens = nltk.tokenize.word_tokenize(str(right_txt).lower())
-        right_caption = []
-        right_caption.append(self.vocab(self.vocab.start_word))
-        right_caption.extend(self.vocab(token) for token in right_tokens)
-        right_caption.append(self.vocab(self.vocab.end_word))
-        right_caption = torch.Tensor(right_caption).long()
-
-        wrong_txt = text_clean(wrong_txt)
-        wrong_tokens = nltk.tokenize.word_tokenize(str(wrong_txt).lower())
-        wrong_caption = []
-        wrong_caption.append(self.vocab(self.vocab.start_word))
-        wrong_caption.extend(self.vocab(token) for token in wrong_tokens)
-        wrong_caption.append(self.vocab(self.vocab.end_word))
-        wrong_caption = torch.Tensor(wrong_caption).long()
+        wrong_img_index, wrong_txt_index = self.find_wrong_indices(index)
 
         sample = {
-                'right_img_id': right_img_id,
-                'right_class_id': class_id,
-                'right_image_32': right_image_32,
-                'right_image_64': right_image_64,
-                'right_image_128': right_image_128,
-                'right_image_256': right_image_256,
-                'right_embed': torch.FloatTensor(right_embed),
-                'right_caption': right_caption,
-                'right_txt': right_txt,
-                'wrong_image_32': wrong_image_32,
-                'wrong_image_64': wrong_image_64,
-                'wrong_image_128': wrong_image_128,
-                'wrong_image_256': wrong_image_256,
-                'wrong_embed': torch.FloatTensor(wrong_embed),
-                'wrong_caption': wrong_caption,
-                'wrong_txt': wrong_txt,
+                'right_img_id': self.index.image_id(index),
+                'right_class_id': self.class_ids[index],
                  }
 
-        return sample
-
-    def find_wrong_img_id(self, right_img_id):
-        idx = np.random.randint(len(self.ann_ids))
-        ann_id = self.ann_ids[idx]
-        img_id = self.coco.anns[ann_id]["image_id"]
-
-        if img_id != right_img_id:
-            return img_id
-
-        return self.find_wrong_img_id(right_img_id)
+        # Processing images
+        for side, img_index in (('right', index), ('wrong', wrong_img_index)):
+            sizes = self.wanted_sizes(side)
+            if sizes and self.batch_pyramid:
+                # the smaller sizes are built from the largest one, for the whole batch at once
+                sample['{}_image_{}'.format(side, sizes[-1])] = self.get_uint8_image(img_index, sizes[-1])
+            elif sizes and self.uint8_images:
+                # normalized for the whole batch at once
+                for size, image in zip(sizes, self.get_uint8_images(img_index, sizes)):
+                    sample['{}_image_{}'.format(side, size)] = image
+            elif sizes:
+                for size, image in zip(sizes, self.get_images(img_index, sizes)):
+                    sample['{}_image_{}'.format(side, size)] = image
 
-    def find_wrond_txt(self, right_img_id):
-        idx = np.random.randint(len(self.ann_ids))
-        ann_id = self.ann_ids[idx]
-        img_id = self.coco.anns[ann_id]["image_id"]
+        # Processing txt
+        # Look up the pre-tokenized word ids of the captions.
+        for side, txt_index in (('right', index), ('wrong', wrong_txt_index)):
+            if self.wants(side + '_txt'):
+                sample[side + '_txt'] = text_clean(self.index.caption(txt_index))
+            if self.wants(side + '_captions', side + '_caption_lengths'):
+                sample[side + '_caption'] = torch.from_numpy(self.captions.get_caption(txt_index))
+            if self.wants(side + '_embeds'):
+                # TODO use DAMSM model to get embedding
+                sample[side + '_embed'] = torch.FloatTensor([0])
+        self.add_text_embeddings(sample, index)
+        self.add_image_features(sample, index)
 
-        if img_id != right_img_id:
-            txt = self.coco.anns[ann_id]["caption"]
-            return txt
+        return sample
 
-        return self.find_wrond_txt(right_img_id)
+    def get_images(self, index, sizes):
+        """Decode the image of annotation <index> and return its transformed tensor at every size of <sizes>."""
+        return [self.transform(image) for image in self.get_resized_images(index, sizes)]
+
+    def get_uint8_image(self, index, size):
+        """Return the image of annotation <index> resized to <size> as a (3, size, size) uint8 tensor."""
+        return uint8_tensor(self.get_resized_images(index, [size])[0])
+
+    def get_uint8_images(self, index, sizes):
+        """Return the image of annotation <index> at every size of <sizes> as (3, size, size) uint8 tensors."""
+        return [uint8_tensor(image) for image in self.get_resized_images(index, sizes)]
+
+    def get_resized_images(self, index, sizes):
+        """Return the image of annotation <index> resized to every size of <sizes>, as PIL images.
+        With an image cache, the image is only decoded the first time one of its captions is loaded."""
+        if self.image_cache is None:
+            image = self.load_image(index, max(sizes))
+            return [image.resize((size, size)) for size in sizes]
+
+        image_row = int(self.index.image_rows[index])
+        resized = self.image_cache.get(image_row)
+        if resized is None or any(size not in resized for size in sizes):
+            image = self.load_image(index, max(sizes))
+            resized = dict(resized or {})
+            for size in sizes:
+                resized[size] = image.resize((size, size))
+            self.image_cache.put(image_row, resized)
+        return [resized[size] for size in sizes]
+
+    def load_image(self, index, size=None):
+        """Decode the image of annotation <index>, at reduced resolution when it is resized to <size> afterwards."""
+        image_path = self.index.file_name(index)
+        return decode_image(os.path.join(self.data_dir + 'images/{}/'.format(self.which_set), image_path),
+                            size if self.scaled_decode else None)
+
+    def image_keys(self):
+        """Images are shared by the annotations of the same image, numbered by order of first appearance."""
+        return self.index.image_rows
+
+    def image_source_file(self):
+        return self.index.annotations_file
+
+    def find_wrong_indices(self, indices):
+        """Draw the wrong image and wrong caption indices of one index or a whole batch of indices.
+        Both come from annotations of another image; the result has shape indices.shape + (2,).
+        """
+        return self.negatives.sample(indices, 2)
 
 
-class TextImageDataset(Dataset):
+class TextImageDataset(FieldSelectionMixin, DAMSMCacheMixin, Dataset):
     def __init__(self,
                  data_dir,
                  dataset_name,
@@ -181,11 +229,39 @@ class TextImageDataset(Dataset):
                  start_word="<start>",
                  end_word="<end>",
                  unk_word="<unk>",
-                 vocab_from_file=False
+                 vocab_from_file=False,
+                 use_image_pyramid=False,
+                 h5_cache_bytes=H5_CACHE_BYTES,
+                 h5_cache_slots=H5_CACHE_SLOTS,
+                 fields=None,
+                 batch_pyramid=False,
+                 columnar=False,
+                 flip=True,
+                 scaled_decode=True,
+                 shared_cache_bytes=0,
+                 shared_cache_size=max(PYRAMID_SIZES),
+                 uint8_images=False
                  ):
         """
             @:param datasetFile (string): path for dataset file
             @:param which_set (string): "train:, "valid", "test"
+            @:param use_image_pyramid (bool): serve images from the preprocessed pyramid instead of decoding them
+            @:param h5_cache_bytes (int): hdf5 chunk cache size of every process
+            @:param h5_cache_slots (int): hdf5 chunk cache hash table slots of every process
+            @:param fields (list): batch fields to compute, see TEXT_IMAGE_FIELDS; None for all of them
+            @:param batch_pyramid (bool): only load the largest image size as uint8, the batch is transformed
+                                          by data_loader.batch_transforms.expand_image_pyramid
+            @:param columnar (bool): read the columnar file built by data_loader/columnar_h5.py
+            @:param flip (bool): randomly flip the images served from the image pyramid, and the uint8 images
+                                 in data_loader.batch_transforms.expand_image_pyramid, like the transform does
+            @:param scaled_decode (bool): decode the JPEG images close to the largest size they are resized to,
+                                          see data_loader.image_decode.decode_image
+            @:param shared_cache_bytes (int): memory of the images decoded at <shared_cache_size> kept for all
+                                              the processes, see data_loader.shm_image_cache.SharedImageCache;
+                                              0 to decode the images every time
+            @:param shared_cache_size (int): size of the images of the shared cache
+            @:param uint8_images (bool): load every image size as uint8, the batch is normalized by
+                                         data_loader.batch_transforms.expand_image_pyramid
         """
 
         if os.path.exists(data_dir):
@@ -200,28 +276,26 @@ class TextImageDataset(Dataset):
         assert self.which_set in {'train', 'valid', 'test'}
 
         self.transform = transform
-        self.total_data = h5py.File(self.h5_file, mode='r')
-        self.data = self.total_data[which_set]
-        self.img_ids = [str(k) for k in self.data.keys()]
+        self.set_fields(fields)
+        self.batch_pyramid = batch_pyramid
+        self.flip = flip
+        self.scaled_decode = scaled_decode
+        self.uint8_images = uint8_images
+        # the hdf5 file is opened lazily by every process using it, see <data>
+        self.total_data = LazyH5File(self.h5_file, rdcc_nbytes=h5_cache_bytes, rdcc_nslots=h5_cache_slots)
+        # examples read from contiguous columns instead of one hdf5 group per example
+        self.columns = None
+        if columnar:
+            self.columns = ColumnarH5Reader(columnar_file(data_dir, dataset_name), which_set,
+                                            rdcc_nbytes=h5_cache_bytes, rdcc_nslots=h5_cache_slots)
+            self.img_ids = self.columns.img_ids
+        else:
+            self.img_ids = [str(k) for k in self.data.keys()]
 
-        if dataset_name == 'birds':
-            # load bounding box
-            self.bbox = self.load_bounding_box()
-            # load class file
-            class_file = os.path.join(data_dir, dataset_name, 'CUB_200_2011', 'classes.txt')
-            self.classes = OrderedDict()
-            with open(class_file, 'rb') as f:
-                for line in f:
-                    (key, val) = line.split()
-                    self.classes[val.decode("utf-8")] = int(key)
-        elif dataset_name == 'flowers':
-            self.bbox = None
-            class_file = os.path.join(data_dir, dataset_name, 'classes.txt')
-            self.classes = OrderedDict()
-            with open(class_file, 'rb') as f:
-                for i, line in enumerate(f):
-                    val = line.split()[0]
-                    self.classes[val.decode("utf-8")] = i+1
+        # crop rectangles of the bounding boxes, row i for img_ids[i]
+        self.crop_boxes = self.load_crop_boxes() if dataset_name == 'birds' else None
+        # load class file
+        self.classes = self.load_classes(data_dir, dataset_name)
 
         self.vocab = Vocabulary(
             vocab_threshold=vocab_threshold,
@@ -232,10 +306,76 @@ class TextImageDataset(Dataset):
             vocab_from_file=vocab_from_file,
             data_dir=data_dir)
 
-        all_tokens = [nltk.tokenize.word_tokenize(
-                      text_clean(str(np.array(self.data[index]['txt']))).lower())
-                        for index in tqdm(self.img_ids)]
-        self.caption_lengths = [len(token) for token in all_tokens]
+        # captions are tokenized once and then served from the memory-mapped store
+        self.captions = CaptionStore(os.path.join(data_dir, dataset_name, 'caption_store'), which_set, self.vocab)
+        self.captions.build_or_load(
+            lambda: [self.get_txt(index) for index in tqdm(range(len(self.img_ids)))])
+        self.caption_lengths = self.captions.lengths
+
+        # wrong images, captions and embeddings are drawn among the examples of the other classes
+        if self.columns is not None:
+            self.class_ids = self.columns.class_ids
+        else:
+            self.class_ids = np.array([self.classes[str(np.array(self.data[img_id]['class']))]
+                                       for img_id in tqdm(self.img_ids)])
+        self.negatives = NegativeSampler(self.class_ids)
+
+        # images already decoded, cropped and resized by data_loader/image_pyramid.py
+        self.pyramid = None
+        if use_image_pyramid:
+            self.pyramid = ImagePyramid(data_dir, dataset_name, which_set).load()
+            assert len(self.pyramid) == len(self.img_ids), "image pyramid is out of date, please rebuild it"
+
+        # images decoded by any process, filled on first access, when they are not served from the pyramid
+        self.shared_cache = None
+        if shared_cache_bytes > 0 and self.pyramid is None:
+            self.shared_cache = SharedImageCache(len(self.img_ids), shared_cache_size, shared_cache_bytes,
+                                                 name='{}_{}'.format(dataset_name, which_set))
+
+        # do not leave a handle open across the fork of the DataLoader workers
+        self.total_data.close()
+
+    def load_crop_boxes(self):
+        """Load the (N, 4) int32 crop rectangles of the split, computed once from the bounding boxes."""
+        path = crop_boxes_file(self.data_dir, self.dataset_name, self.which_set)
+        if os.path.exists(path):
+            crop_boxes = np.load(path)
+            if len(crop_boxes) == len(self.img_ids):
+                return crop_boxes
+        print("Computing the crop boxes of {} {}...".format(self.dataset_name, self.which_set))
+        bbox = self.load_bounding_box(self.data_dir, self.dataset_name)
+        return build_crop_boxes(len(self.img_ids), self.get_name, self.get_images_bytes, bbox, path)
+
+    @property
+    def data(self):
+        """The hdf5 group of the split, opened on first access in the current process."""
+        return self.total_data[self.which_set]
+
+    def get_txt(self, index):
+        if self.columns is not None:
+            return self.columns.txt(index)
+        return str(np.array(self.data[self.img_ids[index]]['txt']))
+
+    def get_embeddings(self, index):
+        if self.columns is not None:
+            return self.columns.embeddings(index)
+        return np.array(self.data[self.img_ids[index]]['embeddings'], dtype=float)
+
+    def get_image_bytes(self, index):
+        if self.columns is not None:
+            return self.columns.image_bytes(index)
+        return bytes(np.array(self.data[self.img_ids[index]]['img']))
+
+    def get_images_bytes(self, indices):
+        """Encoded images of a list of indices, read together from the columnar file."""
+        if self.columns is not None:
+            return self.columns.get_batch(indices, columns=('img',))['img']
+        return [self.get_image_bytes(index) for index in indices]
+
+    def get_name(self, index):
+        if self.columns is not None:
+            return self.columns.names[index]
+        return str(np.array(self.data[self.img_ids[index]]['name']))
 
     def __len__(self):
         return len(self.img_ids)
@@ -243,141 +383,151 @@ class TextImageDataset(Dataset):
     def __getitem__(self, index):
 
         img_id = self.img_ids[index]
-        class_name = str(np.array(self.data[img_id]['class']))
-        class_id = self.classes[class_name]
-
-        right_txt = str(np.array(self.data[img_id]['txt']))
-        wrong_txt = str(np.array(self.find_wrong_txt(self.data[img_id]['class'])))
-        right_image_path = bytes(np.array(self.data[img_id]['img']))
-        right_embed = np.array(self.data[img_id]['embeddings'], dtype=float)
-        wrong_image_path, wrong_img_id = self.find_wrong_image(self.data[img_id]['class'])
-        wrong_image_path = bytes(np.array(wrong_image_path))
-        wrong_embed = np.array(self.find_wrong_embed())
-
-        # Processing images
-        right_image = Image.open(io.BytesIO(right_image_path)).convert("RGB")
-        wrong_image = Image.open(io.BytesIO(wrong_image_path)).convert("RGB")
-
-        if self.bbox is not None:
-            right_image_bbox = self.bbox[str(np.array(self.data[img_id]["name"]))]
-            wrong_image_bbox = self.bbox[str(np.array(self.data[wrong_img_id]["name"]))]
-            right_image = self.crop_image(right_image, right_image_bbox)
-            wrong_image = self.crop_image(wrong_image, wrong_image_bbox)
-
-        right_image_32 = right_image.resize((32, 32))
-        wrong_image_32 = wrong_image.resize((32, 32))
-        right_image_64 = right_image.resize((64, 64))
-        wrong_image_64 = wrong_image.resize((64, 64))
-        right_image_128 = right_image.resize((128, 128))
-        wrong_image_128 = wrong_image.resize((128, 128))
-        right_image_256 = right_image.resize((256, 256))
-        wrong_image_256 = wrong_image.resize((256, 256))
-
-        right_image_32 = self.transform(right_image_32)
-        wrong_image_32 = self.transform(wrong_image_32)
-        right_image_64 = self.transform(right_image_64)
-        wrong_image_64 = self.transform(wrong_image_64)
-        right_image_128 = self.transform(right_image_128)
-        wrong_image_128 = self.transform(wrong_image_128)
-        right_image_256 = self.transform(right_image_256)
-        wrong_image_256 = self.transform(wrong_image_256)
-
-        # Processing txt
-        # Convert caption to tensor of word ids.
-        right_txt = text_clean(right_txt)
-        right_tokens = nltk.tokenize.word_tokenize(str(right_txt).lower())
-        right_caption = []
-        right_caption.append(self.vocab(self.vocab.start_word))
-        right_caption.extend(self.vocab(token) for token in right_tokens)
-        right_caption.append(self.vocab(self.vocab.end_word))
-        right_caption = torch.Tensor(right_caption).long()
-
-        wrong_txt = text_clean(wrong_txt)
-        wrong_tokens = nltk.tokenize.word_tokenize(str(wrong_txt).lower())
-        wrong_caption = []
-        wrong_caption.append(self.vocab(self.vocab.start_word))
-        wrong_caption.extend(self.vocab(token) for token in wrong_tokens)
-        wrong_caption.append(self.vocab(self.vocab.end_word))
-        wrong_caption = torch.Tensor(wrong_caption).long()
+        wrong_index, wrong_txt_index, wrong_embed_index = self.find_wrong_indices(index)
 
         sample = {
                 'right_img_id': img_id,
-                'right_class_id': class_id,
-                'right_image_32': right_image_32,
-                'right_image_64': right_image_64,
-                'right_image_128': right_image_128,
-                'right_image_256': right_image_256,
-                'right_embed': torch.FloatTensor(right_embed),
-                'right_caption': right_caption,
-                'right_txt': right_txt,
-                'wrong_image_32': wrong_image_32,
-                'wrong_image_64': wrong_image_64,
-                'wrong_image_128': wrong_image_128,
-                'wrong_image_256': wrong_image_256,
-                'wrong_embed': torch.FloatTensor(wrong_embed),
-                'wrong_caption': wrong_caption,
-                'wrong_txt': wrong_txt,
+                'right_class_id': self.class_ids[index],
                  }
 
-        return sample
-
-    def find_wrong_image(self, category):
-        idx = np.random.randint(len(self.img_ids))
-        img_id = self.img_ids[idx]
-        _category = self.data[img_id]
+        # Processing images
+        for side, image_index in (('right', index), ('wrong', wrong_index)):
+            sizes = self.wanted_sizes(side)
+            if sizes and self.batch_pyramid:
+                # the smaller sizes are built from the largest one, for the whole batch at once
+                sample['{}_image_{}'.format(side, sizes[-1])] = self.get_uint8_image(image_index, sizes[-1])
+            elif sizes and self.uint8_images:
+                # normalized for the whole batch at once
+                for size, image in zip(sizes, self.get_uint8_images(image_index, sizes)):
+                    sample['{}_image_{}'.format(side, size)] = image
+            elif sizes:
+                for size, image in zip(sizes, self.get_images(image_index, sizes)):
+                    sample['{}_image_{}'.format(side, size)] = image
 
-        if _category != category:
-            return self.data[img_id]['img'], img_id
+        # Processing txt
+        # Look up the pre-tokenized word ids of the captions.
+        for side, txt_index, embed_index in (('right', index, index), ('wrong', wrong_txt_index, wrong_embed_index)):
+            if self.wants(side + '_txt'):
+                sample[side + '_txt'] = text_clean(self.get_txt(txt_index))
+            if self.wants(side + '_captions', side + '_caption_lengths'):
+                sample[side + '_caption'] = torch.from_numpy(self.captions.get_caption(txt_index))
+            if self.wants(side + '_embeds'):
+                sample[side + '_embed'] = torch.FloatTensor(self.get_embeddings(embed_index))
+        self.add_text_embeddings(sample, index)
+        self.add_image_features(sample, index)
 
-        return self.find_wrong_image(category)
+        return sample
 
-    def find_wrong_embed(self):
-        idx = np.random.randint(len(self.img_ids))
-        img_id = self.img_ids[idx]
-        return self.data[img_id]['embeddings']
+    def load_image(self, index, size=None):
+        """Decode image <index> and crop it to its bounding box (birds), at reduced resolution when it is
+        resized to <size> afterwards."""
+        crop_box = self.crop_boxes[index].tolist() if self.crop_boxes is not None else None
+        return decode_image(self.get_image_bytes(index), size if self.scaled_decode else None, crop_box)
+
+    def get_images(self, index, sizes):
+        """Return the transformed tensors of image <index> at every size of <sizes>."""
+        if self.pyramid is not None:
+            return self.get_pyramid_images(index, sizes)
+        return [self.transform(image) for image in self.get_resized_images(index, sizes)]
+
+    def get_uint8_image(self, index, size):
+        """Return image <index> resized to <size> as a (3, size, size) uint8 tensor."""
+        if self.pyramid is not None:
+            return uint8_tensor(self.pyramid.levels[self.pyramid.sizes.index(size)][index])
+        return uint8_tensor(self.get_resized_image(index, size))
+
+    def get_uint8_images(self, index, sizes):
+        """Return image <index> at every size of <sizes> as (3, size, size) uint8 tensors."""
+        if self.pyramid is not None:
+            return [uint8_tensor(self.pyramid.levels[self.pyramid.sizes.index(size)][index]) for size in sizes]
+        return [uint8_tensor(image) for image in self.get_resized_images(index, sizes)]
+
+    def get_resized_images(self, index, sizes):
+        """Return image <index> resized to every size of <sizes>, as PIL images."""
+        if self.shared_cache is not None and max(sizes) == self.shared_cache.size:
+            # the smaller sizes are resized from the cached image
+            image = Image.fromarray(self.get_resized_image(index, max(sizes)))
+        else:
+            image = self.load_image(index, max(sizes))
+        return [image.resize((size, size)) for size in sizes]
+
+    def get_resized_image(self, index, size):
+        """Return image <index> resized to <size> as a (size, size, 3) uint8 array, through the shared image
+        cache when it holds the images of that size."""
+        if self.shared_cache is None or size != self.shared_cache.size:
+            return np.asarray(self.load_image(index, size).resize((size, size)), dtype=np.uint8)
+        image = self.shared_cache.get(index)
+        if image is None:
+            image = np.asarray(self.load_image(index, size).resize((size, size)), dtype=np.uint8)
+            self.shared_cache.put(index, image)
+        return image
 
-    def find_wrong_txt(self, category):
-        idx = np.random.randint(len(self.img_ids))
-        img_id = self.img_ids[idx]
+    def image_source_file(self):
+        return self.h5_file
 
-        _category = self.data[img_id]
+    def image_settings(self):
+        """The images of the pyramid are resized from the full resolution images."""
+        settings = super(TextImageDataset, self).image_settings()
+        settings['image_pyramid'] = self.pyramid is not None
+        return settings
 
-        if _category != category:
-            return self.data[img_id]['txt']
+    def find_wrong_indices(self, indices):
+        """Draw the wrong image, wrong caption and wrong embedding indices of one index or a whole
+        batch of indices. All three come from other classes; the result has shape indices.shape + (3,).
+        """
+        return self.negatives.sample(indices, 3)
 
-        return self.find_wrong_image(category)
+    def get_pyramid_images(self, index, sizes=PYRAMID_SIZES):
+        """Return the tensors of an example at every size of <sizes> from the image pyramid.
+        The same random horizontal flip is applied to every size, then pixels are scaled to [-1.0, 1.0]
+        like transforms.ToTensor followed by transforms.Normalize with mean and std 0.5.
+        """
+        flip = self.flip and np.random.random() < 0.5
+        images = []
+        for size in sizes:
+            image = self.pyramid.levels[self.pyramid.sizes.index(size)][index]
+            if flip:
+                image = image[:, ::-1]
+            image = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)
+            images.append(image.float().div_(127.5).sub_(1.0))
+        return images
+
+    @staticmethod
+    def load_classes(data_dir, dataset_name):
+        """Return the class id of every class name."""
+        classes = OrderedDict()
+        if dataset_name == 'birds':
+            class_file = os.path.join(data_dir, dataset_name, 'CUB_200_2011', 'classes.txt')
+            with open(class_file, 'rb') as f:
+                for line in f:
+                    (key, val) = line.split()
+                    classes[val.decode("utf-8")] = int(key)
+        elif dataset_name == 'flowers':
+            class_file = os.path.join(data_dir, dataset_name, 'classes.txt')
+            with open(class_file, 'rb') as f:
+                for i, line in enumerate(f):
+                    val = line.split()[0]
+                    classes[val.decode("utf-8")] = i+1
+        return classes
 
-    def load_bounding_box(self):
-        bbox_path = os.path.join(self.data_dir, self.dataset_name, 'CUB_200_2011/bounding_boxes.txt')
+    @staticmethod
+    def load_bounding_box(data_dir, dataset_name):
+        bbox_path = os.path.join(data_dir, dataset_name, 'CUB_200_2011/bounding_boxes.txt')
         df_bounding_boxes = pd.read_csv(bbox_path,
                                         delim_whitespace=True,
                                         header=None).astype(int)
         #
-        filepath = os.path.join(self.data_dir, self.dataset_name, 'CUB_200_2011/images.txt')
+        filepath = os.path.join(data_dir, dataset_name, 'CUB_200_2011/images.txt')
         df_filenames = \
             pd.read_csv(filepath, delim_whitespace=True, header=None)
-        filenames = df_filenames[1].tolist()
-
-        # processing filenames to match data example name
-        for i in range(len(filenames)):
-            filename = filenames[i][:-4]
-            filename = filename.split('/')
-            filename = filename[1]
-            filenames[i] = filename
+        # processing filenames to match data example name, <class>/<name>.jpg to <name>
+        filenames = df_filenames[1].str.split('/').str[1].str[:-4].tolist()
         print('Total filenames: ', len(filenames), filenames[0])
-        #
-        filename_bbox = {img_file: [] for img_file in filenames}
-        numImgs = len(filenames)
-        for i in range(numImgs):
-            # bbox = [x-left, y-top, width, height]
-            bbox = df_bounding_boxes.iloc[i][1:].tolist()
-
-            key = filenames[i]
-            filename_bbox[key] = bbox
-        #
-        return filename_bbox
+        # bbox = [x-left, y-top, width, height]
+        return dict(zip(filenames, df_bounding_boxes.values[:, 1:].tolist()))
 
-    def crop_image(self, image, bbox):
+    @staticmethod
+    def crop_image(image, bbox):
         width, height = image.size
         r = int(np.maximum(bbox[2], bbox[3]) * 0.75)
         center_x = int((2 * bbox[0] + bbox[2]) / 2)
@@ -0,0 +1,66 @@
+import os
+import h5py
+from multiprocessing.util import Finalize
+
+# default raw data chunk cache of every opened file, see H5Pset_chunk_cache
+H5_CACHE_BYTES = 32 * 1024 ** 2
+H5_CACHE_SLOTS = 10007
+
+
+class LazyH5File(object):
+    """Read-only h5py file that is opened on first access, separately in every process.
+    h5py handles must not cross a fork, so the handle is dropped when the object is pickled
+    or used from another process (e.g. a DataLoader worker), which then opens its own copy.
+    Handles opened in a worker are closed when the worker exits.
+    """
+    def __init__(self, path, rdcc_nbytes=H5_CACHE_BYTES, rdcc_nslots=H5_CACHE_SLOTS, rdcc_w0=0.75):
+        """
+            @:param path (string): path of the hdf5 file
+            @:param rdcc_nbytes (int): size in bytes of the chunk cache of every dataset
+            @:param rdcc_nslots (int): number of hash table slots of the chunk cache, preferably a prime
+            @:param rdcc_w0 (float): chunk preemption policy, 1.0 evicts fully read chunks first
+        """
+        self.path = path
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        self.rdcc_w0 = rdcc_w0
+        self._file = None
+        self._groups = {}
+        self._pid = None
+
+    @property
+    def file(self):
+        if self._file is None or self._pid != os.getpid():
+            # a handle inherited from the parent process is dropped, never closed from here
+            self._file = h5py.File(self.path, mode='r', rdcc_nbytes=self.rdcc_nbytes,
+                                   rdcc_nslots=self.rdcc_nslots, rdcc_w0=self.rdcc_w0)
+            self._groups = {}
+            self._pid = os.getpid()
+            # run at garbage collection or when the (worker) process exits
+            Finalize(self, LazyH5File._close_file, args=(self._file,), exitpriority=10)
+        return self._file
+
+    def __getitem__(self, key):
+        handle = self.file
+        if key not in self._groups:
+            self._groups[key] = handle[key]
+        return self._groups[key]
+
+    def close(self):
+        if self._file is not None and self._pid == os.getpid():
+            self._close_file(self._file)
+        self._file = None
+        self._groups = {}
+        self._pid = None
+
+    @staticmethod
+    def _close_file(handle):
+        if handle.id.valid:
+            handle.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_groups'] = {}
+        state['_pid'] = None
+        return state
@@ -0,0 +1,35 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Dict of at most <capacity> entries, evicting the least recently used one.
+    Used as a per process cache: a cache created before the DataLoader workers are forked is
+    copied in every worker, which then fills its own copy.
+    """
+    def __init__(self, capacity):
+        """
+            @:param capacity (int): maximum number of entries
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the value of <key>, None if it is not cached."""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
@@ -0,0 +1,43 @@
+import io
+import math
+from PIL import Image
+
+# smallest ratio between a side of the decoded (and cropped) image and the size it is resized to, so that a COCO
+# image of 640x480 resized to 256x256 is decoded at 320x240; the resized images stay within about 1/255 of the
+# full resolution ones on average, see benchmarks/decode_benchmark.py
+DRAFT_MIN_RATIO = 0.9
+
+
+def decode_image(source, size=None, crop_box=None, min_ratio=DRAFT_MIN_RATIO):
+    """Decode an image to RGB. When it is only resized to <size> afterwards, a JPEG is downscaled by 2, 4 or 8
+    while it is decoded (in the DCT domain, see PIL.Image.draft), as long as both sides of the image, or of its
+    crop box, stay close to <size>. The crop box is then applied in the coordinates of the downscaled image.
+        @:param source (string, bytes or file object): image file
+        @:param size (int): largest size the image is resized to; None to decode it at full resolution
+        @:param crop_box (list): [x1, y1, x2, y2] crop of the full resolution image
+        @:param min_ratio (float): smallest ratio between a side of the decoded crop and <size>
+        @:return the decoded and cropped PIL image
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    image = Image.open(source)
+    full_width, full_height = image.size
+    if crop_box is None:
+        crop_width, crop_height = full_width, full_height
+    else:
+        crop_width, crop_height = crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]
+
+    if size is not None and image.format == 'JPEG' and crop_width > 0 and crop_height > 0:
+        # size of the full image for which the crop is min_ratio * size, draft keeps the image at least that large
+        min_size = size * min_ratio
+        image.draft('RGB', (int(math.ceil(full_width * min_size / crop_width)),
+                            int(math.ceil(full_height * min_size / crop_height))))
+    image = image.convert('RGB')
+
+    if crop_box is not None:
+        # the decoded sides are the full ones divided by the scale, rounded up
+        scale = int(round(float(full_width) / image.size[0]))
+        if scale > 1:
+            crop_box = [int(math.floor(float(coordinate) / scale + 0.5)) for coordinate in crop_box]
+        image = image.crop(crop_box)
+    return image
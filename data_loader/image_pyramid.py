@@ -0,0 +1,115 @@
+import os
+import io
+import argparse
+import h5py
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+
+PYRAMID_SIZES = (32, 64, 128, 256)
+
+
+def pyramid_file(data_dir, dataset_name, which_set, size):
+    return os.path.join(data_dir, dataset_name, 'pyramid', '{}_{}.npy'.format(which_set, size))
+
+
+class ImagePyramid(object):
+    """Read-only view of the preprocessed image pyramid of one split.
+    Every resolution is a memory-mapped uint8 array of shape (N, size, size, 3),
+    row i holding the cropped and resized image of example i of the split.
+    """
+    def __init__(self, data_dir, dataset_name, which_set, sizes=PYRAMID_SIZES):
+        self.sizes = sizes
+        self.files = [pyramid_file(data_dir, dataset_name, which_set, size) for size in sizes]
+        self.levels = None
+
+    def exists(self):
+        return all(os.path.exists(path) for path in self.files)
+
+    def load(self):
+        if not self.exists():
+            raise ValueError("image pyramid not found, build it with python -m data_loader.image_pyramid")
+        self.levels = [np.load(path, mmap_mode='r') for path in self.files]
+        return self
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def __getitem__(self, index):
+        """Return the uint8 HWC arrays of example <index>, one per size."""
+        return [level[index] for level in self.levels]
+
+
+# per worker state of the pyramid builder, set by <_init_builder>
+_builder = {}
+
+
+def _init_builder(h5_file, which_set, img_ids, bbox, out_files, sizes):
+    from data_loader.datasets_custom import TextImageDataset
+    # every worker opens its own handles, h5py files must not be shared across processes
+    _builder['data'] = h5py.File(h5_file, mode='r')[which_set]
+    _builder['img_ids'] = img_ids
+    _builder['bbox'] = bbox
+    _builder['crop_image'] = TextImageDataset.crop_image
+    _builder['levels'] = [np.load(path, mmap_mode='r+') for path in out_files]
+    _builder['sizes'] = sizes
+
+
+def _build_range(index_range):
+    data = _builder['data']
+    start, end = index_range
+    for index in range(start, end):
+        example = data[_builder['img_ids'][index]]
+        image = Image.open(io.BytesIO(bytes(np.array(example['img'])))).convert("RGB")
+        if _builder['bbox'] is not None:
+            image = _builder['crop_image'](image, _builder['bbox'][str(np.array(example['name']))])
+        for level, size in zip(_builder['levels'], _builder['sizes']):
+            level[index] = np.asarray(image.resize((size, size)), dtype=np.uint8)
+    for level in _builder['levels']:
+        level.flush()
+    return end - start
+
+
+def build_image_pyramid(data_dir, dataset_name, which_set, sizes=PYRAMID_SIZES, num_workers=None, chunk_size=256):
+    """Decode, crop and resize every image of a split once, writing one uint8 array per size."""
+    from data_loader.datasets_custom import TextImageDataset
+
+    h5_file = os.path.join(data_dir, '{}/{}.hdf5'.format(dataset_name, dataset_name))
+    with h5py.File(h5_file, mode='r') as f:
+        img_ids = [str(k) for k in f[which_set].keys()]
+    bbox = TextImageDataset.load_bounding_box(data_dir, dataset_name) if dataset_name == 'birds' else None
+
+    out_files = [pyramid_file(data_dir, dataset_name, which_set, size) for size in sizes]
+    tmp_files = [path[:-len('.npy')] + '.tmp.npy' for path in out_files]
+    out_dir = os.path.dirname(out_files[0])
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for path, size in zip(tmp_files, sizes):
+        np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(len(img_ids), size, size, 3))
+
+    ranges = [(start, min(start + chunk_size, len(img_ids))) for start in range(0, len(img_ids), chunk_size)]
+    pool = Pool(num_workers, initializer=_init_builder,
+                initargs=(h5_file, which_set, img_ids, bbox, tmp_files, sizes))
+    try:
+        done = 0
+        for n in pool.imap_unordered(_build_range, ranges):
+            done += n
+            print("[{}/{}] {} {} images processed".format(done, len(img_ids), dataset_name, which_set))
+    finally:
+        pool.close()
+        pool.join()
+
+    for tmp_path, path in zip(tmp_files, out_files):
+        os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the memory-mapped image pyramid of birds / flowers')
+    parser.add_argument('--data_dir', type=str, default='data/', help='main directory of datasets')
+    parser.add_argument('--dataset_name', type=str, default='birds', help='[birds | flowers]')
+    parser.add_argument('--which_set', type=str, nargs='+', default=['train', 'valid', 'test'], help='splits to process')
+    parser.add_argument('--num_workers', type=int, default=None, help='# processes, default to the number of cpus')
+    args = parser.parse_args()
+
+    for which_set in args.which_set:
+        build_image_pyramid(args.data_dir, args.dataset_name, which_set, num_workers=args.num_workers)
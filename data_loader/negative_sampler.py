@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class NegativeSampler(object):
+    """Draw examples whose label differs from the label of a given example, in constant time.
+    Example indices are grouped by label once; a mismatched example is then drawn uniformly
+    from the indices before and after the group of the query, without any rejection loop.
+    """
+    def __init__(self, labels):
+        """
+            @:param labels (array like): label of every example, e.g. its class or image id
+        """
+        labels = np.asarray(labels)
+        self.n_samples = len(labels)
+        # example indices sorted so that every label forms one contiguous group
+        self.order = np.argsort(labels, kind='mergesort')
+        unique_labels, group_starts, group_sizes = np.unique(labels[self.order], return_index=True, return_counts=True)
+        assert len(unique_labels) > 1, "need at least two different labels to draw negatives"
+
+        # start and size of the label group of every example
+        groups = np.searchsorted(unique_labels, labels)
+        self.group_start = group_starts[groups]
+        self.group_size = group_sizes[groups]
+
+    def sample(self, indices, size=None):
+        """Return negatives of <indices> (an int or an array of example indices).
+        The result has the shape of <indices>, with a trailing dimension of <size> if given;
+        every negative is drawn independently.
+        """
+        indices = np.asarray(indices)
+        start = self.group_start[indices]
+        group_size = self.group_size[indices]
+        shape = indices.shape
+        if size is not None:
+            shape = shape + (size,)
+            start = start[..., None]
+            group_size = group_size[..., None]
+
+        # position among the examples of the other labels, then skip over the group of the query
+        position = (np.random.random_sample(shape) * (self.n_samples - group_size)).astype(np.int64)
+        position += group_size * (position >= start)
+        return self.order[position]
@@ -0,0 +1,117 @@
+import time
+import threading
+import torch
+from queue import Queue, Full
+
+
+class _EndOfEpoch(object):
+    pass
+
+
+class _LoaderError(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class DataPrefetcher(object):
+    """Iterate over a data loader while a background thread keeps the next <n_batches> batches ready.
+    On a CUDA device the batches are pinned and copied to the device on a side stream, so the trainers
+    receive tensors already on the device; on a CPU the thread overlaps loading, collating and
+    unpacking with the training step.
+    The time the training loop waited for data and the time spent producing the batches are
+    accumulated in <wait_time> and <load_time>, see <report>.
+    """
+    def __init__(self, data_loader, device, n_batches=2):
+        """
+            @:param data_loader (DataLoader): loader of the batches, dicts of tensors and lists
+            @:param device (torch.device): device the tensors are copied to
+            @:param n_batches (int): number of batches loaded ahead
+        """
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.n_batches = n_batches
+        self.use_cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def reset_stats(self):
+        self.wait_time = 0.0
+        self.load_time = 0.0
+        self.n_served = 0
+
+    def report(self):
+        """Summary of the data waiting time of the batches served since <reset_stats>."""
+        n_served = max(self.n_served, 1)
+        hidden = max(self.load_time - self.wait_time, 0.0)
+        return 'data: %.1f ms/batch to load, %.1f ms/batch waited, %.1f%% of the loading time hidden' % (
+            1000 * self.load_time / n_served, 1000 * self.wait_time / n_served,
+            100 * hidden / max(self.load_time, 1e-12))
+
+    def stage(self, batch):
+        """Start the copy of the tensors of <batch> to the device, return the batch and the event of the copy."""
+        if not self.use_cuda:
+            return batch, None
+        staged = {}
+        with torch.cuda.stream(self.stream):
+            for key, value in batch.items():
+                if torch.is_tensor(value):
+                    value = value.pin_memory().to(self.device, non_blocking=True)
+                staged[key] = value
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return staged, event
+
+    def _produce(self, queue, stop):
+        def put(item):
+            # give up when the consumer stopped iterating
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        try:
+            start = time.time()
+            for batch in self.data_loader:
+                staged = self.stage(batch)
+                self.load_time += time.time() - start
+                if not put(staged):
+                    return
+                start = time.time()
+            put(_EndOfEpoch())
+        except Exception as error:
+            put(_LoaderError(error))
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.n_batches)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(queue, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                item = queue.get()
+                self.wait_time += time.time() - start
+                if isinstance(item, _EndOfEpoch):
+                    return
+                if isinstance(item, _LoaderError):
+                    raise item.error
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    # the memory of the copies must not be reused while the training stream uses it
+                    for value in batch.values():
+                        if torch.is_tensor(value):
+                            value.record_stream(current_stream)
+                self.n_served += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
@@ -0,0 +1,248 @@
+import numpy as np
+from torch.utils.data.sampler import Sampler
+from base import load_sampler_state
+
+
+class EpochBatchSampler(Sampler):
+    """Batch sampler making the batches of a whole epoch at once, with <_make_batches>.
+    The state of an epoch can be saved and restored like base.ResumableRandomSampler.
+    """
+    state_keys = ('batches', 'rng')
+
+    def __init__(self, seed=None):
+        self.rng = np.random.RandomState(seed)
+        # batches of the current epoch, or of the next one when made in advance by __len__
+        self._batches = None
+        self._fresh = False
+
+    def _make_batches(self):
+        """Return the list of the batches of a new epoch, arrays of indices."""
+        raise NotImplementedError
+
+    def __iter__(self):
+        if not self._fresh:
+            self._batches = self._make_batches()
+        self._fresh = False
+        batches = self._batches
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self._batches is None:
+            self._batches = self._make_batches()
+            self._fresh = True
+        return len(self._batches)
+
+    def state_dict(self, position):
+        """State of the current epoch, <position> batches of which have been consumed."""
+        return {'batches': self._batches[position:], 'rng': self.rng.get_state()}
+
+    def load_state_dict(self, state):
+        self._batches = state['batches']
+        self.rng.set_state(state['rng'])
+        self._fresh = True
+
+
+class BucketBatchSampler(EpochBatchSampler):
+    """Batch sampler grouping captions of similar length to reduce padding.
+    Every epoch the examples are shuffled and cut into buckets of <bucket_size> batches; each bucket
+    is sorted by caption length and split into batches, and the order of the batches is shuffled.
+    Batches hold <batch_size> examples, or if <max_tokens> is set, as many examples as fit in
+    a budget of <max_tokens> padded tokens (capped at <batch_size>).
+    The state of an epoch can be saved and restored like base.ResumableRandomSampler.
+    """
+    def __init__(self, lengths, batch_size, max_tokens=None, indices=None, bucket_size=100, shuffle=True, drop_last=False,
+                 seed=None):
+        """
+            @:param lengths (array like): caption length of every example of the dataset, without start and end words
+            @:param batch_size (int): number of examples per batch, the maximum one with <max_tokens>
+            @:param max_tokens (int): padded tokens per batch, batch_size * longest caption of the batch
+            @:param indices (array like): subset of examples to sample from, all examples if None
+            @:param bucket_size (int): number of batches sorted together
+            @:param shuffle (bool): shuffle the examples and the batches every epoch
+            @:param drop_last (bool): drop the batches with less than <batch_size> examples (fixed size batches only)
+            @:param seed (int): seed of the random stream
+        """
+        # captions are padded with the start and end words
+        self.lengths = np.asarray(lengths) + 2
+        self.indices = np.arange(len(self.lengths)) if indices is None else np.asarray(indices)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        super(BucketBatchSampler, self).__init__(seed)
+
+    def _split_bucket(self, bucket):
+        if self.max_tokens is None:
+            return [bucket[start:start + self.batch_size] for start in range(0, len(bucket), self.batch_size)]
+
+        # the bucket is sorted by increasing length, the padded length of a batch is the one of its last example
+        batches, start = [], 0
+        for end in range(2, len(bucket) + 1):
+            size = end - start
+            if size > self.batch_size or size * self.lengths[bucket[end - 1]] > self.max_tokens:
+                batches.append(bucket[start:end - 1])
+                start = end - 1
+        batches.append(bucket[start:])
+        return batches
+
+    def _make_batches(self):
+        indices = self.rng.permutation(self.indices) if self.shuffle else self.indices
+        bucket_len = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), bucket_len):
+            bucket = indices[start:start + bucket_len]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='mergesort')]
+            batches.extend(self._split_bucket(bucket))
+
+        if self.drop_last and self.max_tokens is None:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        return batches
+
+
+class ImageGroupedBatchSampler(EpochBatchSampler):
+    """Batch sampler of COCO captions decoding every image once per epoch.
+    Every epoch the images are shuffled and dealt to <num_workers> streams, one per DataLoader worker. A stream
+    takes its images <batch_size> at a time and deals their captions over consecutive batches of its own, so that
+    a batch holds captions of different images. The streams are interleaved batch by batch, as the DataLoader
+    hands batches to its workers in turn, so all the captions of an image are loaded by the same worker
+    while its decoded image is still in the worker cache, see COCOTextImageDataset.image_cache.
+    The state of an epoch can be saved and restored like base.ResumableRandomSampler.
+    """
+    def __init__(self, image_rows, batch_size, num_workers=0, indices=None, shuffle=True, seed=None):
+        """
+            @:param image_rows (array like): image of every example of the dataset
+            @:param batch_size (int): number of examples per batch
+            @:param num_workers (int): number of DataLoader workers
+            @:param indices (array like): subset of examples to sample from, all examples if None
+            @:param shuffle (bool): shuffle the images every epoch
+            @:param seed (int): seed of the random stream
+        """
+        image_rows = np.asarray(image_rows)
+        indices = np.arange(len(image_rows)) if indices is None else np.asarray(indices)
+        # examples grouped by image
+        indices = indices[np.argsort(image_rows[indices], kind='mergesort')]
+        _, starts = np.unique(image_rows[indices], return_index=True)
+        self.groups = np.split(indices, starts[1:])
+        self.batch_size = batch_size
+        self.num_streams = max(num_workers, 1)
+        self.shuffle = shuffle
+        super(ImageGroupedBatchSampler, self).__init__(seed)
+
+    def _stream_batches(self, groups):
+        batches = []
+        for start in range(0, len(groups), self.batch_size):
+            captions = np.concatenate(groups[start:start + self.batch_size])
+            # caption t of the chunk goes to batch t % n_batches: the batches have the same size give or take one,
+            # and the captions of an image are in different batches unless it has more captions than there are batches
+            n_batches = (len(captions) + self.batch_size - 1) // self.batch_size
+            batches.extend(captions[i::n_batches] for i in range(n_batches))
+        return batches
+
+    def _make_batches(self):
+        order = self.rng.permutation(len(self.groups)) if self.shuffle else np.arange(len(self.groups))
+        groups = [self.groups[i] for i in order]
+        streams = [self._stream_batches(groups[stream::self.num_streams]) for stream in range(self.num_streams)]
+        batches = []
+        for position in range(max(len(stream) for stream in streams)):
+            batches.extend(stream[position] for stream in streams if position < len(stream))
+        return batches
+
+
+class StreamingBatchSampler(Sampler):
+    """Batch sampler chaining the epochs of an epoch sampler into one stream of batches, so that a DataLoader is
+    iterated once for the whole training: its workers are started once and keep loading ahead across the epoch
+    boundaries. The epoch of the n-th batch of the stream is given by <position>.
+    The epoch sampler is either a sampler of examples, cut into batches of <batch_size> whose incomplete last batch
+    of every epoch is dropped with <drop_last>, or a batch sampler whose batches are kept as they are.
+    The stream is checkpointed with <state_dict> and resumed with <load_state_dict>, which requires a resumable
+    epoch sampler, see base.ResumableRandomSampler and EpochBatchSampler.
+    """
+    state_keys = ('stream',)
+
+    def __init__(self, sampler, batch_size=None, drop_last=True, n_epochs=None):
+        """
+            @:param sampler (Sampler): sampler of the examples, or batch sampler if <batch_size> is None
+            @:param batch_size (int): number of examples per batch of a sampler of examples
+            @:param drop_last (bool): drop the incomplete last batch of the epochs of a sampler of examples
+            @:param n_epochs (int): number of epochs of the stream, None for an endless stream
+        """
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.n_epochs = n_epochs
+        # [first batch of the stream, epoch, batches skipped, state of the epoch sampler] of the epochs started
+        self.epochs = []
+        # batches of the first epoch skipped when resuming
+        self._skip = 0
+
+    def epoch_batches(self):
+        if self.batch_size is None:
+            for batch in self.sampler:
+                yield batch
+            return
+        batch = []
+        for index in self.sampler:
+            batch.append(index)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch and not self.drop_last:
+            yield batch
+
+    def __iter__(self):
+        epoch, skip = 0, self._skip
+        self._skip = 0
+        self.epochs = []
+        n_batches = 0
+        while self.n_epochs is None or epoch < self.n_epochs:
+            batches = self.epoch_batches()
+            for position, batch in enumerate(batches):
+                if position == 0:
+                    # the epoch sampler has made its epoch, its state is the one of the start of the epoch
+                    state = self.sampler.state_dict(0) if hasattr(self.sampler, 'state_dict') else None
+                    self.epochs.append([n_batches, epoch, skip, state])
+                if position < skip:
+                    continue
+                n_batches += 1
+                yield batch
+            epoch += 1
+            skip = 0
+
+    def __len__(self):
+        """Number of batches of an epoch."""
+        if self.batch_size is None:
+            return len(self.sampler)
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def _epoch_of(self, n):
+        """Entry of <epochs> of the n-th batch of the stream; the entries of the epochs before are dropped, the
+        batches being consumed in order."""
+        while len(self.epochs) > 1 and self.epochs[1][0] <= n:
+            self.epochs.pop(0)
+        return self.epochs[0]
+
+    def position(self, n):
+        """Return the epoch (counted from the start of the stream, or from the resumed epoch) of the n-th batch
+        of the stream, and the position of the batch in its epoch."""
+        first_batch, epoch, skip, state = self._epoch_of(n)
+        return epoch, skip + n - first_batch
+
+    def state_dict(self, batches_done):
+        """State of the stream, <batches_done> batches of which have been consumed. The stream resumes in the
+        epoch of the last consumed batch, which is empty if that batch was its last one."""
+        first_batch, epoch, skip, state = self._epoch_of(batches_done - 1)
+        assert state is not None, "the epoch sampler of the stream cannot be resumed"
+        return {'stream': {'epoch': epoch, 'skip': skip + batches_done - first_batch, 'batch_size': self.batch_size,
+                           'sampler': state}}
+
+    def load_state_dict(self, state):
+        """Restore a state of <state_dict>; the epochs of the stream, <n_epochs> included, are then counted from
+        the resumed epoch."""
+        load_sampler_state(self.sampler, state['stream']['sampler'])
+        self._skip = state['stream']['skip']
@@ -0,0 +1,119 @@
+import os
+import shutil
+import fcntl
+import tempfile
+import numpy as np
+from multiprocessing.util import Finalize
+
+# default directory of the caches, a RAM backed file system on linux
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+class SharedImageCache(object):
+    """Cache of decoded (size, size, 3) uint8 images shared by all the processes loading a dataset, e.g. the
+    DataLoader workers of every epoch. The images live in memory-mapped files of <SHM_DIR>, with at most
+    <budget_bytes> of images: every image is written by the first process that decodes it, and once the cache is
+    full, slots are recycled with the clock (second chance) policy.
+    The files are created by the process building the cache and removed when it exits; the other processes map
+    them on first access. Readers hold a shared lock and writers an exclusive one, so an image is never read
+    while it is being replaced.
+    """
+    def __init__(self, n_images, size, budget_bytes, name='images', cache_dir=SHM_DIR):
+        """
+            @:param n_images (int): number of images of the dataset, numbered from 0
+            @:param size (int): size of the cached images
+            @:param budget_bytes (int): memory of the cached images
+            @:param name (string): prefix of the cache directory
+            @:param cache_dir (string): where the cache directory is created
+        """
+        self.n_images = n_images
+        self.size = size
+        self.n_slots = int(min(n_images, budget_bytes // (size * size * 3)))
+        assert self.n_slots > 0, "the shared image cache budget is smaller than one image"
+        self.path = tempfile.mkdtemp(prefix='{}_{}_'.format(name, size), dir=cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+        np.lib.format.open_memmap(self.file('images'), mode='w+', dtype=np.uint8, shape=(self.n_slots, size, size, 3))
+        # slot of every image and image of every slot, -1 when there is none
+        np.save(self.file('slots'), np.full(n_images, -1, dtype=np.int32))
+        np.save(self.file('owners'), np.full(self.n_slots, -1, dtype=np.int32))
+        # reference bits of the clock policy, and the [clock hand, # used slots]
+        np.save(self.file('references'), np.zeros(self.n_slots, dtype=np.uint8))
+        np.save(self.file('clock'), np.zeros(2, dtype=np.int64))
+        open(self.file('lock'), 'w').close()
+        Finalize(self, shutil.rmtree, args=(self.path, True), exitpriority=0)
+
+        self._pid = None
+        self._lock = None
+        self._arrays = None
+
+    def file(self, name):
+        return os.path.join(self.path, name + ('' if name == 'lock' else '.npy'))
+
+    def arrays(self):
+        """Memory maps of the cache files and lock file of the current process."""
+        if self._pid != os.getpid():
+            # the lock of another process must not be shared, flock locks belong to the opened file
+            self._lock = open(self.file('lock'), 'r')
+            self._arrays = {name: np.load(self.file(name), mmap_mode='r+')
+                            for name in ('images', 'slots', 'owners', 'references', 'clock')}
+            self._pid = os.getpid()
+            Finalize(self, SharedImageCache._close_lock, args=(self._lock,), exitpriority=10)
+        return self._arrays
+
+    @staticmethod
+    def _close_lock(lock):
+        lock.close()
+
+    def __len__(self):
+        return int(np.count_nonzero(self.arrays()['owners'] >= 0))
+
+    def get(self, index):
+        """Return a copy of cached image <index>, None if it is not cached."""
+        arrays = self.arrays()
+        fcntl.flock(self._lock, fcntl.LOCK_SH)
+        try:
+            slot = arrays['slots'][index]
+            if slot < 0:
+                self.misses += 1
+                return None
+            image = np.array(arrays['images'][slot])
+            arrays['references'][slot] = 1
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self.hits += 1
+        return image
+
+    def put(self, index, image):
+        """Cache image <index>, a (size, size, 3) uint8 array, unless another process already did."""
+        arrays = self.arrays()
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            if arrays['slots'][index] >= 0:
+                return
+            slots, owners, references, clock = arrays['slots'], arrays['owners'], arrays['references'], arrays['clock']
+            if clock[1] < self.n_slots:
+                slot = clock[1]
+                clock[1] += 1
+            else:
+                # second chance: skip and clear the slots read since the hand last passed
+                while references[clock[0]]:
+                    references[clock[0]] = 0
+                    clock[0] = (clock[0] + 1) % self.n_slots
+                slot = clock[0]
+                clock[0] = (clock[0] + 1) % self.n_slots
+                slots[owners[slot]] = -1
+            arrays['images'][slot] = image
+            owners[slot] = index
+            slots[index] = slot
+            references[slot] = 1
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_lock'] = None
+        state['_arrays'] = None
+        return state
@@ -47,6 +47,12 @@ def get_option_setter(model_name):
     return model_class.modify_commandline_options
 
 
+def get_sample_fields(model_name):
+    """Return the batch fields consumed by the model class, see <BaseTrainer.sample_fields>."""
+    model_class = find_model_using_name(model_name)
+    return model_class.sample_fields
+
+
 def create_model(opt):
     """Create a model given the option.
     This function warps the class CustomDatasetDataLoader.
@@ -159,6 +159,18 @@ def define_D(opt, init_type='normal', init_gain=0.02, gpu_ids=[]):
         raise NotImplementedError('Discriminator model name [%s] is not recognized' % net)
 
 
+def damsm_checkpoint(dataset_name):
+    """Return the path of the pre-trained DAMSM checkpoint of a dataset: birds | flowers | CoCo"""
+    if "d" in dataset_name:  # birds
+        return birds_damsm
+    elif "r" in dataset_name: # flowers
+        return flowers_damsm
+    elif "C" in dataset_name: # coco
+        return coco_damsm
+    else:
+        raise ValueError("cannot find corresponding damsm model path")
+
+
 def define_DAMSM(opt, gpu_ids=[]):
     """
     Create Pre-trained DAMSM rnn encoder and cnn encoder
@@ -190,14 +202,7 @@ def define_DAMSM(opt, gpu_ids=[]):
         rnn_encoder.to(device)
         cnn_encoder.to(device)
 
-    if "d" in opt.dataset_name:  # birds
-        resume_path = birds_damsm
-    elif "r" in opt.dataset_name: # flowers
-        resume_path = flowers_damsm
-    elif "C" in opt.dataset_name: # coco
-        resume_path = coco_damsm
-    else:
-        raise ValueError("cannot find corresponding damsm model path")
+    resume_path = damsm_checkpoint(opt.dataset_name)
     checkpoint = torch.load(resume_path, map_location=device)
 
     rnn_encoder.load_state_dict(checkpoint["rnn_state_dict"])
@@ -1,2 +1,3 @@
 from .train_options import *
-from .test_options import *
\ No newline at end of file
+from .test_options import *
+from .autotune_options import *
\ No newline at end of file
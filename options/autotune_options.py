@@ -0,0 +1,20 @@
+from .train_options import TrainOptions
+
+
+class AutotuneOptions(TrainOptions):
+    """This class includes the options of autotune.py.
+    It also includes the training options, the data loader and model being calibrated are the training ones.
+    """
+
+    def initialize(self, parser):
+        parser = TrainOptions.initialize(self, parser)
+        parser.add_argument('--autotune_batches', type=int, default=20, help='# training steps timed per calibration pass')
+        parser.add_argument('--autotune_warmup', type=int, default=3, help='# training steps of every calibration pass before the timing starts')
+        parser.add_argument('--autotune_workers', type=int, nargs='+', default=[], help='num_workers values tried, by default 0, 1, 2, 4, ... up to the number of cpus')
+        parser.add_argument('--autotune_prefetch_factors', type=int, nargs='+', default=[2, 4, 8], help='prefetch_factor values tried, with torch >= 1.7')
+        parser.add_argument('--autotune_prefetch_batches', type=int, nargs='+', default=[0, 2, 4], help='prefetch_batches values tried')
+        parser.add_argument('--autotune_threads', type=int, nargs='+', default=[], help='num_threads values tried on a cpu, by default 1, 2, 4, ... up to the number of cpus')
+        parser.add_argument('--autotune_batch_sizes', type=int, nargs='+', default=[], help='batch_size values tried, by default only --batch_size')
+        parser.add_argument('--autotune_tolerance', type=float, default=0.05, help='keep the cheapest value within this fraction of the best throughput')
+        parser.add_argument('--autotune_out', type=str, default='', help='options file the best settings are written to, by default --options_file or [checkpoints_dir]/[exp_name]/loader_options.json')
+        return parser
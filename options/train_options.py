@@ -29,6 +29,7 @@ class TrainOptions(BaseOptions):
         # training parameters
         parser.add_argument('--epochs', type=int, default=100, help='# of epochs at starting learning rate')
         parser.add_argument('--nepoch_decay', type=int, default=10, help='# of epochs to linearly decay learning rate to zero')
+        parser.add_argument('--streaming', action='store_true', help='iterate over all the epochs with one DataLoader iterator, the workers keep loading across the epoch boundaries and the incomplete last batch of an epoch is dropped by the sampler')
         parser.add_argument('--beta_1', type=float, default=0.5, help='momentum term of adam')
         parser.add_argument('--g_lr', type=float, default=0.0002, help='initial generator learning rate for adam')
         parser.add_argument('--d_lr', type=float, default=0.0004, help='initial discriminator learning rate for adam')
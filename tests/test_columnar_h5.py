@@ -0,0 +1,70 @@
+import h5py
+import numpy as np
+import pytest
+from data_loader.columnar_h5 import ColumnarH5Reader, _pack_bytes
+
+N_EXAMPLES = 12
+
+
+def write_columnar(path, which_set='train'):
+    """Columnar file of <N_EXAMPLES> examples of different sizes, see convert_to_columnar."""
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, size=rng.randint(1, 200)).astype(np.uint8).tobytes() for _ in range(N_EXAMPLES)]
+    captions = [u'caption {} of the bird n°{}'.format('x' * i, i).encode('utf-8') for i in range(N_EXAMPLES)]
+    embeddings = rng.randn(N_EXAMPLES, 5, 8).astype(np.float32)
+    with h5py.File(path, mode='w') as target:
+        group = target.create_group(which_set)
+        group.create_dataset('img_ids', data=np.array(['id_{}'.format(i).encode('utf-8') for i in range(N_EXAMPLES)]))
+        group.create_dataset('names', data=np.array(['name_{}'.format(i).encode('utf-8') for i in range(N_EXAMPLES)]))
+        group.create_dataset('classes', data=np.array(['class_{}'.format(i % 3).encode('utf-8')
+                                                       for i in range(N_EXAMPLES)]))
+        group.create_dataset('class_ids', data=np.arange(N_EXAMPLES, dtype=np.int32) % 3)
+        group.create_dataset('embeddings', data=embeddings)
+        for column, chunks in (('img', images), ('txt', captions)):
+            values, offsets = _pack_bytes(chunks)
+            group.create_dataset(column + '_bytes', data=values, chunks=True)
+            group.create_dataset(column + '_offsets', data=offsets)
+    return images, [caption.decode('utf-8') for caption in captions], embeddings
+
+
+@pytest.fixture
+def columnar(tmp_path):
+    path = str(tmp_path / 'birds_columnar.hdf5')
+    images, captions, embeddings = write_columnar(path)
+    return ColumnarH5Reader(path, 'train'), images, captions, embeddings
+
+
+def test_reader_examples(columnar):
+    reader, images, captions, embeddings = columnar
+    assert len(reader) == N_EXAMPLES
+    for index in range(N_EXAMPLES):
+        assert reader.image_bytes(index) == images[index]
+        assert reader.txt(index) == captions[index]
+        np.testing.assert_array_equal(reader.embeddings(index), embeddings[index])
+
+
+@pytest.mark.parametrize('indices', [
+    [3, 4, 5, 6],
+    [9, 2, 7, 0, 11],
+    [5, 1, 5, 8, 1],
+    [11],
+    [],
+])
+@pytest.mark.parametrize('max_gap', [0, 50, 2 ** 20])
+def test_get_batch_keeps_order(columnar, indices, max_gap):
+    reader, images, captions, embeddings = columnar
+    batch = reader.get_batch(indices, max_gap=max_gap)
+    assert batch['img_id'] == ['id_{}'.format(i) for i in indices]
+    assert batch['name'] == ['name_{}'.format(i) for i in indices]
+    assert batch['class_id'].tolist() == [i % 3 for i in indices]
+    assert batch['img'] == [images[i] for i in indices]
+    assert batch['txt'] == [captions[i] for i in indices]
+    if indices:
+        np.testing.assert_array_equal(batch['embeddings'], embeddings[indices])
+
+
+def test_get_batch_columns(columnar):
+    reader, images, captions, embeddings = columnar
+    batch = reader.get_batch([4, 2], columns=('img', 'class_id'))
+    assert sorted(batch) == ['class_id', 'img']
+    assert batch['img'] == [images[4], images[2]]
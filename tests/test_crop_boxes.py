@@ -0,0 +1,46 @@
+import io
+import numpy as np
+from PIL import Image
+from data_loader.crop_boxes import compute_crop_boxes, build_crop_boxes
+from data_loader.datasets_custom import TextImageDataset
+
+
+def random_examples(n_examples, seed=0):
+    """Image sizes and [x-left, y-top, width, height] bounding boxes, some of them reaching the image borders."""
+    rng = np.random.RandomState(seed)
+    image_sizes = rng.randint(20, 120, size=(n_examples, 2))
+    bboxes = np.zeros((n_examples, 4), dtype=np.int64)
+    for i, (width, height) in enumerate(image_sizes):
+        bboxes[i, 0] = rng.randint(0, width)
+        bboxes[i, 1] = rng.randint(0, height)
+        bboxes[i, 2] = rng.randint(1, width - bboxes[i, 0] + 1)
+        bboxes[i, 3] = rng.randint(1, height - bboxes[i, 1] + 1)
+    return bboxes, image_sizes
+
+
+def test_crop_boxes_match_crop_image():
+    bboxes, image_sizes = random_examples(200)
+    crop_boxes = compute_crop_boxes(bboxes, image_sizes)
+    assert crop_boxes.shape == (200, 4) and crop_boxes.dtype == np.int32
+    for bbox, (width, height), crop_box in zip(bboxes.tolist(), image_sizes, crop_boxes):
+        # every pixel of the image is different, equal crops come from the same rectangle
+        pixels = np.arange(width * height, dtype=np.int32).reshape(height, width)
+        image = Image.fromarray(pixels)
+        expected = TextImageDataset.crop_image(image, bbox)
+        np.testing.assert_array_equal(np.array(image.crop(crop_box.tolist())), np.array(expected))
+
+
+def test_build_crop_boxes(tmp_path):
+    bboxes, image_sizes = random_examples(10, seed=1)
+    images = []
+    for width, height in image_sizes:
+        buffer = io.BytesIO()
+        Image.new('RGB', (int(width), int(height))).save(buffer, format='PNG')
+        images.append(buffer.getvalue())
+    names = ['image_{}'.format(i) for i in range(10)]
+    out_file = str(tmp_path / 'crop_boxes' / 'train.npy')
+
+    crop_boxes = build_crop_boxes(10, names.__getitem__, lambda indices: [images[i] for i in indices],
+                                  dict(zip(names, bboxes.tolist())), out_file, chunk_size=3)
+    np.testing.assert_array_equal(crop_boxes, compute_crop_boxes(bboxes, image_sizes))
+    np.testing.assert_array_equal(np.load(out_file), crop_boxes)
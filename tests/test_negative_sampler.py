@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from data_loader.negative_sampler import NegativeSampler
+
+# unsorted labels of groups of different sizes, one of a single example
+LABELS = np.array([3, 0, 3, 7, 0, 3, 1, 7, 3, 0, 3, 3])
+
+
+@pytest.mark.parametrize('labels', [LABELS, np.array(['b', 'a', 'c', 'a', 'b', 'b'])])
+def test_negatives_have_another_label(labels):
+    np.random.seed(0)
+    sampler = NegativeSampler(labels)
+    indices = np.arange(len(labels))
+    negatives = sampler.sample(indices, size=500)
+    assert negatives.shape == (len(labels), 500)
+    assert not np.any(labels[negatives] == labels[indices][:, None])
+
+
+def test_every_other_example_is_drawn():
+    np.random.seed(0)
+    sampler = NegativeSampler(LABELS)
+    for index in range(len(LABELS)):
+        drawn = set(sampler.sample(index, size=2000).tolist())
+        assert drawn == set(np.flatnonzero(LABELS != LABELS[index]).tolist())
+
+
+def test_sample_shapes():
+    sampler = NegativeSampler(LABELS)
+    negative = sampler.sample(0)
+    assert np.ndim(negative) == 0 and LABELS[negative] != LABELS[0]
+    assert sampler.sample(np.array([[0, 1], [2, 3]])).shape == (2, 2)
+    assert sampler.sample(np.array([[0, 1], [2, 3]]), size=4).shape == (2, 2, 4)
+
+
+def test_single_label():
+    with pytest.raises(AssertionError):
+        NegativeSampler([2, 2, 2])
@@ -0,0 +1,154 @@
+import pickle
+import numpy as np
+import pytest
+from torch.utils.data import DataLoader
+from base import ResumableRandomSampler, ResumableLoaderMixin
+from data_loader.samplers import BucketBatchSampler
+from data_loader.data_loaders import StreamingDataLoader
+
+N_SAMPLES = 23
+BATCH_SIZE = 4
+
+
+class ResumableLoader(ResumableLoaderMixin, DataLoader):
+    pass
+
+
+def checkpoint(state):
+    """The state as read back from a training state file, see BaseTrainer.save_training_state."""
+    return pickle.loads(pickle.dumps(state))
+
+
+def plain_loader(seed=0):
+    sampler = ResumableRandomSampler(np.arange(N_SAMPLES), seed=seed)
+    return ResumableLoader(list(range(N_SAMPLES)), batch_size=BATCH_SIZE, sampler=sampler)
+
+
+def bucket_loader(seed=0):
+    lengths = np.arange(N_SAMPLES) % 5 + 1
+    return ResumableLoader(list(range(N_SAMPLES)), batch_sampler=BucketBatchSampler(lengths, BATCH_SIZE, seed=seed))
+
+
+def epochs(loader, n_epochs):
+    return [[batch.tolist() for batch in loader] for _ in range(n_epochs)]
+
+
+def test_random_sampler_state_round_trip():
+    sampler = ResumableRandomSampler(np.arange(N_SAMPLES), seed=0)
+    first_epoch = list(sampler)
+    state = checkpoint(sampler.state_dict(7))
+    second_epoch = list(sampler)
+
+    resumed = ResumableRandomSampler(np.arange(N_SAMPLES), seed=1)
+    resumed.load_state_dict(state)
+    assert len(resumed) == N_SAMPLES - 7
+    assert list(resumed) == first_epoch[7:]
+    # the random stream continues, the next epoch is the one of the uninterrupted sampler
+    assert list(resumed) == second_epoch
+    assert len(resumed) == N_SAMPLES
+
+
+def test_random_sampler_resumed_twice():
+    sampler = ResumableRandomSampler(np.arange(N_SAMPLES), seed=0)
+    epoch = list(sampler)
+    resumed = ResumableRandomSampler(np.arange(N_SAMPLES))
+    resumed.load_state_dict(checkpoint(sampler.state_dict(5)))
+    iter(resumed)
+    # positions are counted from the start of the epoch, not of the resumed part
+    again = ResumableRandomSampler(np.arange(N_SAMPLES))
+    again.load_state_dict(checkpoint(resumed.state_dict(3)))
+    assert list(again) == epoch[8:]
+
+
+def test_sampler_without_shuffle_keeps_order():
+    sampler = ResumableRandomSampler(np.arange(N_SAMPLES), shuffle=False)
+    assert list(sampler) == list(range(N_SAMPLES))
+    resumed = ResumableRandomSampler(np.arange(N_SAMPLES), shuffle=False)
+    resumed.load_state_dict(checkpoint(sampler.state_dict(10)))
+    assert list(resumed) == list(range(10, N_SAMPLES))
+
+
+def test_loader_resumes_at_next_batch():
+    expected = epochs(plain_loader(), 2)
+    loader = plain_loader()
+    for n, _ in enumerate(loader):
+        if n == 2:
+            state = checkpoint(loader.state_dict(3))
+            break
+
+    resumed = plain_loader(seed=5)
+    resumed.load_state_dict(state)
+    assert epochs(resumed, 2) == [expected[0][3:], expected[1]]
+
+
+def test_bucket_loader_resumes_at_next_batch():
+    expected = epochs(bucket_loader(), 2)
+    assert sorted(sum(expected[0], [])) == list(range(N_SAMPLES))
+    loader = bucket_loader()
+    for n, _ in enumerate(loader):
+        if n == 1:
+            state = checkpoint(loader.state_dict(2))
+            break
+
+    resumed = bucket_loader(seed=5)
+    resumed.load_state_dict(state)
+    assert epochs(resumed, 2) == [expected[0][2:], expected[1]]
+
+
+def stream_state(make_loader, batches_done, n_epochs=2):
+    """State of a stream of the epochs of <make_loader>() after <batches_done> batches, with the batches that
+    follow in the uninterrupted stream, and the number of batches of its epochs."""
+    stream = StreamingDataLoader(make_loader(), n_epochs=n_epochs)
+    batches = [batch.tolist() for batch in stream]
+    stream = StreamingDataLoader(make_loader(), n_epochs=n_epochs)
+    for n, _ in enumerate(stream):
+        if n == batches_done - 1:
+            return checkpoint(stream.state_dict(batches_done)), batches[batches_done:], len(stream.batch_sampler)
+
+
+@pytest.mark.parametrize('make_loader', [plain_loader, bucket_loader])
+def test_stream_resumes_at_next_batch(make_loader):
+    state, expected, epoch_batches = stream_state(make_loader, 7)
+    resumed = StreamingDataLoader(make_loader(seed=5), n_epochs=2)
+    resumed.load_state_dict(state)
+    # the epochs of the resumed stream are counted from the resumed one, it runs one epoch longer
+    assert [batch.tolist() for batch in resumed][:len(expected)] == expected
+
+
+def test_stream_state_resumes_plain_loader():
+    state, expected, epoch_batches = stream_state(plain_loader, 7)
+    resumed = plain_loader(seed=5)
+    resumed.load_state_dict(state)
+    # the stream drops the incomplete last batch of the epoch, the plain loader keeps it
+    rest = epochs(resumed, 1)[0]
+    assert rest[:-1] == expected[:2 * epoch_batches - 7]
+    assert len(rest[-1]) == N_SAMPLES % BATCH_SIZE
+
+
+def test_stream_state_resumes_bucket_loader():
+    state, expected, epoch_batches = stream_state(bucket_loader, 3)
+    resumed = bucket_loader(seed=5)
+    resumed.load_state_dict(state)
+    assert epochs(resumed, 1)[0] == expected[:epoch_batches - 3]
+
+
+def test_epoch_state_resumes_stream():
+    loader = plain_loader()
+    expected = epochs(plain_loader(), 1)[0]
+    next(iter(loader))
+    resumed = StreamingDataLoader(plain_loader(seed=5), n_epochs=1, drop_last=False)
+    resumed.load_state_dict(checkpoint(loader.state_dict(2)))
+    assert [batch.tolist() for batch in resumed] == expected[2:]
+
+
+@pytest.mark.parametrize('source, target', [
+    (bucket_loader, plain_loader),
+    (plain_loader, bucket_loader),
+    (lambda: StreamingDataLoader(bucket_loader(), 2), lambda: StreamingDataLoader(plain_loader(), 2)),
+    (plain_loader, lambda: StreamingDataLoader(bucket_loader(), 2)),
+])
+def test_mismatched_state_raises(source, target):
+    source = source()
+    next(iter(source))
+    with pytest.raises(ValueError):
+        target().load_state_dict(checkpoint(source.state_dict(1)))
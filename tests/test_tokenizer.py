@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from utils.tokenizer import tokenize, remove_punctuation, CaptionTokenizer
+
+nltk_tokenize = pytest.importorskip('nltk.tokenize')
+
+CAPTIONS = [
+    'A small bird with a red crown, and white belly.',
+    "this bird's wings are black; its beak is short & pointed!",
+    'The flower has petals that are pink -- and yellow stamen?',
+    u'a “white” bird with a ‘long’ tail — perched on a branch',
+    u'«Bird» with „grey” feathers and a black–white ‒ striped head',
+    'i cannot tell, gimme a second: gonna go, gotta see, lemme look, wanna fly',
+    'CANNOT Gimme Wanna wanna. wannabe cannotx',
+    u'ΣΊΣΥΦΟΣ ΟΔΟΣ a bird',
+    '',
+    '   ',
+    12345,
+]
+
+
+def reference_tokens(caption):
+    # once the punctuation is removed a caption is a single sentence, preserve_line skips the sentence
+    # splitter and its punkt model
+    return nltk_tokenize.word_tokenize(remove_punctuation(str(caption)).lower(), preserve_line=True)
+
+
+@pytest.mark.parametrize('caption', CAPTIONS)
+def test_tokenize_matches_nltk(caption):
+    assert tokenize(caption) == reference_tokens(caption)
+
+
+def test_encode_batch_matches_encode():
+    word2idx = {'<unk>': 3, 'a': 4, 'bird': 5, 'with': 6, 'red': 7, 'can': 8, 'not': 9}
+    tokenizer = CaptionTokenizer(word2idx, word2idx['<unk>'])
+    flat_ids, offsets = tokenizer.encode_batch(CAPTIONS)
+
+    assert flat_ids.dtype == np.int32 and offsets.dtype == np.int64
+    assert len(offsets) == len(CAPTIONS) + 1
+    for i, caption in enumerate(CAPTIONS):
+        expected = [word2idx.get(token, word2idx['<unk>']) for token in reference_tokens(caption)]
+        assert flat_ids[offsets[i]:offsets[i + 1]].tolist() == expected
+        assert tokenizer.encode(caption).tolist() == expected
+
+
+def test_encode_batch_empty():
+    flat_ids, offsets = CaptionTokenizer({}, 0).encode_batch([])
+    assert len(flat_ids) == 0
+    assert offsets.tolist() == [0]
@@ -1,7 +1,12 @@
 import time
-from data_loader import COCOTextImageDataLoader, TextImageDataLoader
+import torch
+import numpy as np
+from data_loader import COCOTextImageDataLoader, COCOShardDataLoader, TextImageDataLoader, StreamingDataLoader
+from data_loader.prefetcher import DataPrefetcher
+from data_loader.damsm_cache import DAMSMTextCache, DAMSMImageCache, DAMSM_TEXT_FIELDS, DAMSM_IMAGE_FIELDS, damsm_cache_dir
+from model.networks import damsm_checkpoint
 from utils.visualization import Visualizer
-from model import create_model
+from model import create_model, get_sample_fields
 from options import TrainOptions
 
 
@@ -9,16 +14,121 @@ def get_instance(module, name, opt, *args):
     return getattr(module, opt[name]['type'])(*args, **opt[name]['args'])
 
 
-def main(opt):
-    # setup data_loader instances
-    if opt.dataset_name == 'CoCo':
+def training_state(epoch, epoch_iter, total_iters, data_loader_state):
+    return {
+        'epoch': epoch,
+        'epoch_iter': epoch_iter,
+        'total_iters': total_iters,
+        'data_loader': data_loader_state,
+        'torch_rng': torch.get_rng_state(),
+        'numpy_rng': np.random.get_state(),
+    }
+
+
+class EpochEvents(object):
+    """Callbacks run at the start and at the end of every epoch, with the epoch number."""
+    def __init__(self):
+        self.on_start = []
+        self.on_end = []
+
+    def start(self, epoch):
+        for callback in self.on_start:
+            callback(epoch)
+
+    def end(self, epoch):
+        for callback in self.on_end:
+            callback(epoch)
+
+
+def epoch_batches(batches, data_loader, first_epoch, last_epoch, events):
+    """Yield (epoch, position in the epoch, batches of the loader consumed, batch) for every training batch,
+    iterating over <batches> once per epoch; the DataLoader workers are started again every epoch."""
+    for epoch in range(first_epoch, last_epoch + 1):
+        events.start(epoch)
+        for i, data in enumerate(batches):  # inner loop within one epoch
+            # donot forward the last batchepochs
+            if i == len(data_loader) - 1:
+                break
+            yield epoch, i, i + 1, data
+        events.end(epoch)
+
+
+def stream_batches(batches, data_loader, first_epoch, events):
+    """Yield (epoch, position in the epoch, batches of the loader consumed, batch) for every training batch of a
+    StreamingDataLoader, iterated once; the end of an epoch is handled while the next batches are loading."""
+    epoch = 0
+    events.start(first_epoch)
+    for n, data in enumerate(batches):
+        batch_epoch, i = data_loader.position(n)
+        while epoch < batch_epoch:
+            events.end(first_epoch + epoch)
+            epoch += 1
+            events.start(first_epoch + epoch)
+        yield first_epoch + epoch, i, n + 1, data
+    events.end(first_epoch + epoch)
+
+
+def training_fields(opt):
+    """Batch fields consumed by the trainer of <opt.model>, None for all of them."""
+    # only compute the batch fields the trainer consumes
+    fields = get_sample_fields(opt.model)
+    if opt.damsm_text_cache:
+        if opt.coco_shards:
+            raise ValueError("--damsm_text_cache is not supported with --coco_shards")
+        if fields is not None:
+            fields = tuple(fields) + DAMSM_TEXT_FIELDS
+    if opt.streaming and opt.coco_shards:
+        raise ValueError("--streaming is not supported with --coco_shards")
+    if opt.damsm_image_cache:
+        if opt.coco_shards:
+            raise ValueError("--damsm_image_cache is not supported with --coco_shards")
+        if fields is not None:
+            fields = tuple(fields) + DAMSM_IMAGE_FIELDS
+
+    return fields
+
+
+def image_flip(opt):
+    """Whether the training images are randomly flipped; the features of --damsm_image_cache are the ones of
+    the unflipped images."""
+    return not opt.no_flip and not opt.damsm_image_cache
+
+
+def create_data_loader(opt, fields):
+    """Data loader of the training set, computing the batch <fields>."""
+    if opt.dataset_name == 'CoCo' and opt.coco_shards:
+        data_loader = COCOShardDataLoader(
+            data_dir=opt.dataroot + '/coco/',
+            which_set=opt.which_set,
+            image_size=opt.image_size,
+            batch_size=opt.batch_size,
+            num_workers=opt.num_workers,
+            pin_memory=opt.pin_memory,
+            prefetch_factor=opt.prefetch_factor,
+            shuffle_buffer=opt.shuffle_buffer,
+            fields=fields,
+            batch_pyramid=opt.batch_pyramid,
+            scaled_decode=not opt.full_decode,
+            uint8_images=opt.uint8_images
+        )
+    elif opt.dataset_name == 'CoCo':
         data_loader = COCOTextImageDataLoader(
             data_dir=opt.dataroot + '/coco/',
             which_set=opt.which_set,
             image_size=opt.image_size,
             batch_size=opt.batch_size,
             validation_split=opt.validation_split,
-            num_workers=opt.num_workers
+            num_workers=opt.num_workers,
+            pin_memory=opt.pin_memory,
+            prefetch_factor=opt.prefetch_factor,
+            bucket_by_length=opt.bucket_by_length,
+            max_tokens=opt.max_tokens or None,
+            fields=fields,
+            batch_pyramid=opt.batch_pyramid,
+            flip=image_flip(opt),
+            group_by_image=opt.group_by_image,
+            scaled_decode=not opt.full_decode,
+            uint8_images=opt.uint8_images
         )
     else:
         data_loader = TextImageDataLoader(
@@ -27,63 +137,150 @@ def main(opt):
             which_set=opt.which_set,
             image_size=opt.image_size,
             batch_size=opt.batch_size,
-            num_workers=opt.num_workers
+            num_workers=opt.num_workers,
+            pin_memory=opt.pin_memory,
+            prefetch_factor=opt.prefetch_factor,
+            use_image_pyramid=opt.use_image_pyramid,
+            columnar=opt.columnar_h5,
+            h5_cache_bytes=opt.h5_cache_mb * 1024 ** 2,
+            bucket_by_length=opt.bucket_by_length,
+            max_tokens=opt.max_tokens or None,
+            fields=fields,
+            batch_pyramid=opt.batch_pyramid,
+            flip=image_flip(opt),
+            scaled_decode=not opt.full_decode,
+            uint8_images=opt.uint8_images,
+            shared_cache_bytes=opt.shm_cache_mb * 1024 ** 2
         )
 
+    return data_loader
+
+
+def set_damsm_caches(opt, data_loader, model):
+    """Serve the DAMSM embeddings and features cached with --damsm_text_cache and --damsm_image_cache, computing
+    them first with the frozen encoders of <model> if needed."""
+    if opt.damsm_text_cache:
+        # the frozen text encoder runs once per caption instead of once per step
+        captions = data_loader.dataset.captions
+        text_cache = DAMSMTextCache(damsm_cache_dir(captions), captions, damsm_checkpoint(opt.dataset_name))
+        data_loader.dataset.set_text_embeddings(text_cache.build_or_load(model.rnn_encoder, model.device))
+    if opt.damsm_image_cache:
+        # the frozen image encoder runs once per real image instead of once per step
+        dataset = data_loader.dataset
+        image_cache = DAMSMImageCache(damsm_cache_dir(dataset.captions), opt.which_set, dataset.image_source_file(),
+                                      damsm_checkpoint(opt.dataset_name), image_settings=dataset.image_settings())
+        dataset.set_image_features(image_cache.build_or_load(dataset, model.cnn_encoder, model.device, opt.num_workers))
+
+
+def main(opt):
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+    # only compute the batch fields the trainer consumes
+    fields = training_fields(opt)
+
+    # setup data_loader instances
+    data_loader = create_data_loader(opt, fields)
+
     opt.vocab_size = len(data_loader.dataset.vocab)
     print("train vocab size:{}".format(opt.vocab_size))
 
     # setup model
     model = create_model(opt)      # create a model given opt.model and other options
     model.setup(opt)               # regular setup: load and print networks; create schedulers
+    model.set_image_flip(data_loader.dataset.flip)
+    set_damsm_caches(opt, data_loader, model)
     visualizer = Visualizer(opt)   # create a visualizer that display/save images and plots
     total_iters = 0                # the total number of training iterations
+    epoch_count = opt.epoch_count
+    last_epoch = opt.epochs + opt.nepoch_decay
 
-    for epoch in range(opt.epoch_count, opt.epochs + opt.nepoch_decay + 1):    # outer loop for different epochs; we save the model by <epoch_count>, <epoch_count>+<save_latest_freq>
-        epoch_start_time = time.time()  # timer for entire epoch
-        iter_data_time = time.time()    # timer for data loading per iteration
-        epoch_iter = 0                  # the number of training iterations in current epoch, reset to 0 every epoch
+    # resume an interrupted epoch at its next unseen batch
+    resume_state = None
+    if opt.continue_train:
+        resume_state = model.load_training_state('iter_%d' % opt.load_iter if opt.load_iter > 0 else opt.epoch)
+    if resume_state is not None:
+        epoch_count = resume_state['epoch']
+        total_iters = resume_state['total_iters']
+        torch.set_rng_state(resume_state['torch_rng'])
+        np.random.set_state(resume_state['numpy_rng'])
+    if opt.streaming:
+        # one iteration over all the epochs, the workers keep loading across the epoch boundaries
+        data_loader = StreamingDataLoader(data_loader, n_epochs=last_epoch - epoch_count + 1)
+    if resume_state is not None and resume_state['data_loader'] is not None:
+        data_loader.load_state_dict(resume_state['data_loader'])
+    # batches loaded and copied to the training device ahead of time
+    batches = DataPrefetcher(data_loader, model.device, opt.prefetch_batches) if opt.prefetch_batches > 0 else data_loader
 
-        for i, data in enumerate(data_loader):  # inner loop within one epoch
-            # donot forward the last batchepochs
-            if i == len(data_loader) -1:
-                break
+    events = EpochEvents()
+    epoch_start_time = {}
+
+    def start_epoch(epoch):
+        epoch_start_time[epoch] = time.time()  # timer for entire epoch
+        if batches is not data_loader:
+            batches.reset_stats()
 
-            iter_start_time = time.time()  # timer for computation per iteration
-            if total_iters % opt.print_freq == 0:
-                t_data = iter_start_time - iter_data_time
-            visualizer.reset()
-            total_iters += opt.batch_size
-            epoch_iter += opt.batch_size
-            model.set_input(data)         # unpack data from dataset and apply preprocessing
-            model.optimize_parameters()   # calculate loss functions, get gradients, update network weights
-
-            if total_iters % opt.display_freq == 0:   # display images on visdom and save images to a HTML file
-                save_result = total_iters % opt.update_html_freq == 0
-                model.compute_visuals()
-                visualizer.display_current_results(model.get_current_visuals(data_loader.dataset.vocab), epoch, save_result)
-
-            if total_iters % opt.print_freq == 0:    # print training losses and save logging information to the disk
-                losses = model.get_current_losses()
-                t_comp = (time.time() - iter_start_time) / opt.batch_size
-                visualizer.print_current_losses(epoch, epoch_iter, losses, t_comp, t_data)
-                if opt.display_id > 0:
-                    visualizer.plot_current_losses(epoch, float(epoch_iter) / len(data_loader), losses)
-
-            if total_iters % opt.save_latest_freq == 0:   # cache our latest model every <save_latest_freq> iterations
-                print('saving the latest model (epoch %d, total_iters %d)' % (epoch, total_iters))
-                save_suffix = 'iter_%d' % total_iters if opt.save_by_iter else 'latest'
-                model.save_networks(save_suffix)
-
-            iter_data_time = time.time()
+    def save_epoch(epoch):
         if epoch % opt.save_epoch_freq == 0:              # cache our model every <save_epoch_freq> epochs
             print('saving the model at the end of epoch %d, iters %d' % (epoch, total_iters))
             model.save_networks('latest')
             model.save_networks(epoch)
+            model.save_training_state('latest', training_state(epoch + 1, 0, total_iters, None))
+            model.save_training_state(epoch, training_state(epoch + 1, 0, total_iters, None))
+
+    def report_epoch(epoch):
+        print('End of epoch %d / %d \t Time Taken: %d sec' % (epoch, last_epoch, time.time() - epoch_start_time.pop(epoch)))
+        if batches is not data_loader:
+            print(batches.report())
+
+    events.on_start.append(start_epoch)
+    events.on_end.append(save_epoch)
+    events.on_end.append(report_epoch)
+    # events.on_end.append(lambda epoch: model.update_learning_rate())   # update learning rates at the end of every epoch.
+
+    if opt.streaming:
+        stream = stream_batches(batches, data_loader, epoch_count, events)
+    else:
+        stream = epoch_batches(batches, data_loader, epoch_count, last_epoch, events)
+
+    current_epoch = None
+    iter_data_time = time.time()    # timer for data loading per iteration
+    for epoch, i, batches_done, data in stream:    # epochs <epoch_count> to <last_epoch>; we save the model by <epoch_count>, <epoch_count>+<save_latest_freq>
+        if epoch != current_epoch:
+            current_epoch = epoch
+            epoch_iter = 0                  # the number of training iterations in current epoch, reset to 0 every epoch
+            if resume_state is not None:
+                epoch_iter = resume_state['epoch_iter']
+                resume_state = None
+
+        iter_start_time = time.time()  # timer for computation per iteration
+        if total_iters % opt.print_freq == 0:
+            t_data = iter_start_time - iter_data_time
+        visualizer.reset()
+        total_iters += opt.batch_size
+        epoch_iter += opt.batch_size
+        model.set_input(data)         # unpack data from dataset and apply preprocessing
+        model.optimize_parameters()   # calculate loss functions, get gradients, update network weights
+
+        if total_iters % opt.display_freq == 0:   # display images on visdom and save images to a HTML file
+            save_result = total_iters % opt.update_html_freq == 0
+            model.compute_visuals()
+            visualizer.display_current_results(model.get_current_visuals(data_loader.dataset.vocab), epoch, save_result)
+
+        if total_iters % opt.print_freq == 0:    # print training losses and save logging information to the disk
+            losses = model.get_current_losses()
+            t_comp = (time.time() - iter_start_time) / opt.batch_size
+            visualizer.print_current_losses(epoch, epoch_iter, losses, t_comp, t_data)
+            if opt.display_id > 0:
+                visualizer.plot_current_losses(epoch, float(epoch_iter) / len(data_loader), losses)
 
-        print('End of epoch %d / %d \t Time Taken: %d sec' % (epoch, opt.epochs + opt.nepoch_decay, time.time() - epoch_start_time))
-        # model.update_learning_rate()                     # update learning rates at the end of every epoch.
+        if total_iters % opt.save_latest_freq == 0:   # cache our latest model every <save_latest_freq> iterations
+            print('saving the latest model (epoch %d, total_iters %d)' % (epoch, total_iters))
+            save_suffix = 'iter_%d' % total_iters if opt.save_by_iter else 'latest'
+            model.save_networks(save_suffix)
+            model.save_training_state(save_suffix, training_state(epoch, epoch_iter, total_iters,
+                                                                  data_loader.state_dict(batches_done)))
 
+        iter_data_time = time.time()
 
 if __name__ == '__main__':
     opt = TrainOptions().parse()
@@ -11,6 +11,9 @@ dirname = os.path.dirname(__file__)
 
 
 class AttnGANtrainer(BaseTrainer):
+    sample_fields = ('class_id', 'right_captions', 'right_caption_lengths',
+                     'right_images_64', 'right_images_128', 'right_images_256')
+
     @staticmethod
     def modify_commandline_options(parser, is_train=True):
         """Add new dataset-specific options, and rewrite default values for existing options.
@@ -75,12 +78,18 @@ class AttnGANtrainer(BaseTrainer):
         Parameters:
             input (dict): include the data itself and its metadata information.
         """
+        batch_size = data["right_captions"].size(0)
+        if batch_size != self.batch_size:
+            self.set_batch_size(batch_size)
+        data = self.expand_images(data)
+
         self.real_imgs = []
         self.real_imgs.append(data["right_images_64"].to(self.device))
         self.real_imgs.append(data["right_images_128"].to(self.device))
         self.real_imgs.append(data["right_images_256"].to(self.device))
         self.right_captions = data["right_captions"].to(self.device)
         self.right_caption_lengths = data["right_caption_lengths"].to(self.device)
+        self.right_text_embs = self.get_text_embeddings(data)
         self.class_ids = np.array(data['class_id'])
         self.labels = torch.LongTensor(range(self.batch_size)).to(self.device)
 
@@ -107,8 +116,12 @@ class AttnGANtrainer(BaseTrainer):
         # words_embs: batch_size x nef x seq_len
         # sent_emb: batch_size x nef
 
-        self.words_embs, self.sent_emb = self.rnn_encoder(self.right_captions, self.right_caption_lengths)
-        self.words_embs, self.sent_emb = self.words_embs.detach(), self.sent_emb.detach()
+        if self.right_text_embs is not None:
+            # computed once by the frozen text encoder, see data_loader/damsm_cache.py
+            self.words_embs, self.sent_emb = self.right_text_embs
+        else:
+            self.words_embs, self.sent_emb = self.rnn_encoder(self.right_captions, self.right_caption_lengths)
+            self.words_embs, self.sent_emb = self.words_embs.detach(), self.sent_emb.detach()
         mask = (self.right_captions == 0)
         num_words = self.words_embs.size(2)
         if mask.size(1) > num_words:
@@ -1,10 +1,13 @@
 import os
 import json
+import pickle
 import torch
 import logging
+from torch.autograd import Variable
 from collections import OrderedDict
 from abc import ABC, abstractmethod
 from model import networks
+from data_loader.batch_transforms import expand_image_pyramid
 from utils.util import ensure_dir
 
 
@@ -17,6 +20,8 @@ class BaseTrainer(ABC):
         -- <configimize_parameters>:           calculate losses, gradients, and update network weights.
         -- <modify_commandline_configions>:    (configionally) add model-specific configions and set default configions.
     """
+    # batch fields read by <set_input>, the datasets skip computing the others; None to get every field
+    sample_fields = None
 
     def __init__(self, opt):
         """Initialize the BaseModel class.
@@ -46,6 +51,8 @@ class BaseTrainer(ABC):
         self.optimizers = []
         self.configimizers = []
         self.image_paths = []
+        # random flip of the uint8 images, the one of the data loader, see <set_image_flip>
+        self.image_flip = False
         self.metric = None # used for learning rate policy 'plateau'
 
     def prepare_device(self, n_gpu_use):
@@ -65,6 +72,40 @@ class BaseTrainer(ABC):
         list_ids = list(range(n_gpu_use))
         return device, list_ids
 
+    def set_batch_size(self, batch_size):
+        """Resize the noise and label buffers; called by <set_input> when a batch of another size comes in,
+        e.g. the batches sized by a token budget of data_loader.samplers.BucketBatchSampler."""
+        self.batch_size = batch_size
+        self.noise = Variable(torch.FloatTensor(self.batch_size, 100), volatile=True)
+        self.noise.to(self.device)
+        self.real_labels, self.fake_labels, self.match_labels = self.prepare_labels()
+
+    def set_image_flip(self, flip):
+        """Randomly flip the uint8 images in <expand_images> when the dataset flips its normalized images,
+        see the <flip> attribute of the datasets."""
+        self.image_flip = flip
+
+    def expand_images(self, data):
+        """Build on the training device the smaller images, flips and normalization of a batch loaded
+        with --batch_pyramid or --uint8_images; batches of normalized images are returned unchanged."""
+        return expand_image_pyramid(data, fields=self.sample_fields, flip=self.image_flip, device=self.device)
+
+    def get_text_embeddings(self, data):
+        """DAMSM word and sentence embeddings of the right captions of a batch loaded with --damsm_text_cache,
+        shaped like the outputs of the text encoder: (batch, nef, seq_len) and (batch, nef); None without the cache."""
+        if 'right_words_embs' not in data:
+            return None
+        words_embs = data['right_words_embs'].to(self.device).float().transpose(1, 2).contiguous()
+        sent_emb = data['right_sent_emb'].to(self.device).float()
+        return words_embs, sent_emb
+
+    def get_image_features(self, data):
+        """DAMSM region features and global codes of the right images of a batch loaded with --damsm_image_cache,
+        shaped like the outputs of the image encoder: (batch, nef, 17, 17) and (batch, nef); None without the cache."""
+        if 'right_cnn_codes' not in data:
+            return None
+        return data['right_region_features'].to(self.device).float(), data['right_cnn_codes'].to(self.device).float()
+
     @staticmethod
     def modify_commandline_configions(parser, ):
         """Add new model-specific configions, and rewrite default values for existing configions.
@@ -199,6 +240,27 @@ class BaseTrainer(ABC):
         else:
             self.__patch_instance_norm_state_dict(state_dict, getattr(module, key), keys, i + 1)
 
+    def save_training_state(self, suffix, state):
+        """Save the training progress (counters, random states, data loader sampling state) next to the networks.
+        Parameters:
+            suffix (str) -- suffix of the networks saved with it; used in the file name '%s_train_state.pkl' % suffix
+            state (dict) -- training progress
+        """
+        save_path = os.path.join(self.save_dir, '%s_train_state.pkl' % suffix)
+        # written to a temporary file first, a job preempted while saving keeps the previous state
+        with open(save_path + '.tmp', 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(save_path + '.tmp', save_path)
+
+    def load_training_state(self, suffix):
+        """Load the training progress saved by <save_training_state>, None if it was not saved."""
+        load_path = os.path.join(self.save_dir, '%s_train_state.pkl' % suffix)
+        if not os.path.exists(load_path):
+            return None
+        print('loading the training state from %s' % load_path)
+        with open(load_path, 'rb') as f:
+            return pickle.load(f)
+
     def load_networks(self, epoch):
         """Load all the networks from the disk.
         Parameters:
@@ -12,6 +12,11 @@ dirname = os.path.dirname(__file__)
 
 
 class CycleGANTrainer(BaseTrainer):
+    sample_fields = ('class_id', 'right_captions', 'right_caption_lengths',
+                     'right_images_64', 'right_images_128', 'right_images_256',
+                     'wrong_captions', 'wrong_caption_lengths',
+                     'wrong_images_64', 'wrong_images_128', 'wrong_images_256')
+
     @staticmethod
     def modify_commandline_options(parser, is_train=True):
         """Add new dataset-specific options, and rewrite default values for existing options.
@@ -95,12 +100,19 @@ class CycleGANTrainer(BaseTrainer):
         Parameters:
             input (dict): include the data itself and its metadata information.
         """
+        batch_size = data["right_captions"].size(0)
+        if batch_size != self.batch_size:
+            self.set_batch_size(batch_size)
+        data = self.expand_images(data)
+
         self.real_imgs = []
         self.real_imgs.append(data["right_images_64"].to(self.device))
         self.real_imgs.append(data["right_images_128"].to(self.device))
         self.real_imgs.append(data["right_images_256"].to(self.device))
         self.real_captions = data["right_captions"].to(self.device)
         self.real_caption_lengths = data["right_caption_lengths"].to(self.device)
+        self.real_text_embs = self.get_text_embeddings(data)
+        self.real_image_features = self.get_image_features(data)
         self.class_ids = np.array(data['class_id'])
         self.labels = torch.LongTensor(range(self.batch_size)).to(self.device)
 
@@ -126,7 +138,7 @@ class CycleGANTrainer(BaseTrainer):
     def forward(self):
 
         # Forward from sentence to image G(S) = I
-        self.fake_imgs, self.mu, self.logvar, self.real_words_embs, self.real_sent_emb = self.forward_G_I(self.real_captions, self.real_caption_lengths)
+        self.fake_imgs, self.mu, self.logvar, self.real_words_embs, self.real_sent_emb = self.forward_G_I(self.real_captions, self.real_caption_lengths, self.real_text_embs)
 
         # Reconstruction from fake image to rec sentence F(G(S)) = S_hat
         _, _, self.rec_captions, self.rec_caption_lengths = self.forward_G_S(self.fake_imgs[-1])
@@ -141,7 +153,11 @@ class CycleGANTrainer(BaseTrainer):
         ###### Compute images feauters
         _, self.rec_sent_emb = self.rnn_encoder(self.rec_captions, self.rec_caption_lengths)
         _, self.rec_image_emb = self.cnn_encoder(self.rec_images[-1])
-        _, self.real_image_emb = self.cnn_encoder(self.real_imgs[-1])
+        if self.real_image_features is not None:
+            # computed once by the frozen image encoder, see data_loader/damsm_cache.py
+            _, self.real_image_emb = self.real_image_features
+        else:
+            _, self.real_image_emb = self.cnn_encoder(self.real_imgs[-1])
 
 
     def forward_G_S(self, images):
@@ -161,14 +177,17 @@ class CycleGANTrainer(BaseTrainer):
 
         return rewards, props, fake_captions, fake_caption_lengths
 
-    def forward_G_I(self, captions, caption_lengths):
+    def forward_G_I(self, captions, caption_lengths, text_embs=None):
 
-        """ Forward through the generator of AttnGAN """
+        """ Forward through the generator of AttnGAN, <text_embs> are the precomputed DAMSM embeddings of the captions if any """
         ####### Forward AttnGAN Generator #########
         # words_embs: batch_size x nef x seq_len
         # sent_emb: batch_size x nef
-        words_embs, sent_emb = self.rnn_encoder(captions, caption_lengths)
-        words_embs, sent_emb = words_embs.detach(), sent_emb.detach()
+        if text_embs is not None:
+            words_embs, sent_emb = text_embs
+        else:
+            words_embs, sent_emb = self.rnn_encoder(captions, caption_lengths)
+            words_embs, sent_emb = words_embs.detach(), sent_emb.detach()
         mask = (captions == 0)
         num_words = words_embs.size(2)
         if mask.size(1) > num_words:
@@ -1,24 +1,138 @@
-import nltk
 import os
-import pickle
 import json
 import h5py
-import sys
 import string
+import hashlib
+import torch
 import numpy as np
+from multiprocessing import Pool
 dirname = os.path.dirname(__file__)
 dirname = os.path.dirname(dirname)
-sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data/coco/cocoapi/PythonAPI'))
-from pycocotools.coco import COCO
 from tqdm import tqdm
 from collections import Counter
+from utils.tokenizer import PUNCTUATION_TABLE, tokenize
 from autocorrect import spell
 from nltk.corpus import wordnet as WN
 from nltk.corpus import stopwords
 stop_words_en = set(stopwords.words('english'))
 
 
-class COCOVocabulary(object):
+def file_fingerprint(path):
+    """Return the sha1 of the content of a file. The hash is memoized in <path>.sha1.json
+    and computed again only when the size or the modification time of the file change."""
+    memo_file = path + '.sha1.json'
+    stat = os.stat(path)
+    if os.path.exists(memo_file):
+        with open(memo_file, 'r') as f:
+            memo = json.load(f)
+        if memo['size'] == stat.st_size and memo['mtime'] == stat.st_mtime:
+            return memo['sha1']
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    try:
+        with open(memo_file, 'w') as f:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}, f)
+    except IOError:
+        # read-only dataset directory, the hash is computed again next time
+        pass
+    return sha1.hexdigest()
+
+
+def vocab_cache_file(cache_dir, source_file, vocab_threshold, start_word, end_word, unk_word):
+    """Path of the vocabulary built from <source_file> with these settings, named after their fingerprint."""
+    key = json.dumps([file_fingerprint(source_file), vocab_threshold, start_word, end_word, unk_word])
+    return os.path.join(cache_dir, 'vocab_{}.json'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+
+def _count_chunk(captions):
+    counter = Counter()
+    for caption in captions:
+        counter.update(tokenize(caption))
+    return counter
+
+
+def count_tokens(captions, num_workers=None, chunk_size=2000):
+    """Count the tokens of <captions> in parallel. Chunk counts are merged in order, so words are
+    ordered by first occurrence like with a serial count."""
+    chunks = [captions[start:start + chunk_size] for start in range(0, len(captions), chunk_size)]
+    counter = Counter()
+    pool = Pool(num_workers)
+    try:
+        for i, chunk_counter in enumerate(pool.imap(_count_chunk, chunks)):
+            counter.update(chunk_counter)
+            print("[%d/%d] Tokenizing captions..." % (min((i + 1) * chunk_size, len(captions)), len(captions)))
+    finally:
+        pool.close()
+        pool.join()
+    return counter
+
+
+class VocabularyTableMixin(object):
+    """Word tables of the vocabularies: <idx2word> is a numpy array of the words in id order and
+    <word2idx> a dict, so that whole batches of tokens are encoded, and whole batches of ids decoded,
+    without a Python call per token."""
+
+    def set_words(self, words):
+        """Set the tables from the list of the words in id order."""
+        self.word2idx = {word: idx for idx, word in enumerate(words)}
+        self.idx2word = np.array(words, dtype=np.str_)
+        self.idx = len(words)
+
+    def load_words(self, path):
+        """Load the words saved by <save_words>, in id order."""
+        with open(path, 'r') as f:
+            self.set_words(json.load(f)['words'])
+
+    def save_words(self, path):
+        # written to a temporary file first so that concurrent runs never read a partial vocabulary
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'words': self.idx2word.tolist()}, f)
+        os.replace(path + '.tmp', path)
+
+    def encode(self, tokens_2d):
+        """Encode a batch of token lists.
+            @:param tokens_2d (list): list of lists of tokens
+            @:return (N, max length) int64 array of the ids, padded with 0 like the collated captions,
+                     and the (N,) int64 array of the lengths
+        """
+        get = self.word2idx.get
+        unk_idx = self.word2idx[self.unk_word]
+        lengths = np.array([len(tokens) for tokens in tokens_2d], dtype=np.int64)
+        flat_ids = np.array([get(token, unk_idx) for tokens in tokens_2d for token in tokens], dtype=np.int64)
+        ids = np.zeros((len(lengths), lengths.max() if len(lengths) > 0 else 0), dtype=np.int64)
+        ids[np.arange(ids.shape[1]) < lengths[:, None]] = flat_ids
+        return ids, lengths
+
+    def decode(self, id_matrix, stop_at_end=True):
+        """Decode a batch of ids into words, without the start words.
+            @:param id_matrix (array like or tensor): (N, L) ids, or the (L,) ids of a single caption
+            @:param stop_at_end (bool): drop the end word and everything after it
+            @:return list of the N lists of words, or the list of words of the single caption
+        """
+        if torch.is_tensor(id_matrix):
+            id_matrix = id_matrix.detach().cpu().numpy()
+        ids = np.asarray(id_matrix, dtype=np.int64)
+        single = ids.ndim == 1
+        ids = ids.reshape(-1, ids.shape[-1])
+
+        keep = ids != self.word2idx[self.start_word]
+        if stop_at_end:
+            keep &= np.cumsum(ids == self.word2idx[self.end_word], axis=1) == 0
+        words = self.idx2word[ids]
+        sentences = [row_words[row_keep].tolist() for row_words, row_keep in zip(words, keep)]
+        return sentences[0] if single else sentences
+
+    def __call__(self, word):
+        return self.word2idx.get(word, self.word2idx[self.unk_word])
+
+    def __len__(self):
+        return len(self.word2idx)
+
+
+class COCOVocabulary(VocabularyTableMixin):
 
     def __init__(self,
         vocab_threshold,
@@ -33,14 +147,13 @@ class COCOVocabulary(object):
         Initialize the vocabulary.
             Paramters:
               vocab_threshold: Minimum word count threshold.
-              vocab_file: File containing the vocabulary.
+              vocab_file: File of the vocabulary, the cached vocabularies are saved in its directory.
               start_word: Special word denoting sentence start.
               end_word: Special word denoting sentence end.
               unk_word: Special word denoting unknown words.
               annotations_file: Path for train annotation file.
-              vocab_from_file: If False, create vocab from scratch & override any
-                               existing vocab_file. If True, load vocab from from
-                               existing vocab_file, if it exists.
+              vocab_from_file: Unused, the vocabulary is loaded from the cache when the annotations
+                               file and settings did not change, see <get_vocab>.
         """
         self.vocab_threshold = vocab_threshold
         self.vocab_file = vocab_file
@@ -52,17 +165,17 @@ class COCOVocabulary(object):
         self.get_vocab()
 
     def get_vocab(self):
-        """Load the vocabulary from file or build it from scratch."""
-        if os.path.exists(self.vocab_file) & self.vocab_from_file:
-            with open(self.vocab_file, "rb") as f:
-                vocab = pickle.load(f)
-                self.word2idx = vocab.word2idx
-                self.idx2word = vocab.idx2word
-            print("Vocabulary successfully loaded from vocab.pkl file!")
+        """Load the vocabulary from the cache or build it from scratch. Vocabularies are cached in the
+        directory of <vocab_file> by fingerprint of the annotations file and settings, whatever
+        <vocab_from_file>, like the birds / flowers ones."""
+        cache_file = vocab_cache_file(os.path.dirname(self.vocab_file), self.annotations_file, self.vocab_threshold,
+                                      self.start_word, self.end_word, self.unk_word)
+        if os.path.exists(cache_file):
+            self.load_words(cache_file)
+            print("Vocabulary successfully loaded from {}".format(cache_file))
         else:
             self.build_vocab()
-            with open(self.vocab_file, "wb") as f:
-                pickle.dump(self, f)
+            self.save_words(cache_file)
 
     def build_vocab(self):
         """Populate the dictionaries for converting tokens to integers
@@ -90,33 +203,19 @@ class COCOVocabulary(object):
     def add_captions(self):
         """Loop over training captions and add all tokens to the vocabulary
         that meet or exceed the threshold."""
-        coco = COCO(self.annotations_file)
-        counter = Counter()
-        ids = coco.anns.keys()
-        for i, id in enumerate(ids):
-            caption = str(coco.anns[id]["caption"])
-            caption = text_clean(caption)
-            tokens = nltk.tokenize.word_tokenize(caption.lower())
-            counter.update(tokens)
-
-            if i % 100000 == 0:
-                print("[%d/%d] Tokenizing captions..." % (i, len(ids)))
+        with open(self.annotations_file, 'r') as f:
+            annotations = json.load(f)['annotations']
+        counter = count_tokens([str(ann["caption"]) for ann in annotations])
 
         words = [word for word, cnt in counter.items()
                  if cnt >= self.vocab_threshold]
 
         for i, word in enumerate(words):
             self.add_word(word)
-    def __call__(self, word):
-        if not word in self.word2idx:
-            return self.word2idx[self.unk_word]
-        return self.word2idx[word]
-
-    def __len__(self):
-        return len(self.word2idx)
+        self.set_words([self.idx2word[idx] for idx in range(self.idx)])
 
 
-class Vocabulary(object):
+class Vocabulary(VocabularyTableMixin):
 
     def __init__(self,
         vocab_threshold,
@@ -144,16 +243,13 @@ class Vocabulary(object):
         self.end_word = end_word
         self.unk_word = unk_word
 
-        if vocab_from_file:
-            raise ValueError("cannot read h5 data from pickle, please try generate dictionary")
-
         self.vocab_from_file = vocab_from_file
 
         assert dataset_name in {'birds', 'flowers'}, "Wrong dataset name: {}".format(dataset_name)
         self.dataset_name = dataset_name
 
         if os.path.exists(data_dir):
-            self.vocab_file = os.path.join(data_dir, '{}/vocab.pkl'.format(dataset_name))
+            self.vocab_dir = os.path.join(data_dir, dataset_name)
             self.h5_file = os.path.join(data_dir, '{}/{}.hdf5'.format(dataset_name, dataset_name))
         else:
             raise ValueError("data directory do not exist")
@@ -161,17 +257,19 @@ class Vocabulary(object):
         self.get_vocab()
 
     def get_vocab(self):
-        """Load the vocabulary from file or build it from scratch."""
-        if os.path.exists(self.vocab_file) & self.vocab_from_file:
-            with open(self.vocab_file, "rb") as f:
-                vocab = pickle.load(f)
-                self.word2idx = vocab.word2idx
-                self.idx2word = vocab.idx2word
-            print("Vocabulary successfully loaded from vocab.pkl file!")
+        """Load the vocabulary from the cache or build it from scratch. Vocabularies are cached
+        by fingerprint of the hdf5 file and settings, whatever <vocab_from_file>."""
+        if not os.path.exists(self.h5_file):
+            raise ValueError("data h5 file do not exist")
+
+        cache_file = vocab_cache_file(self.vocab_dir, self.h5_file, self.vocab_threshold,
+                                      self.start_word, self.end_word, self.unk_word)
+        if os.path.exists(cache_file):
+            self.load_words(cache_file)
+            print("Vocabulary successfully loaded from {}".format(cache_file))
         else:
             self.build_vocab()
-            with open(self.vocab_file, "wb") as f:
-                pickle.dump(self, f)
+            self.save_words(cache_file)
 
     def build_vocab(self):
         """Populate the dictionaries for converting tokens to integers
@@ -199,33 +297,21 @@ class Vocabulary(object):
     def add_captions(self):
         """Loop over training captions and add all tokens to the vocabulary
         that meet or exceed the threshold."""
-        if os.path.exists(self.h5_file):
-            self.data = h5py.File(self.h5_file, mode='r')
-            ids = [str(k) for k in self.data['train'].keys()]
-        else:
+        if not os.path.exists(self.h5_file):
             raise ValueError("data h5 file do not exist")
 
-        counter = Counter()
-        for i, id in enumerate(tqdm(ids)):
-            caption = str(np.array(self.data['train'][id]['txt']))
-            caption = text_clean(caption)
-            tokens = nltk.tokenize.word_tokenize(caption.lower())
-            # tokens = [word for word in tokens]
-            counter.update(tokens)
+        # keep the handle local, an open h5py file cannot be pickled nor shared with DataLoader workers
+        with h5py.File(self.h5_file, mode='r') as data:
+            ids = [str(k) for k in data['train'].keys()]
+            captions = [str(np.array(data['train'][id]['txt'])) for id in tqdm(ids)]
+        counter = count_tokens(captions)
 
         words = [word for word, cnt in counter.items()
                  if cnt >= self.vocab_threshold]
 
         for i, word in enumerate(words):
             self.add_word(word)
-
-    def __call__(self, word):
-        if not word in self.word2idx:
-            return self.word2idx[self.unk_word]
-        return self.word2idx[word]
-
-    def __len__(self):
-        return len(self.word2idx)
+        self.set_words([self.idx2word[idx] for idx in range(self.idx)])
 
 
 def SpellChecker(token):
@@ -243,9 +329,7 @@ def SpellChecker(token):
 
 
 def remove_punctuation(text_original):
-    translator = str.maketrans('', '', string.punctuation)
-    text_no_punctuation = text_original.translate(translator)
-    return(text_no_punctuation)
+    return text_original.translate(PUNCTUATION_TABLE)
 
 
 def text_clean(text_original):
@@ -0,0 +1,62 @@
+import re
+import string
+import numpy as np
+
+# ASCII punctuation removed by text_clean
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+# Once the ASCII punctuation is removed, the only rules of nltk.tokenize.word_tokenize that can still
+# apply are the split of the unicode quotes and dashes, and the split of a few contractions.
+# Sentence splitting only happens on '.', '?' and '!', so the whole caption is a single sentence.
+_SPLIT_TABLE = str.maketrans({c: ' {} '.format(c) for c in u'«“‘„»”’‒–—―'})
+
+# CONTRACTIONS2 of nltk.tokenize.destructive.MacIntyreContractions merged in a single pass; the ones
+# holding an apostrophe (d'ye, more'n and CONTRACTIONS3) cannot match without the punctuation.
+# A split never creates a match for another alternative, so one pass is the same as one pass per pattern.
+_CONTRACTIONS = re.compile(r"(?i)\b(?:(can)(not)\b|(gim)(me)\b|(gon)(na)\b|(got)(ta)\b|(lem)(me)\b|(wan)(na)(?=\s))")
+
+
+def _split_contraction(match):
+    return ' {} {} '.format(match.group(match.lastindex - 1), match.group(match.lastindex))
+
+
+def remove_punctuation(text):
+    return text.translate(PUNCTUATION_TABLE)
+
+
+def tokenize(caption):
+    """Tokens of a raw caption, the same as nltk.tokenize.word_tokenize(text_clean(str(caption)).lower())."""
+    # lowercased before the quotes are padded, the context of a letter can change its lowercase (final sigma)
+    text = remove_punctuation(str(caption)).lower().translate(_SPLIT_TABLE)
+    text = _CONTRACTIONS.sub(_split_contraction, ' ' + text + ' ')
+    return text.split()
+
+
+class CaptionTokenizer(object):
+    """Tokenize and encode captions with the word -> id mapping of a vocabulary."""
+    def __init__(self, word2idx, unk_idx):
+        """
+            @:param word2idx (dict): word -> id mapping of the vocabulary
+            @:param unk_idx (int): id of the words missing from the vocabulary
+        """
+        self.word2idx = word2idx
+        self.unk_idx = unk_idx
+
+    def encode(self, caption):
+        """Return the int32 token ids of a caption, without the start and end words."""
+        get = self.word2idx.get
+        unk_idx = self.unk_idx
+        return np.array([get(token, unk_idx) for token in tokenize(caption)], dtype=np.int32)
+
+    def encode_batch(self, captions):
+        """Encode a list of captions into one flat array, caption i being flat_ids[offsets[i]:offsets[i + 1]].
+            @:return flat_ids (int32), offsets (int64, one more than the captions)
+        """
+        get = self.word2idx.get
+        unk_idx = self.unk_idx
+        ids = []
+        offsets = np.zeros(len(captions) + 1, dtype=np.int64)
+        for i, caption in enumerate(captions):
+            ids.extend([get(token, unk_idx) for token in tokenize(caption)])
+            offsets[i + 1] = len(ids)
+        return np.array(ids, dtype=np.int32), offsets
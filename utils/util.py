@@ -120,31 +120,14 @@ def word_list(word_idx_list, vocab):
     """Take a list of word ids and a vocabulary from a dataset as inputs
     and return the corresponding words as a list.
     """
-    word_list = []
-    for i in range(len(word_idx_list)):
-        vocab_id = word_idx_list[i]
-        word = vocab.idx2word[vocab_id]
-        if word == vocab.end_word:
-            break
-        if word != vocab.start_word:
-            word_list.append(word)
-    return word_list
+    return vocab.decode(word_idx_list, stop_at_end=True)
 
 
 def clean_sentence(word_idx_list, vocab):
     """Take a list of word ids and a vocabulary from a dataset as inputs
     and return the corresponding sentence (as a single Python string).
     """
-    sentence = []
-    for i in range(len(word_idx_list)):
-        vocab_id = word_idx_list[i]
-        word = vocab.idx2word[vocab_id]
-        if word == vocab.end_word:
-            break
-        if word != vocab.start_word:
-            sentence.append(word)
-    sentence = " ".join(sentence)
-    return sentence
+    return " ".join(vocab.decode(word_idx_list, stop_at_end=True))
 
 def get_end_symbol_index(caption_list):
     if 1 in caption_list:
@@ -264,10 +247,11 @@ def mkdir(path):
 
 
 def convert_back_to_text(word_idx_array, vocab):
-    from itertools import takewhile
-    blacklist = [vocab.word2idx[word] for word in [vocab.start_word]]
-    predicate = lambda word_id: vocab.idx2word[word_id] != vocab.end_word
-    sampled_caption = [vocab.idx2word[word_id] for word_id in takewhile(predicate, word_idx_array) if word_id not in blacklist]
-
-    sentence = '-'.join(sampled_caption)
-    return sentence
\ No newline at end of file
+    """Words of the ids up to the end word, without the start words, joined with '-'.
+    A (N, L) array of ids gives the list of the N texts."""
+    if torch.is_tensor(word_idx_array):
+        word_idx_array = word_idx_array.detach().cpu().numpy()
+    sampled_captions = vocab.decode(word_idx_array, stop_at_end=True)
+    if np.ndim(word_idx_array) == 1:
+        return '-'.join(sampled_captions)
+    return ['-'.join(sampled_caption) for sampled_caption in sampled_captions]